@@ -21,12 +21,13 @@ along with this program.  If not, see <https://www.gnu.org/licenses/>.
 """
 
 import importlib.metadata
+import json
 from json.decoder import JSONDecodeError
 import logging
 import multiprocessing
 import os
+import threading
 import typing as T
-import uuid
 
 import botocore
 import flask
@@ -34,9 +35,12 @@ import paramiko
 import requests
 import uploadtogenestack
 
+import api_cache
+from api_presets import apply_column_preset
 from api_utils import *  # pylint: disable=wildcard-import
 import config
 import uploader
+import upstream
 
 # first up, we need to grab the genestack configuration
 # this is typically in ~/.genestack.cfg
@@ -71,19 +75,184 @@ api_blueprint = flask.Blueprint("api", "api")
 logger: logging.Logger = logging.getLogger("API")
 logger.setLevel(config.LOG_LEVEL)
 
-all_jobs: T.Dict[uuid.UUID, uploader.GenestackUploadJob] = {}
+DEFAULT_STUDY_SEARCH_LIMIT: int = 20
+MAX_STUDY_SEARCH_LIMIT: int = 100
+
+# when run with several web workers (see gunicorn.conf.py), this module
+# is imported once, before they're forked, so they all share this queue
+# with the job workers
 jobs_queue: "multiprocessing.Queue[uploader.GenestackUploadJob]" = multiprocessing.Queue(
 )
 
+_jobs_processes: T.List[multiprocessing.Process] = []
+
 
 def start_multiproc():
-    """start the multiprocessing - another process handles
-    the upload jobs coming off the queue"""
-    _jobs_process: multiprocessing.Process = multiprocessing.Process(
-        target=uploader.job_handler,
-        args=(jobs_queue,)
-    )
-    _jobs_process.start()
+    """start the multiprocessing - a pool of JOB_WORKERS
+    processes handle the upload jobs coming off the queue"""
+    uploader.reset_worker_states()
+    interrupted: int = uploader.fail_interrupted_jobs()
+    if interrupted:
+        logger.warning(f"failed {interrupted} job(s) left unfinished by a restart")
+    logger.info(f"starting {uploader.JOB_WORKERS} job worker(s)")
+    for worker_id in range(uploader.JOB_WORKERS):
+        _jobs_process: multiprocessing.Process = multiprocessing.Process(
+            target=uploader.job_handler,
+            args=(jobs_queue, worker_id),
+            name=f"job-worker-{worker_id}"
+        )
+        _jobs_process.start()
+        _jobs_processes.append(_jobs_process)
+
+    # a job worker that dies in the S3 public policy window can't leave
+    # it, and its linger timer dies with it, so this process keeps watch
+    threading.Thread(
+        target=uploader.s3.policy_watchdog,
+        args=(s3_bucket,),
+        name="policy-watchdog",
+        daemon=True
+    ).start()
+
+
+def stop_multiproc():
+    """stop the job workers started by start_multiproc,
+    such as when the server shuts down"""
+    logger.info(f"stopping {len(_jobs_processes)} job worker(s)")
+    for _jobs_process in _jobs_processes:
+        _jobs_process.terminate()
+    for _jobs_process in _jobs_processes:
+        _jobs_process.join()
+    _jobs_processes.clear()
+
+    # a worker may have been stopped while the public policy lingered,
+    # or part way through a job, so don't leave the bucket public
+    uploader.s3.close_public_policy(s3_bucket, force=True)
+
+
+def start_expiry_sweeper():
+    """start the thread that periodically removes
+    expired jobs from the job store"""
+    threading.Thread(
+        target=uploader.expiry_sweeper,
+        name="expiry-sweeper",
+        daemon=True
+    ).start()
+
+
+def template_detail(token: str, template_id: str) -> T.List[T.Dict[str, T.Any]]:
+    """get the fields of template <template_id> (accession),
+    from the template cache, or from Genestack
+
+    Raises:
+        TemplateNotFoundError: if Genestack can't find it
+    """
+    template_id = template_id.strip()
+
+    def lookup(gsu: uploadtogenestack.GenestackUtils) -> T.Any:
+        with upstream.timed_call("get_template_detail"):
+            template = gsu.ApplicationsODM(
+                gsu, None).get_template_detail(template_id)
+
+        if "Failed to found template" in template.text:
+            # OK, here we go
+            # Time for a bit of complaining about the Genestack API
+
+            # What I wanted to do here was:
+            # if template.status_code == 404:
+            # you know, like I should be able to do, as 404 is the status code
+            # for when something isn't found.
+
+            # But Genestack doesn't return a 404 when it can't find the template,
+            # instead it returns "201 Created". **mindblow**
+            # It's not like its even creating the template when it doesn't find it
+
+            # So, here we are. I'm searching for "Failed to found template" in
+            # the response text. Which doesn't even really make sense.
+
+            # ¯\_(ツ)_/¯
+            # Complaining Over.
+
+            # not found isn't cached, the template might be made soon
+            raise TemplateNotFoundError(template.json()["error"])
+
+        return template.json()["result"]
+
+    return upstream.cached_template_lookup(token, ("template", template_id), lookup)
+
+
+def study_problems(token: str, body: T.Any) -> T.Tuple[T.Any, T.List[str]]:
+    """check everything about a new study that can be checked without
+    uploading it: the body, its metadata against its template, and the
+    columns to change against the header of the sample file, which is
+    all of the sample file that's read
+
+    Args:
+        token: str - the user's Genestack token
+        body: Any - the body of the new study, as it would be POSTed
+
+    Returns:
+        Tuple[Any, List[str]]: the body, with any column preset it names
+            applied (see apply_column_preset), which is what should be
+            queued, and a description of each problem, which is empty
+            if there are none
+
+    Raises:
+        PermissionError: if Genestack rejects the token
+        uploadtogenestack.genestackETL.AuthenticationFailed
+        botocore.exceptions.ClientError: if the sample file can't be
+            read, other than it not being there, or access being denied
+        Exception: from anything else that stops the checks running,
+            such as Genestack or S3 having trouble
+    """
+    body, problems = apply_column_preset(body)
+    if problems:
+        return body, problems
+
+    problems = uploader.validate_body(uploader.JobType.Study, body)
+    if problems:
+        return body, problems
+
+    problems = uploader.sample_columns.shape_problems(body)
+    if problems:
+        return body, problems
+
+    try:
+        problems += uploader.study.metadata_problems(
+            body, template_detail(token, str(body["template"])))
+    except TemplateNotFoundError:
+        problems.append(f"template {body['template']} not found")
+
+    renamed, added, deleted = uploader.sample_columns.complete_columns(
+        body["renamedColumns"], body["addedColumns"], body["deletedColumns"])
+    sample_file = body["Sample File"]
+    if not isinstance(sample_file, str) or not sample_file.strip():
+        if renamed or added or deleted:
+            problems.append("there are columns to change, but no sample file")
+        return body, problems
+
+    key = sample_file.strip().replace(f"s3://{gs_config['genestackbucket']}/", "")
+    try:
+        # the VM only policy refuses our own credentials too,
+        # so the header is read within the public policy window
+        with uploader.s3.S3PublicPolicy(s3_bucket):
+            headers = uploader.sample_columns.split_fields(
+                uploader.s3.read_first_line(gs_config["genestackbucket"], key))
+    except botocore.exceptions.ClientError as err:
+        code = err.response.get("Error", {}).get("Code")
+        if code in ("NoSuchKey", "404"):
+            problems.append(f"sample file {sample_file} not found")
+        elif code == "InvalidRange":
+            problems.append(f"sample file {sample_file} is empty")
+        elif code in ("AccessDenied", "AllAccessDisabled", "403"):
+            problems.append(f"sample file {sample_file} can't be read, access denied")
+        else:
+            raise
+        return body, problems
+    except ValueError as err:
+        problems.append(f"can't read the header of the sample file: {err}")
+        return body, problems
+
+    return body, problems + uploader.sample_columns.problems_with(headers, renamed, added, deleted)
 
 
 @api_blueprint.app_errorhandler(404)
@@ -91,6 +260,29 @@ def _():
     return not_found(EndpointNotFoundError())
 
 
+@api_blueprint.before_request
+def _() -> None:
+    """empty any cache another web worker has emptied"""
+    api_cache.sync_invalidations()
+
+
+@api_blueprint.after_request
+def _(response: flask.Response) -> flask.Response:
+    """count every API request by the endpoint that
+    handled it and the response code"""
+    uploader.metrics.inc(
+        "uploader_http_requests_total",
+        endpoint=flask.request.endpoint or "unknown",
+        code=response.status_code)
+    return response
+
+
+@api_blueprint.after_request
+def _(response: flask.Response) -> flask.Response:
+    """compress large API responses, when the client accepts it"""
+    return compress(response, config.COMPRESS_MIN_BYTES)
+
+
 @api_blueprint.route("", methods=["GET"])
 def api_version() -> Response:
     """
@@ -112,6 +304,7 @@ def _():
 
 
 @api_blueprint.route("/studies", methods=["GET", "POST"])
+@conditional
 def all_studies() -> Response:
     """
         GET for returning all studies
@@ -127,24 +320,93 @@ def all_studies() -> Response:
     # POST Handler #
     # ************ #
     if flask.request.method == "POST":
+        # anything we can tell is wrong now is rejected,
+        # rather than waiting for a job worker to find it
+        try:
+            body, problems = study_problems(token, flask.request.json)
+        except (PermissionError, uploadtogenestack.genestackETL.AuthenticationFailed) as err:
+            logger.error("Request Forbidden")
+            logger.exception(err)
+            return FORBIDDEN
+        except Exception as err:
+            logger.error("couldn't check the new study")
+            logger.exception(err)
+            return internal_server_error(err)
+
+        if problems:
+            logger.error(f"invalid study: {problems}")
+            return bad_request(InvalidStudyError(*problems))
+
         _job = uploader.GenestackUploadJob(
-            uploader.JobType.Study, token, flask.request.json)
+            uploader.JobType.Study, token, body)
         jobs_queue.put(_job)
-        all_jobs[_job.uuid] = _job
 
         return create_response({"jobId": _job.uuid}, 202)
 
     # *********** #
     # GET Handler #
     # *********** #
+    # ?limit= returns a single page, with the cursor to get the next one.
+    # otherwise every study is returned, as one JSON response with an ETag,
+    # or streamed one study per line as Genestack's pages arrive with
+    # ?format=ndjson, keeping memory flat however many studies there are
+    try:
+        try:
+            offset = int(flask.request.args.get("cursor", 0))
+            limit: T.Optional[int] = int(flask.request.args["limit"]) \
+                if "limit" in flask.request.args else None
+        except ValueError:
+            return bad_request(ValueError("cursor and limit must be integers"))
+
+        if offset < 0 or (limit is not None and not 0 < limit <= config.STUDIES_PAGE_SIZE):
+            return bad_request(ValueError(
+                f"cursor must be 0 or more, and limit from 1 to {config.STUDIES_PAGE_SIZE}"))
+
+        logger.info(f"Getting Studies from {offset}")
+        # the first page is got before responding, so errors get the right status code
+        studies, next_offset = upstream.get_studies_page(
+            token, offset, limit or config.STUDIES_PAGE_SIZE)
+
+        if limit is not None:
+            return create_response({
+                "studies": studies,
+                "nextCursor": str(next_offset) if next_offset is not None else None
+            })
+
+        if flask.request.args.get("format") == "ndjson":
+            def stream_ndjson() -> T.Iterator[str]:
+                for study in upstream.stream_studies(token, studies, next_offset):
+                    yield f"{json.dumps(study)}\n"
+
+            return flask.Response(stream_ndjson(), mimetype="application/x-ndjson")
+
+        # the ETag needs the whole body, so this one isn't streamed
+        return create_response(list(upstream.stream_studies(token, studies, next_offset)))
+
+    except (PermissionError, uploadtogenestack.genestackETL.AuthenticationFailed) as err:
+        logger.error("Request Forbidden")
+        logger.exception(err)
+        return FORBIDDEN
+
+    except Exception as err:
+        logger.error("Error")
+        logger.exception(err)
+        return internal_server_error(err)
+
+
+@api_blueprint.route("/studies/validate", methods=["POST"])
+def validate_study() -> Response:
+    """check a new study, as it would be POSTed to /studies,
+    returning every problem found, without queueing it"""
+
+    token: str = flask.request.headers.get("Genestack-API-Token")
+    if not token:
+        logger.error("study validation missing token")
+        return MISSING_TOKEN
+
     try:
-        logger.info("Getting all Studies")
-        gsu = uploadtogenestack.GenestackUtils(
-            token=token, server=config.SERVER_ENDPOINT)
-        # Note: This doesn't take into account pagination
-        # will return max. 2000 results
-        studies = gsu.ApplicationsODM(gsu, None).get_all_studies()
-        return create_response(studies.json()["data"])
+        _, problems = study_problems(token, flask.request.json)
+        return create_response({"valid": not problems, "problems": problems})
 
     except (PermissionError, uploadtogenestack.genestackETL.AuthenticationFailed) as err:
         logger.error("Request Forbidden")
@@ -157,7 +419,47 @@ def all_studies() -> Response:
         return internal_server_error(err)
 
 
+@api_blueprint.route("/studies/search", methods=["GET"])
+@conditional
+def search_studies() -> Response:
+    """
+        GET: search the studies the user can see by accession,
+        title and source, for ?q=, returning the best ?limit= matches
+    """
+
+    token: str = flask.request.headers.get("Genestack-API-Token")
+    if not token:
+        logger.error("study search missing token")
+        return MISSING_TOKEN
+
+    query: str = flask.request.args.get("q", "")
+    try:
+        limit = int(flask.request.args.get("limit", DEFAULT_STUDY_SEARCH_LIMIT))
+    except ValueError as err:
+        return bad_request(err)
+
+    if not 0 < limit <= MAX_STUDY_SEARCH_LIMIT:
+        return bad_request(ValueError(f"limit must be from 1 to {MAX_STUDY_SEARCH_LIMIT}"))
+
+    try:
+        return create_response({
+            "query": query,
+            "studies": upstream.study_index(token).search(query, limit)
+        })
+
+    except (PermissionError, uploadtogenestack.genestackETL.AuthenticationFailed) as err:
+        logger.error("Forbidden")
+        logger.exception(err)
+        return FORBIDDEN
+
+    except Exception as err:
+        logger.error("Error")
+        logger.exception(err)
+        return internal_server_error(err)
+
+
 @api_blueprint.route("/studies/<study_id>", methods=["GET"])
+@conditional
 def single_study(study_id: str) -> Response:
     """
         GET: return information about single study
@@ -171,9 +473,9 @@ def single_study(study_id: str) -> Response:
     study: T.Optional[requests.Response] = None
     try:
         logger.info(f"Getting single study: {study_id}")
-        gsu = uploadtogenestack.GenestackUtils(
-            token=token, server=config.SERVER_ENDPOINT)
-        study = gsu.ApplicationsODM(gsu, None).get_study(study_id.strip())
+        gsu = upstream.clients.get(token).gsu
+        with upstream.timed_call("get_study"):
+            study = gsu.ApplicationsODM(gsu, None).get_study(study_id.strip())
         return create_response(study.json())
 
     except (PermissionError, uploadtogenestack.genestackETL.AuthenticationFailed) as err:
@@ -194,6 +496,7 @@ def single_study(study_id: str) -> Response:
 
 
 @api_blueprint.route("/studies/<study_id>/signals", methods=["GET", "POST"])
+@conditional
 def all_signals(study_id: str) -> Response:
     """
         GET: get all signal datasets for a study
@@ -215,7 +518,6 @@ def all_signals(study_id: str) -> Response:
         _job = uploader.GenestackUploadJob(
             uploader.JobType.Signal, token, flask.request.json, study_id)
         jobs_queue.put(_job)
-        all_jobs[_job.uuid] = _job
 
         return create_response({"jobId": _job.uuid}, 202)
 
@@ -225,10 +527,9 @@ def all_signals(study_id: str) -> Response:
     try:
         logger.info(f"getting info for all signals for study {study_id}")
 
-        gsu = uploadtogenestack.GenestackUtils(
-            token=token, server=config.SERVER_ENDPOINT)
-        signals = [signal for type in ["variant", "expression"]
-                   for signal in gsu.get_signals_by_group(study_id.strip(), type)]
+        # listing the signals is a good time to catch any made outside the uploader
+        index = upstream.signal_index(token, study_id.strip(), refresh=True)
+        signals = [signal for signals in index.values() for signal in signals]
 
         logger.info("got signals OK")
         return create_response({"studyAccession": study_id.strip(), "signals": signals})
@@ -250,6 +551,7 @@ def all_signals(study_id: str) -> Response:
 
 
 @api_blueprint.route("/studies/<study_id>/signals/<signal_id>", methods=["GET"])
+@conditional
 def single_signal(study_id: str, signal_id: str) -> Response:
     """
         GET: get information about single dataset
@@ -262,12 +564,11 @@ def single_signal(study_id: str, signal_id: str) -> Response:
 
     try:
         logger.info(f"getting info for signal {signal_id}")
-        gsu = uploadtogenestack.GenestackUtils(
-            token=token, server=config.SERVER_ENDPOINT)
-
-        signals = [signal for type in ["variant", "expression"]
-                   for signal in gsu.get_signals_by_group(study_id.strip(), type)
-                   if signal["itemId"] == signal_id.strip()]
+        signals = upstream.signal_index(token, study_id.strip()).get(signal_id.strip())
+        if signals is None:
+            # it could have been made since the index was built
+            signals = upstream.signal_index(
+                token, study_id.strip(), refresh=True).get(signal_id.strip(), [])
 
         if len(signals) == 1:
             logger.info("found 1 signal: all good")
@@ -300,6 +601,7 @@ def single_signal(study_id: str, signal_id: str) -> Response:
 
 
 @api_blueprint.route("/templates", methods=["GET"])
+@conditional
 def get_all_templates():
     """
         Gets all the templates from genestack
@@ -312,10 +614,13 @@ def get_all_templates():
 
     try:
         logger.info("getting all templates")
-        gsu = uploadtogenestack.GenestackUtils(
-            token=token, server=config.SERVER_ENDPOINT)
-        template = gsu.ApplicationsODM(gsu, None).get_all_templates()
-        return create_response(template.json()["result"])
+
+        def lookup(gsu: uploadtogenestack.GenestackUtils) -> T.Any:
+            with upstream.timed_call("get_all_templates"):
+                template = gsu.ApplicationsODM(gsu, None).get_all_templates()
+            return template.json()["result"]
+
+        return create_response(upstream.cached_template_lookup(token, ("templates",), lookup))
 
     except (PermissionError, uploadtogenestack.genestackETL.AuthenticationFailed) as err:
         logger.error("Forbidden")
@@ -329,6 +634,7 @@ def get_all_templates():
 
 
 @api_blueprint.route("/templates/<template_id>", methods=["GET"])
+@conditional
 def get_template(template_id: str):
     """
         Gets the details about template <template_id> (accession)
@@ -342,38 +648,18 @@ def get_template(template_id: str):
 
     try:
         logger.info(f"getting single template {template_id}")
-        gsu = uploadtogenestack.GenestackUtils(
-            token=token, server=config.SERVER_ENDPOINT)
-        template = gsu.ApplicationsODM(
-            gsu, None).get_template_detail(template_id.strip())
-
-        if "Failed to found template" in template.text:
-            # OK, here we go
-            # Time for a bit of complaining about the Genestack API
-
-            # What I wanted to do here was:
-            # if template.status_code == 404:
-            # you know, like I should be able to do, as 404 is the status code
-            # for when something isn't found.
-
-            # But Genestack doesn't return a 404 when it can't find the template,
-            # instead it returns "201 Created". **mindblow**
-            # It's not like its even creating the template when it doesn't find it
-
-            # So, here we are. I'm searching for "Failed to found template" in
-            # the response text. Which doesn't even really make sense.
-
-            # ¯\_(ツ)_/¯
-            # Complaining Over.
 
+        try:
+            template = template_detail(token, template_id)
+        except TemplateNotFoundError as template_err:
             logger.error("Template not Found")
-            logger.error(template.json()["error"])
-            return not_found(TemplateNotFoundError(template.json()["error"]))
+            logger.error(template_err)
+            return not_found(template_err)
 
         logger.info(f"template {template_id} found")
         return create_response({
             "accession": template_id.strip(),
-            "template": template.json()["result"]
+            "template": template
         })
 
     except (PermissionError, uploadtogenestack.genestackETL.AuthenticationFailed) as err:
@@ -388,6 +674,7 @@ def get_template(template_id: str):
 
 
 @api_blueprint.route("/templateTypes", methods=["GET"])
+@conditional
 def get_template_types():
     """
         Gets the display names and datatypes for templates
@@ -401,13 +688,15 @@ def get_template_types():
 
     try:
         logger.info("getting template types")
-        gsu = uploadtogenestack.GenestackUtils(
-            token=token, server=config.SERVER_ENDPOINT
-        )
-        types = gsu.ApplicationsODM(gsu, None).get_template_types()
 
+        def lookup(gsu: uploadtogenestack.GenestackUtils) -> T.Any:
+            with upstream.timed_call("get_template_types"):
+                types = gsu.ApplicationsODM(gsu, None).get_template_types()
+            return types.json()["result"]
+
+        types = upstream.cached_template_lookup(token, ("templateTypes",), lookup)
         logger.info("happily got template types")
-        return create_response(types.json()["result"])
+        return create_response(types)
 
     except (PermissionError, uploadtogenestack.genestackETL.AuthenticationFailed) as err:
         logger.error("Forbidden")
@@ -420,20 +709,56 @@ def get_template_types():
         return internal_server_error(err)
 
 
-@api_blueprint.route("/jobs/<job_uuid>", methods=["GET"])
-def get_job(job_uuid: str):
-    """return the status of the job with uuid job_uuid
+@api_blueprint.route("/metrics", methods=["GET"])
+def get_metrics():
+    """return the metrics gathered from the API and
+    all the job workers in the Prometheus text format"""
+    return flask.Response(
+        uploader.metrics.render() + api_cache.render_metrics() +
+        upstream.clients.render_metrics(),
+        mimetype="text/plain; version=0.0.4"
+    )
 
-    as it's finding the job, it'll also clear out any
-    expired jobs
 
-    if it doesn't find the job, it'll raise not_found
-    with a JobIDNotFound error
+@api_blueprint.route("/cache", methods=["GET", "DELETE"])
+def api_caches():
+    """
+        GET: how well each of the API's in-memory caches is doing,
+            in the web worker that answers
+        DELETE: empty the caches, or just the one in ?name=, so
+            changes made in Genestack are seen straight away. every
+            web worker empties its own within a second
     """
-    global all_jobs  # pylint: disable=global-statement,invalid-name
-    all_jobs = {k: v for k, v in all_jobs.items() if not v.expired}
+
+    token: str = flask.request.headers.get("Genestack-API-Token")
+    if not token:
+        logger.error("caches request without token")
+        return MISSING_TOKEN
+
     try:
-        _job = all_jobs[uuid.UUID(job_uuid)]
-        return create_response(_job.json)
-    except (KeyError, ValueError) as err:
-        return not_found(JobIDNotFound(*err.args))
+        upstream.check_token(token)
+
+        if flask.request.method == "DELETE":
+            name: T.Optional[str] = flask.request.args.get("name")
+            if name is not None and name not in api_cache.caches:
+                return bad_request(ValueError(
+                    f"name must be one of {', '.join(api_cache.caches)}"))
+
+            for cache_name in api_cache.caches:
+                if name in (None, cache_name):
+                    logger.info(f"emptying the {cache_name} cache")
+                    api_cache.invalidate(cache_name)
+
+        return create_response({
+            cache_name: cache.stats for cache_name, cache in api_cache.caches.items()
+        })
+
+    except (PermissionError, uploadtogenestack.genestackETL.AuthenticationFailed) as err:
+        logger.error("Forbidden")
+        logger.exception(err)
+        return FORBIDDEN
+
+    except Exception as err:
+        logger.error("Error")
+        logger.exception(err)
+        return internal_server_error(err)
@@ -0,0 +1,233 @@
+"""
+Genestack Uploader
+A HTTP server providing an API and a frontend for easy uploading to Genestack
+
+Copyright (C) 2022 Genome Research Limited
+
+Author: Michael Grace <mg38@sanger.ac.uk>
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+from collections import OrderedDict
+import hashlib
+import threading
+import time
+import typing as T
+
+import config
+from uploader import job_store
+
+# returned by TTLCache.get when there's nothing cached,
+# as None could be a cached value
+MISSING: T.Any = object()
+
+
+class TTLCache:
+    """
+        An in-memory cache, where each value expires ttl
+        seconds after it was set, and the least recently
+        used value is dropped when there's more than
+        max_size of them
+
+        It's safe to use from the request handling threads
+        at the same time
+    """
+
+    def __init__(self, ttl: float, max_size: int) -> None:
+        self.ttl = ttl
+        self.max_size = max_size
+        self.hits: int = 0
+        self.misses: int = 0
+        self._data: "OrderedDict[T.Hashable, T.Tuple[float, T.Any]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: T.Hashable) -> T.Any:
+        """get the value for key, if it's cached and not expired
+
+        Args:
+            key: Hashable
+
+        Returns:
+            Any: the value, or MISSING if there isn't one
+        """
+        with self._lock:
+            try:
+                expires, value = self._data[key]
+            except KeyError:
+                self.misses += 1
+                return MISSING
+
+            if expires < time.monotonic():
+                del self._data[key]
+                self.misses += 1
+                return MISSING
+
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key: T.Hashable, value: T.Any) -> None:
+        """cache value for key for the next ttl seconds
+
+        Args:
+            key: Hashable
+            value: Any
+        """
+        with self._lock:
+            self._data[key] = (time.monotonic() + self.ttl, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+
+    def invalidate(self, key: T.Optional[T.Hashable] = None) -> None:
+        """remove key from the cache, or everything
+        if key isn't given
+
+        Args:
+            key: Optional[Hashable]
+        """
+        with self._lock:
+            if key is None:
+                self._data.clear()
+            else:
+                self._data.pop(key, None)
+
+    @property
+    def stats(self) -> T.Dict[str, T.Any]:
+        """how well the cache is doing
+
+        Returns:
+            Dict[str, Any]: for example
+                {"hits": 9, "misses": 1, "hitRatio": 0.9,
+                 "size": 1, "maxSize": 256, "ttl": 3600}
+        """
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hitRatio": self.hits / lookups if lookups else None,
+                "size": len(self._data),
+                "maxSize": self.max_size,
+                "ttl": self.ttl
+            }
+
+
+def hash_token(token: str) -> str:
+    """hash a Genestack token, so we can key
+    things on it without keeping the token itself
+
+    Args:
+        token: str
+
+    Returns:
+        str: the hex SHA-256 of the token
+    """
+    return hashlib.sha256(token.encode()).hexdigest()
+
+
+# templates and template types, keyed by Genestack server and
+# what's being looked up. these are the same for every user
+templates = TTLCache(config.TEMPLATE_CACHE_TTL_SECONDS, config.TEMPLATE_CACHE_SIZE)
+
+# hashed tokens that Genestack has accepted recently, so we
+# don't have to check them again on every cached lookup
+valid_tokens = TTLCache(config.TOKEN_CHECK_TTL_SECONDS, 1024)
+
+# the Genestack user each hashed token belongs to, so things
+# saved by a user are still theirs after they change their token
+token_users = TTLCache(config.TOKEN_CHECK_TTL_SECONDS, 1024)
+
+# each study's signals by itemId, keyed by Genestack server, hashed
+# token and study, as what a user can see depends on their token
+signal_indexes = TTLCache(config.SIGNAL_INDEX_TTL_SECONDS, config.SIGNAL_INDEX_SIZE)
+
+# each user's studies, indexed for searching, keyed by Genestack
+# server and hashed token, as what a user can see depends on their token
+study_indexes = TTLCache(config.STUDY_INDEX_TTL_SECONDS, config.STUDY_INDEX_SIZE)
+
+caches: T.Dict[str, TTLCache] = {
+    "templates": templates,
+    "tokens": valid_tokens,
+    "users": token_users,
+    "signals": signal_indexes,
+    "studies": study_indexes
+}
+
+
+# Each web worker has its own caches, so emptying them is recorded in the
+# job store, as a generation for each cache, which every worker checks
+# at most this often, emptying its own copy if it's behind
+_INVALIDATION_CHECK_SECONDS: float = 1
+
+_generations: T.Dict[str, int] = {}
+_generations_checked: float = 0
+_generations_lock = threading.Lock()
+
+
+def invalidate(name: str) -> None:
+    """empty the cache called name in every web worker,
+    this one straight away, and the others when they
+    next check (see sync_invalidations)
+
+    Args:
+        name: str - one of the names in caches
+    """
+    generation = job_store.bump_cache_generation(name)
+    with _generations_lock:
+        caches[name].invalidate()
+        _generations[name] = generation
+
+
+def sync_invalidations() -> None:
+    """empty any of this worker's caches that another worker has
+    emptied since it last checked, unless it checked less than
+    _INVALIDATION_CHECK_SECONDS ago, or another thread is checking"""
+    global _generations_checked  # pylint: disable=global-statement
+    if time.monotonic() - _generations_checked < _INVALIDATION_CHECK_SECONDS \
+            or not _generations_lock.acquire(blocking=False):
+        return
+    try:
+        _generations_checked = time.monotonic()
+        for name, generation in job_store.get_cache_generations().items():
+            if name in caches and _generations.get(name) != generation:
+                caches[name].invalidate()
+                _generations[name] = generation
+    finally:
+        _generations_lock.release()
+
+
+def render_metrics() -> str:
+    """render the hits, misses and size of each cache in
+    the Prometheus text format, to go with uploader.metrics
+
+    Returns:
+        str: the text exposition, for example
+            uploader_api_cache_hits_total{cache="templates"} 9
+    """
+    lines: T.List[str] = []
+    for name, metric_type, metric_help, stat in [
+        ("uploader_api_cache_hits_total", "counter",
+         "Lookups found in the API's in-memory caches, by cache", "hits"),
+        ("uploader_api_cache_misses_total", "counter",
+         "Lookups not found in the API's in-memory caches, by cache", "misses"),
+        ("uploader_api_cache_entries", "gauge",
+         "Entries in the API's in-memory caches, by cache", "size"),
+    ]:
+        lines += [f"# HELP {name} {metric_help}", f"# TYPE {name} {metric_type}"]
+        lines += [f'{name}{{cache="{cache}"}} {float(cache_obj.stats[stat])!r}'
+                  for cache, cache_obj in caches.items()]
+
+    return "\n".join(lines) + "\n"
@@ -0,0 +1,394 @@
+"""
+Genestack Uploader
+A HTTP server providing an API and a frontend for easy uploading to Genestack
+
+Copyright (C) 2021, 2022 Genome Research Limited
+
+Author: Michael Grace <mg38@sanger.ac.uk>
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+The API's endpoints for following and querying upload jobs,
+submitting them in batches, and the job workers running them
+"""
+
+import contextlib
+import datetime
+import json
+import logging
+import math
+import time
+import typing as T
+import uuid
+
+import flask
+import uploadtogenestack
+
+import api
+from api_utils import *  # pylint: disable=wildcard-import
+import config
+import uploader
+import upstream
+
+# registered under the API's blueprint in app.py
+jobs_blueprint = flask.Blueprint("jobs", "api_jobs")
+
+logger = logging.getLogger("API")
+logger.setLevel(config.LOG_LEVEL)
+
+# the longest a client can ask to wait on a job's status to change,
+# and how often a job's event stream sends a keepalive while it waits
+MAX_JOB_WAIT_SECONDS: float = 60
+MAX_JOBS_QUERY_LIMIT: int = 10000
+JOB_EVENTS_KEEPALIVE_SECONDS: float = 15
+# the longest a job's event stream stays open. the browser's EventSource
+# connects again by itself, so a client that's gone can't hold one forever
+JOB_EVENTS_MAX_SECONDS: float = 300
+
+_finished_statuses: T.Set[str] = {x.value for x in uploader.common.FINISHED_STATUSES}
+
+
+@jobs_blueprint.route("/jobs", methods=["GET", "POST"])
+def get_jobs():
+    """return the status of many jobs at once
+
+    the jobs can be filtered with
+        - ids: the job IDs to return, comma separated in GET,
+            or a list in the POST body
+        - status: QUEUED, RUNNING, COMPLETED or FAILED
+        - type: study or signal
+        - since: ISO 8601 time, only jobs submitted since then
+        - limit: the most jobs to return, newest first
+            (default 1000, from 1 to MAX_JOBS_QUERY_LIMIT)
+
+    for GET these are query parameters, for POST they're keys in
+    the JSON body, which is useful when there are a lot of IDs.
+    jobs that can't be found (or have expired) are left out
+
+    without ids, this lists everyone's jobs, so needs a token
+    Genestack accepts. with them, the IDs are enough, as for /jobs/<uuid>
+    """
+    params: T.Dict[str, T.Any]
+    if flask.request.method == "POST":
+        params = flask.request.json
+        if not isinstance(params, dict):
+            return bad_request(ValueError("body must be a JSON object"))
+    else:
+        params = dict(flask.request.args)
+        if "ids" in params:
+            params["ids"] = [x for x in params["ids"].split(",") if x]
+
+    try:
+        job_uuids: T.Optional[T.List[str]] = None
+        if params.get("ids") is not None:
+            if not isinstance(params["ids"], list):
+                raise ValueError("ids must be a list")
+            job_uuids = [str(uuid.UUID(x.strip())) for x in params["ids"]]
+
+        status: T.Optional[str] = params.get("status")
+        if status is not None and status not in {x.value for x in uploader.common.JobStatus}:
+            raise ValueError(f"invalid status: {status}")
+
+        job_type: T.Optional[str] = params.get("type")
+        if job_type is not None and job_type not in uploader.job_types:
+            raise ValueError(f"invalid type: {job_type}")
+
+        since: T.Optional[datetime.datetime] = None
+        if params.get("since"):
+            since = datetime.datetime.fromisoformat(params["since"])
+
+        limit = int(params.get("limit", 1000))
+        if not 0 < limit <= MAX_JOBS_QUERY_LIMIT:
+            raise ValueError(f"limit must be from 1 to {MAX_JOBS_QUERY_LIMIT}")
+
+    except (ValueError, TypeError, AttributeError) as err:
+        return bad_request(err)
+
+    if job_uuids is None:
+        token: str = flask.request.headers.get("Genestack-API-Token")
+        if not token:
+            logger.error("request for all jobs without token")
+            return MISSING_TOKEN
+
+        try:
+            upstream.check_token(token)
+
+        except (PermissionError, uploadtogenestack.genestackETL.AuthenticationFailed) as err:
+            logger.error("Forbidden")
+            logger.exception(err)
+            return FORBIDDEN
+
+        except Exception as err:
+            logger.error("Error")
+            logger.exception(err)
+            return internal_server_error(err)
+
+    return create_response(
+        uploader.job_store.find_jobs(job_uuids, status, job_type, since, limit))
+
+
+def job_wait_seconds(wait: str) -> float:
+    """read the `wait` of a long-poll, capped at MAX_JOB_WAIT_SECONDS
+
+    Raises:
+        ValueError: if it isn't a number, or is negative, infinite or nan,
+            which would never reach the deadline
+    """
+    seconds = float(wait)
+    if not math.isfinite(seconds) or seconds < 0:
+        raise ValueError(f"wait must be a number of seconds, from 0 to {MAX_JOB_WAIT_SECONDS}")
+    return min(seconds, MAX_JOB_WAIT_SECONDS)
+
+
+@jobs_blueprint.route("/jobs/<job_uuid>", methods=["GET"])
+def get_job(job_uuid: str):
+    """return the status of the job with uuid job_uuid
+
+    expired jobs are cleared out of the job store
+    in the background by the expiry sweeper
+
+    to long-poll, pass `wait` as the most seconds to wait
+    for the job's status to change from `status` (or from
+    its current status, if `status` isn't given) before
+    returning. if the status already differs, it returns
+    straight away
+
+    if it doesn't find the job, it'll raise not_found
+    with a JobIDNotFound error
+    """
+    try:
+        job_uuid = str(uuid.UUID(job_uuid))
+    except ValueError as err:
+        return not_found(JobIDNotFound(*err.args))
+
+    _job = uploader.job_store.get_job(job_uuid)
+    if _job is None:
+        return not_found(JobIDNotFound(job_uuid))
+
+    if "wait" in flask.request.args:
+        try:
+            wait = job_wait_seconds(flask.request.args["wait"])
+        except ValueError as err:
+            return bad_request(err)
+
+        known_status: str = flask.request.args.get("status", _job["status"])
+        if known_status == _job["status"] and known_status not in _finished_statuses:
+            _job = uploader.job_store.wait_for_job(job_uuid, known_status, wait)
+            if _job is None:
+                return not_found(JobIDNotFound(job_uuid))
+
+    return create_response(_job)
+
+
+# SSE comment lines keep proxies from closing the idle connection
+JOB_EVENTS_KEEPALIVE: str = ": keepalive\n\n"
+
+
+def job_status_event(_job: T.Dict[str, T.Any]) -> str:
+    """the Server-Sent Event for a job's status, as
+    from uploader.job_store.get_job"""
+    return f"event: status\ndata: {json.dumps(create_response(_job)[0])}\n\n"
+
+
+@jobs_blueprint.route("/jobs/<job_uuid>/events", methods=["GET"])
+def get_job_events(job_uuid: str):
+    """stream the status of the job with uuid job_uuid
+    as Server-Sent Events
+
+    an event is sent with the job's current status, then
+    another each time the status changes, in the same
+    format as GET /jobs/<uuid>. the stream ends once the
+    job has finished, or after JOB_EVENTS_MAX_SECONDS, when
+    the client connects again for the rest
+
+    when run as the ASGI app (see asgi.py), this is served
+    on the event loop instead, with the same events
+
+    if it doesn't find the job, it'll raise not_found
+    with a JobIDNotFound error
+    """
+    try:
+        job_uuid = str(uuid.UUID(job_uuid))
+    except ValueError as err:
+        return not_found(JobIDNotFound(*err.args))
+
+    _job = uploader.job_store.get_job(job_uuid)
+    if _job is None:
+        return not_found(JobIDNotFound(job_uuid))
+
+    def _events(_job: T.Optional[T.Dict[str, T.Any]]) -> T.Iterator[str]:
+        deadline = time.monotonic() + JOB_EVENTS_MAX_SECONDS
+        sent_status: T.Optional[str] = None
+        while _job is not None:
+            if _job["status"] == sent_status:
+                yield JOB_EVENTS_KEEPALIVE
+            else:
+                sent_status = _job["status"]
+                yield job_status_event(_job)
+
+            if sent_status in _finished_statuses or time.monotonic() >= deadline:
+                return
+
+            _job = uploader.job_store.wait_for_job(
+                job_uuid, sent_status,
+                min(JOB_EVENTS_KEEPALIVE_SECONDS, deadline - time.monotonic()))
+
+    return flask.Response(
+        _events(_job),
+        mimetype="text/event-stream",
+        headers={
+            "Cache-Control": "no-cache",
+            # stop nginx buffering the stream
+            "X-Accel-Buffering": "no"
+        }
+    )
+
+
+@jobs_blueprint.route("/jobs/batch", methods=["POST"])
+def submit_batch():
+    """submit many study and/or signal jobs at once
+
+    the body is a list of job specs, each of which is
+    {"type": "study", "body": {...}} or
+    {"type": "signal", "studyAccession": "...", "body": {...}}
+    where each body is what would be POSTed to create that
+    study or signal on its own
+
+    every spec is checked before any are queued. if any are
+    invalid, nothing is queued and every problem is returned
+    """
+
+    token: str = flask.request.headers.get("Genestack-API-Token")
+    if not token:
+        logger.error("batch submission missing token")
+        return MISSING_TOKEN
+
+    specs: T.Any = flask.request.json
+    if not isinstance(specs, list) or not specs:
+        return bad_request(InvalidBatchError("body must be a non-empty list of jobs"))
+
+    problems: T.List[str] = []
+    _jobs: T.List[uploader.GenestackUploadJob] = []
+    # checking a study reads its sample file's header within the S3 public
+    # policy window, so it's opened once for all of them, not for each
+    window: T.ContextManager[T.Any] = uploader.s3.S3PublicPolicy(api.s3_bucket) \
+        if any(isinstance(spec, dict) and spec.get("type") == "study" for spec in specs) \
+        else contextlib.nullcontext()
+    try:
+        with window:
+            for idx, spec in enumerate(specs):
+                if not isinstance(spec, dict) or spec.get("type") not in uploader.job_types:
+                    problems.append(f"job {idx}: type must be one of {list(uploader.job_types)}")
+                    continue
+
+                job_type = uploader.job_types[spec["type"]]
+                body: T.Any = spec.get("body")
+                study_id: T.Optional[str] = None
+                if job_type == uploader.JobType.Signal:
+                    study_id = spec.get("studyAccession")
+                    if not isinstance(study_id, str) or not study_id.strip():
+                        problems.append(f"job {idx}: missing studyAccession")
+
+                if job_type == uploader.JobType.Study:
+                    # the same checks as POSTing the study on its own
+                    body, spec_problems = api.study_problems(token, body)
+                else:
+                    spec_problems = uploader.validate_body(job_type, body)
+                problems += [f"job {idx}: {x}" for x in spec_problems]
+
+                if not problems:
+                    _jobs.append(uploader.GenestackUploadJob(
+                        job_type, token, body, study_id, save=False))
+
+    except (PermissionError, uploadtogenestack.genestackETL.AuthenticationFailed) as err:
+        logger.error("Request Forbidden")
+        logger.exception(err)
+        return FORBIDDEN
+
+    except Exception as err:
+        logger.error("couldn't check the batch submission")
+        logger.exception(err)
+        return internal_server_error(err)
+
+    if problems:
+        logger.error(f"invalid batch submission: {problems}")
+        return bad_request(InvalidBatchError(*problems))
+
+    batch_id = uuid.uuid4()
+    uploader.GenestackUploadJob.save_batch(batch_id, _jobs)
+    for _job in _jobs:
+        api.jobs_queue.put(_job)
+
+    logger.info(f"submitted batch {batch_id} of {len(_jobs)} job(s)")
+    return create_response({
+        "batchId": batch_id,
+        "jobIds": [_job.uuid for _job in _jobs]
+    }, 202)
+
+
+@jobs_blueprint.route("/batches/<batch_id>", methods=["GET"])
+def get_batch(batch_id: str):
+    """return the combined progress of the jobs
+    submitted together in batch batch_id
+
+    if it doesn't find the batch, it'll raise not_found
+    with a BatchIDNotFound error
+    """
+    try:
+        batch_id = str(uuid.UUID(batch_id))
+    except ValueError as err:
+        return not_found(BatchIDNotFound(*err.args))
+
+    _jobs = uploader.job_store.get_batch(batch_id)
+    if not _jobs:
+        return not_found(BatchIDNotFound(batch_id))
+
+    counts: T.Dict[str, int] = {x.value: 0 for x in uploader.common.JobStatus}
+    for _job in _jobs:
+        counts[_job["status"]] += 1
+
+    finished = sum(counts[x] for x in _finished_statuses)
+    return create_response({
+        "batchId": batch_id,
+        "total": len(_jobs),
+        "counts": counts,
+        "finished": finished == len(_jobs),
+        "jobs": _jobs
+    })
+
+
+@jobs_blueprint.route("/workers", methods=["GET"])
+def get_workers():
+    """return the state of each of the job workers
+    in the pool, whether it's idle or busy and which
+    job it's running"""
+
+    token: str = flask.request.headers.get("Genestack-API-Token")
+    if not token:
+        logger.error("request for workers without token")
+        return MISSING_TOKEN
+
+    try:
+        upstream.check_token(token)
+        return create_response(uploader.worker_states())
+
+    except (PermissionError, uploadtogenestack.genestackETL.AuthenticationFailed) as err:
+        logger.error("Forbidden")
+        logger.exception(err)
+        return FORBIDDEN
+
+    except Exception as err:
+        logger.error("Error")
+        logger.exception(err)
+        return internal_server_error(err)
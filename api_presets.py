@@ -0,0 +1,172 @@
+"""
+Genestack Uploader
+A HTTP server providing an API and a frontend for easy uploading to Genestack
+
+Copyright (C) 2021, 2022 Genome Research Limited
+
+Author: Michael Grace <mg38@sanger.ac.uk>
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+The API's endpoints for the column presets of each template, and
+applying a preset to a new study
+"""
+
+import logging
+import typing as T
+
+import flask
+import uploadtogenestack
+
+from api_utils import *  # pylint: disable=wildcard-import
+import config
+import uploader
+import uploader.column_presets
+import upstream
+
+# registered under the API's blueprint in app.py
+presets_blueprint = flask.Blueprint("presets", "api_presets")
+
+logger = logging.getLogger("API")
+logger.setLevel(config.LOG_LEVEL)
+
+
+def apply_column_preset(body: T.Any) -> T.Tuple[T.Any, T.List[str]]:
+    """if a new study names a columnPreset of its template, put the
+    preset's columns to rename, add and delete before any of its own.
+    this is done before the study is queued, so changing the
+    preset afterwards doesn't change the study
+
+    Args:
+        body: Any - the body of the new study, which isn't changed
+
+    Returns:
+        Tuple[Any, List[str]]: a copy of the body with the preset's
+            columns, and without columnPreset, and a description
+            of each problem, which is empty if there are none
+    """
+    if not isinstance(body, dict) or "columnPreset" not in body:
+        return body, []
+
+    body = dict(body)
+    name = str(body.pop("columnPreset")).strip()
+    template = str(body.get("template", "")).strip()
+    preset = uploader.column_presets.get_preset(template, name)
+    if preset is None:
+        return body, [f"template {template} has no column preset {name}"]
+
+    for key in uploader.sample_columns.COLUMN_KEYS:
+        own = body.get(key, [])
+        body[key] = preset[key] + own if isinstance(own, list) else own
+    return body, []
+
+
+@presets_blueprint.route("/templates/<template_id>/columnPresets", methods=["GET"])
+@conditional
+def get_column_presets(template_id: str):
+    """
+        Gets the saved column presets for template <template_id>,
+        the columns to rename, add and delete in a sample file
+    """
+
+    token: str = flask.request.headers.get("Genestack-API-Token")
+    if not token:
+        logger.error("request for column presets without token")
+        return MISSING_TOKEN
+
+    try:
+        upstream.check_token(token)
+        return create_response(uploader.column_presets.get_presets(template_id.strip()))
+
+    except (PermissionError, uploadtogenestack.genestackETL.AuthenticationFailed) as err:
+        logger.error("Forbidden")
+        logger.exception(err)
+        return FORBIDDEN
+
+    except Exception as err:
+        logger.error("Error")
+        logger.exception(err)
+        return internal_server_error(err)
+
+
+@presets_blueprint.route(
+    "/templates/<template_id>/columnPresets/<name>", methods=["GET", "PUT", "DELETE"])
+@conditional
+def column_preset(template_id: str, name: str):
+    """
+        GET for a saved column preset
+        PUT for saving one, replacing any of the same name
+        DELETE for removing one
+
+        a preset can only be replaced or removed by
+        the Genestack user who saved it, with any of their tokens
+    """
+
+    token: str = flask.request.headers.get("Genestack-API-Token")
+    if not token:
+        logger.error("column preset request without token")
+        return MISSING_TOKEN
+
+    template_id, name = template_id.strip(), name.strip()
+    owner: T.Optional[str] = None
+    try:
+        upstream.check_token(token)
+
+        # *********** #
+        # PUT Handler #
+        # *********** #
+        if flask.request.method == "PUT":
+            columns: T.Any = flask.request.json
+            if not isinstance(columns, dict):
+                return bad_request(InvalidColumnPresetError("body must be a JSON object"))
+
+            problems = uploader.sample_columns.shape_problems(columns)
+            if problems:
+                return bad_request(InvalidColumnPresetError(*problems))
+
+            owner = upstream.current_user(token)
+            uploader.column_presets.save_preset(template_id, name, owner, {
+                key: columns.get(key, []) for key in uploader.sample_columns.COLUMN_KEYS})
+            logger.info(
+                f"saved column preset {name} for template {template_id}, by {owner}")
+
+        # ************** #
+        # DELETE Handler #
+        # ************** #
+        elif flask.request.method == "DELETE":
+            owner = upstream.current_user(token)
+            if not uploader.column_presets.delete_preset(template_id, name, owner):
+                return not_found(ColumnPresetNotFoundError(template_id, name))
+            logger.info(
+                f"deleted column preset {name} for template {template_id}, by {owner}")
+            return create_response({"deleted": name})
+
+        preset = uploader.column_presets.get_preset(template_id, name)
+        if preset is None:
+            return not_found(ColumnPresetNotFoundError(template_id, name))
+        return create_response(preset)
+
+    except uploader.column_presets.NotPresetOwnerError as err:
+        logger.error(f"column preset {name} for template {template_id} not owned by {owner}")
+        return forbidden(err)
+
+    except (PermissionError, uploadtogenestack.genestackETL.AuthenticationFailed) as err:
+        logger.error("Forbidden")
+        logger.exception(err)
+        return FORBIDDEN
+
+    except Exception as err:
+        logger.error("Error")
+        logger.exception(err)
+        return internal_server_error(err)
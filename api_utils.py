@@ -20,7 +20,24 @@ You should have received a copy of the GNU General Public License
 along with this program.  If not, see <https://www.gnu.org/licenses/>.
 """
 
+import functools
+import gzip
 import typing as T
+import zlib
+
+import brotli
+import flask
+
+# what `from api_utils import *` gives the API modules
+__all__ = [
+    "Response", "create_response", "conditional", "compress",
+    "MISSING_TOKEN", "FORBIDDEN",
+    "internal_server_error", "bad_request", "forbidden", "not_found",
+    "EndpointNotFoundError", "SignalNotFoundError", "MultipleSignalsFoundError",
+    "TemplateNotFoundError", "StudyNotFoundError", "ColumnPresetNotFoundError",
+    "InvalidColumnPresetError", "InvalidStudyError", "InvalidBatchError",
+    "BatchIDNotFound", "JobIDNotFound"
+]
 
 Response = T.Tuple[T.Dict[str, T.Any], int]
 
@@ -44,6 +61,101 @@ def create_response(data: T.Any, code: int = 200) -> Response:
     }, code
 
 
+def conditional(handler: T.Callable[..., T.Any]) -> T.Callable[..., flask.Response]:
+    """
+    Decorator for GET handlers, giving OK responses an ETag of their
+    content, so a client sending it back in If-None-Match gets a
+    304 Not Modified, without the body, if the content is the same
+
+    Only GET and HEAD requests are made conditional, so a handler can
+    take other methods too. Streamed responses are left alone, as the
+    ETag would need the whole body before sending any of it
+    """
+    @functools.wraps(handler)
+    def wrapper(*args: T.Any, **kwargs: T.Any) -> flask.Response:
+        response = flask.make_response(handler(*args, **kwargs))
+        if flask.request.method in ("GET", "HEAD") \
+                and response.status_code == 200 and not response.is_streamed:
+            response.add_etag()
+            # responses depend on the token, so shouldn't be shared,
+            # and should be checked with us before they're used again
+            response.headers["Cache-Control"] = "private, no-cache"
+            response.vary.add("Genestack-API-Token")
+            response.make_conditional(flask.request)
+        return response
+
+    return wrapper
+
+
+def _compress_stream(chunks: T.Iterable[T.Union[str, bytes]], encoding: str) -> T.Iterator[bytes]:
+    """compress a streamed body as it's sent,
+    flushing after each chunk so it isn't held back"""
+    if encoding == "br":
+        compressor = brotli.Compressor(quality=5)
+        for chunk in chunks:
+            yield compressor.process(chunk.encode() if isinstance(chunk, str) else chunk)
+            yield compressor.flush()
+        yield compressor.finish()
+    else:
+        # wbits of 16 + MAX_WBITS gives a gzip header and trailer
+        compressobj = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        for chunk in chunks:
+            yield compressobj.compress(chunk.encode() if isinstance(chunk, str) else chunk)
+            yield compressobj.flush(zlib.Z_SYNC_FLUSH)
+        yield compressobj.flush()
+
+
+def compress(response: flask.Response, min_size: int) -> flask.Response:
+    """
+    Compresses a response's body with brotli or gzip, whichever the
+    client accepts, preferring brotli
+
+    Bodies smaller than min_size bytes aren't worth compressing.
+    Streamed bodies are compressed as they're sent, apart from
+    event streams, where a client is waiting on each event
+
+    Params:
+        - response: the response to compress
+        - min_size: the smallest body, in bytes, worth compressing
+
+    Returns:
+        - flask.Response: the same response, compressed if it could be
+    """
+    response.vary.add("Accept-Encoding")
+    if (
+        response.direct_passthrough
+        or "Content-Encoding" in response.headers
+        or response.mimetype == "text/event-stream"
+        or (not response.is_streamed and (response.content_length or 0) < min_size)
+    ):
+        return response
+
+    accepted = flask.request.accept_encodings
+    if accepted["br"]:
+        encoding = "br"
+    elif accepted["gzip"]:
+        encoding = "gzip"
+    else:
+        return response
+
+    if response.is_streamed:
+        response.response = _compress_stream(response.response, encoding)
+        response.headers.pop("Content-Length", None)
+    elif encoding == "br":
+        response.set_data(brotli.compress(response.get_data(), quality=5))
+    else:
+        response.set_data(gzip.compress(response.get_data(), compresslevel=6))
+
+    response.headers["Content-Encoding"] = encoding
+    # the compressed body is a different representation,
+    # but If-None-Match is a weak comparison, so the same
+    # ETag still matches the uncompressed one
+    etag, weak = response.get_etag()
+    if etag and not weak:
+        response.set_etag(etag, weak=True)
+    return response
+
+
 MISSING_TOKEN = create_response({"error": "missing token"}, 401)
 FORBIDDEN = create_response({"error": "forbidden"}, 403)
 
@@ -60,6 +172,28 @@ def internal_server_error(err: Exception):
     }, 500)
 
 
+def bad_request(err: Exception) -> Response:
+    """
+        400 Bad Request Response
+    """
+    return create_response({
+        "error": "bad request",
+        "name": err.__class__.__name__,
+        "detail": err.args
+    }, 400)
+
+
+def forbidden(err: Exception) -> Response:
+    """
+        403 Forbidden Response, saying why
+    """
+    return create_response({
+        "error": "forbidden",
+        "name": err.__class__.__name__,
+        "detail": err.args
+    }, 403)
+
+
 def not_found(err: Exception) -> Response:
     """
         404 Not Found Response
@@ -99,6 +233,36 @@ class StudyNotFoundError(Exception):
     """When a study isn't found"""
 
 
+class ColumnPresetNotFoundError(Exception):
+    """When a template has no column preset of that name"""
+
+
+class InvalidColumnPresetError(ValueError):
+    """When a column preset isn't the right shape.
+    The args are the problems found"""
+
+
+class InvalidStudyError(ValueError):
+    """When a new study can't be uploaded as it is.
+    The args are the problems found"""
+
+
+class InvalidBatchError(ValueError):
+    """When any of the jobs in a batch submission
+    are invalid. The args are the problems found"""
+
+
+class BatchIDNotFound(KeyError):
+    """when a batch ID isn't found.
+    this could be because all its jobs expired"""
+
+    def __init__(self, *args: object) -> None:
+        super().__init__(
+            "Batch ID not found. All its jobs may have expired",
+            *args
+        )
+
+
 class JobIDNotFound(KeyError):
     """when a job ID isn't found.
     this could be because it expired"""
@@ -21,26 +21,75 @@ along with this program.  If not, see <https://www.gnu.org/licenses/>.
 """
 
 import logging
+import mimetypes
 from multiprocessing import freeze_support
+import os
 import flask
 from flask_swagger_ui import get_swaggerui_blueprint
-from api import api_blueprint, start_multiproc
+from werkzeug.security import safe_join
+from api import api_blueprint, start_expiry_sweeper, start_multiproc
+from api_jobs import jobs_blueprint
+from api_presets import presets_blueprint
 import config
 
 # We're going to make our Flask app, using the root as the path to static files
 # and frontend/out as the location of our static files.
 # frontend/out is where the next js frontend gets built to.
 # We also need to register our api_blueprint (defined in api.py) to every
-# path starting with /api.
+# path starting with /api. The jobs and column preset endpoints are in their
+# own blueprints (api_jobs.py and api_presets.py), nested under it, so they
+# get the same request metrics and compression.
 app = flask.Flask(__name__, static_url_path="", static_folder="frontend/out")
+api_blueprint.register_blueprint(jobs_blueprint)
+api_blueprint.register_blueprint(presets_blueprint)
 app.register_blueprint(api_blueprint, url_prefix="/api")
 
 logging.basicConfig()
 
+# next js puts a hash of their content in the names of the files
+# under _next/static, so they never change and can be kept for a year.
+# anything else, like the pages, has to be checked with us first
+HASHED_ASSETS_PATH = "_next/static/"
+HASHED_ASSETS_CACHE_CONTROL = "public, max-age=31536000, immutable"
+
+
+def send_static(directory: str, filename: str) -> flask.Response:
+    """
+    Sends a file from the frontend. The Docker build makes a brotli
+    (.br) and gzip (.gz) copy of each text file, so if the client
+    accepts either, we send that instead
+    """
+    accepted = flask.request.accept_encodings
+    response = None
+    for encoding, suffix in (("br", ".br"), ("gzip", ".gz")):
+        compressed = safe_join(directory, filename + suffix)
+        if accepted[encoding] and compressed and os.path.isfile(
+                os.path.join(app.root_path, compressed)):
+            response = flask.send_from_directory(
+                directory, filename + suffix,
+                mimetype=mimetypes.guess_type(filename)[0] or "application/octet-stream")
+            response.headers["Content-Encoding"] = encoding
+            break
+
+    if response is None:
+        response = flask.send_from_directory(directory, filename)
+
+    response.vary.add("Accept-Encoding")
+    if os.path.relpath(os.path.join(directory, filename), app.static_folder) \
+            .startswith(HASHED_ASSETS_PATH):
+        response.headers["Cache-Control"] = HASHED_ASSETS_CACHE_CONTROL
+    else:
+        response.headers["Cache-Control"] = "no-cache"
+    return response
+
+
+# Flask's own static route has to send the compressed copies too
+app.view_functions["static"] = lambda filename: send_static(app.static_folder, filename)
+
 
 @app.errorhandler(404)
 def _(_):
-    return flask.send_from_directory(app.static_folder, "404.html"), 404
+    return send_static(app.static_folder, "404.html"), 404
 
 # as next js produces files with [square brackets] indicating URL parameters
 # we need to use those files when given parameters, so we tell Flask to ignore
@@ -49,27 +98,27 @@ def _(_):
 
 @app.route("/")
 def _index():
-    return flask.send_from_directory(app.static_folder, "index.html")
+    return send_static(app.static_folder, "index.html")
 
 
 @app.route("/studies/")
 def _studies_index():
-    return flask.send_from_directory(app.static_folder, "studies.html")
+    return send_static(app.static_folder, "studies.html")
 
 
 @app.route("/studies/<_>")
 def _studies_id(_):
-    return flask.send_from_directory(app.static_folder + "/studies", "[studyid].html")
+    return send_static(app.static_folder + "/studies", "[studyid].html")
 
 
 @app.route("/studies/<_>/signals")
 def _signal_index(_):
-    return flask.send_from_directory(app.static_folder + "/studies/[studyid]", "signals.html")
+    return send_static(app.static_folder + "/studies/[studyid]", "signals.html")
 
 
 @app.route("/studies/<_a>/signals/<_b>")
 def _signals_id(**_):
-    return flask.send_from_directory(
+    return send_static(
         app.static_folder + "/studies/[studyid]/signals", "[signalid].html")
 
 # The API spec is given in the openapi.yaml file, which is in the root
@@ -93,4 +142,5 @@ app.register_blueprint(swaggerui_blueprint, url_prefix="/docs")
 if __name__ == "__main__":
     freeze_support()
     start_multiproc()
+    start_expiry_sweeper()
     app.run("0.0.0.0")
@@ -0,0 +1,367 @@
+"""
+Genestack Uploader
+A HTTP server providing an API and a frontend for easy uploading to Genestack
+
+Copyright (C) 2022 Genome Research Limited
+
+Author: Michael Grace <mg38@sanger.ac.uk>
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+# The app, as an ASGI app, for running on an asyncio event loop
+# with uvicorn (see gunicorn.conf.py).
+#
+# Each request is still handled by the Flask app, so responses are
+# exactly the same, but on a thread from an executor, rather than a
+# thread of its own. Requests that call Genestack, which can take
+# seconds, have their own executor, so they can't hold up the rest
+# of the app. Requests waiting for a thread are just waiting
+# coroutines, so thousands can be in flight on one process.
+#
+# The calls to Genestack themselves are still blocking (the upload
+# libraries and requests have no async API), so each one holds its
+# thread while it waits. At most GENESTACK_READ_THREADS requests per
+# web worker, so WEB_WORKERS * GENESTACK_READ_THREADS in all (256 by
+# default), are calling Genestack at once, and the rest queue for a
+# thread. The same goes for WEB_THREADS and the other requests.
+#
+# Long-polls of a job's status wait on the event loop, and only
+# take a thread once there's something to respond with. A job's
+# event stream is served on the event loop, without a thread at all.
+#
+# This is our own bridge, rather than a WSGI adapter such as asgiref's
+# WsgiToAsgi, so requests can be sent to the executor for what they do,
+# and a streamed response stops when its client goes.
+
+import asyncio
+import concurrent.futures
+import io
+import re
+import sys
+import threading
+import time
+import typing as T
+from urllib.parse import parse_qsl, urlencode
+import uuid
+
+import api_jobs
+from app import app as flask_app
+import config
+import uploader
+
+Scope = T.Dict[str, T.Any]
+Message = T.Dict[str, T.Any]
+Receive = T.Callable[[], T.Awaitable[Message]]
+Send = T.Callable[[Message], T.Awaitable[None]]
+
+# the API's read endpoints that call Genestack
+GENESTACK_READ_PATHS: T.List[T.Pattern[str]] = [re.compile(f"^/api{path}/?$") for path in [
+    r"/studies",
+    r"/studies/[^/]+",
+    r"/studies/[^/]+/signals",
+    r"/studies/[^/]+/signals/[^/]+",
+    r"/templates",
+    r"/templates/[^/]+",
+    r"/templates/[^/]+/columnPresets",
+    r"/templates/[^/]+/columnPresets/[^/]+",
+    r"/templateTypes",
+    r"/jobs",
+    r"/workers",
+]]
+
+# the API's endpoints that check a new study with Genestack
+# and S3 before it's queued
+STUDY_CHECK_PATHS: T.List[T.Pattern[str]] = [re.compile(f"^/api{path}/?$") for path in [
+    r"/studies",
+    r"/studies/validate",
+    r"/jobs/batch",
+]]
+
+JOB_PATH: T.Pattern[str] = re.compile(r"^/api/jobs/(?P<job_uuid>[^/]+)/?$")
+JOB_EVENTS_PATH: T.Pattern[str] = re.compile(r"^/api/jobs/(?P<job_uuid>[^/]+)/events/?$")
+
+_finished_statuses: T.Set[str] = {x.value for x in uploader.common.FINISHED_STATUSES}
+
+# the most response messages a request's thread can get ahead
+# of the client, so a slow client doesn't fill up our memory
+_MAX_BUFFERED_MESSAGES: int = 16
+
+genestack_executor = concurrent.futures.ThreadPoolExecutor(
+    max_workers=config.GENESTACK_READ_THREADS, thread_name_prefix="genestack-read")
+local_executor = concurrent.futures.ThreadPoolExecutor(
+    max_workers=config.WEB_THREADS, thread_name_prefix="local")
+
+
+class _Disconnected(Exception):
+    """raised in a request's thread when the
+    client has gone, to stop streaming to them"""
+
+
+def _environ(scope: Scope, body: bytes) -> T.Dict[str, T.Any]:
+    """make the WSGI environ for an ASGI HTTP request"""
+    server = scope.get("server") or ("localhost", 80)
+    environ: T.Dict[str, T.Any] = {
+        "REQUEST_METHOD": scope["method"],
+        "SCRIPT_NAME": scope.get("root_path", "").encode("utf8").decode("latin1"),
+        "PATH_INFO": scope["path"].encode("utf8").decode("latin1"),
+        "QUERY_STRING": scope["query_string"].decode("latin1"),
+        "SERVER_NAME": server[0],
+        "SERVER_PORT": str(server[1]),
+        "SERVER_PROTOCOL": f"HTTP/{scope['http_version']}",
+        "wsgi.version": (1, 0),
+        "wsgi.url_scheme": scope.get("scheme", "http"),
+        "wsgi.input": io.BytesIO(body),
+        "wsgi.errors": sys.stderr,
+        "wsgi.multithread": True,
+        "wsgi.multiprocess": True,
+        "wsgi.run_once": False,
+    }
+    if scope.get("client"):
+        environ["REMOTE_ADDR"] = scope["client"][0]
+
+    for name, value in scope["headers"]:
+        header = name.decode("latin1").upper().replace("-", "_")
+        key = header if header in ("CONTENT_LENGTH", "CONTENT_TYPE") else f"HTTP_{header}"
+        environ[key] = f"{environ[key]},{value.decode('latin1')}" \
+            if key in environ else value.decode("latin1")
+
+    return environ
+
+
+async def call_flask(
+    scope: Scope,
+    receive: Receive,
+    send: Send,
+    executor: concurrent.futures.Executor
+) -> None:
+    """handle a request with the Flask app, on a thread from executor,
+    sending the response on as the Flask app produces it"""
+    body = b""
+    while True:
+        message = await receive()
+        body += message.get("body", b"")
+        if not message.get("more_body"):
+            break
+
+    loop = asyncio.get_running_loop()
+    messages: "asyncio.Queue[T.Optional[Message]]" = asyncio.Queue(_MAX_BUFFERED_MESSAGES)
+    disconnected = threading.Event()
+
+    def put(message: T.Optional[Message]) -> None:
+        if disconnected.is_set():
+            raise _Disconnected
+        put_message = asyncio.run_coroutine_threadsafe(messages.put(message), loop)
+        # the queue is full, and the client went before it was emptied
+        while True:
+            try:
+                put_message.result(timeout=1)
+                return
+            except concurrent.futures.TimeoutError:
+                if disconnected.is_set():
+                    put_message.cancel()
+                    raise _Disconnected  # pylint: disable=raise-missing-from
+
+    def run() -> None:
+        start: Message = {}
+
+        def start_response(status: str, headers: T.List[T.Tuple[str, str]], _exc_info=None):
+            start.update({
+                "type": "http.response.start",
+                "status": int(status.split(" ", 1)[0]),
+                "headers": [
+                    (name.lower().encode("latin1"), value.encode("latin1"))
+                    for name, value in headers
+                ]
+            })
+
+        try:
+            chunks = flask_app(_environ(scope, body), start_response)
+            try:
+                for chunk in chunks:
+                    if not chunk:
+                        continue
+                    if start:
+                        put(start.copy())
+                        start.clear()
+                    put({"type": "http.response.body", "body": chunk, "more_body": True})
+                if start:
+                    put(start.copy())
+                put({"type": "http.response.body", "body": b""})
+            finally:
+                if hasattr(chunks, "close"):
+                    chunks.close()
+        except _Disconnected:
+            pass
+        finally:
+            # so we stop waiting, even if Flask raised
+            asyncio.run_coroutine_threadsafe(messages.put(None), loop)
+
+    async def watch_for_disconnect() -> None:
+        # uvicorn's send does nothing once the client has gone, so
+        # this is the only way to find out, and stop the thread
+        while (await receive())["type"] != "http.disconnect":
+            pass
+        disconnected.set()
+
+    future = loop.run_in_executor(executor, run)
+    watcher = asyncio.ensure_future(watch_for_disconnect())
+    try:
+        while True:
+            message_waiter = asyncio.ensure_future(messages.get())
+            await asyncio.wait({message_waiter, watcher}, return_when=asyncio.FIRST_COMPLETED)
+            if not message_waiter.done():
+                message_waiter.cancel()
+                break
+            message = message_waiter.result()
+            if message is None:
+                break
+            await send(message)
+    finally:
+        disconnected.set()
+        watcher.cancel()
+        # let the thread finish putting, so it sees we've gone,
+        # and closes the response, on its next chunk
+        while not messages.empty():
+            messages.get_nowait()
+    await future
+
+
+async def wait_for_job(scope: Scope, job_uuid: str) -> Scope:
+    """if the request is a long-poll of a job's status, wait for its
+    status to change on the event loop, without taking a thread
+
+    Returns:
+        Scope: the request's scope, without the wait, so the Flask app
+            only has to respond with the job's status. unchanged if it's
+            not a long-poll, or is invalid, for the Flask app to deal with
+    """
+    query = parse_qsl(scope["query_string"].decode("latin1"), keep_blank_values=True)
+    params = dict(query)
+    if "wait" not in params:
+        return scope
+
+    try:
+        job_uuid = str(uuid.UUID(job_uuid))
+        wait = api_jobs.job_wait_seconds(params["wait"])
+    except ValueError:
+        return scope
+
+    job = uploader.job_store.get_job(job_uuid)
+    if job is not None:
+        known_status = params.get("status", job["status"])
+        if known_status == job["status"] and known_status not in _finished_statuses:
+            await uploader.job_store.wait_for_job_async(job_uuid, known_status, wait)
+
+    query = [(key, value) for key, value in query if key not in ("wait", "status")]
+    return {**scope, "query_string": urlencode(query).encode("latin1")}
+
+
+async def _wait_for_disconnect(receive: Receive) -> None:
+    """wait for the client to go"""
+    while (await receive())["type"] != "http.disconnect":
+        pass
+
+
+async def job_events(receive: Receive, send: Send, job_uuid: str) -> bool:
+    """stream a job's status as Server-Sent Events, as GET /jobs/<uuid>/events
+    does, but waiting on the event loop, so following a job doesn't hold a thread
+
+    Returns:
+        bool: whether it responded. if the job can't be found, it
+            doesn't, so the Flask app can respond with the error
+    """
+    try:
+        job_uuid = str(uuid.UUID(job_uuid))
+    except ValueError:
+        return False
+
+    job = uploader.job_store.get_job(job_uuid)
+    if job is None:
+        return False
+
+    await send({
+        "type": "http.response.start",
+        "status": 200,
+        "headers": [
+            (b"content-type", b"text/event-stream; charset=utf-8"),
+            (b"cache-control", b"no-cache"),
+            # stop nginx buffering the stream
+            (b"x-accel-buffering", b"no"),
+        ]
+    })
+    uploader.metrics.inc(
+        "uploader_http_requests_total", endpoint="api.jobs.get_job_events", code=200)
+
+    disconnected = asyncio.ensure_future(_wait_for_disconnect(receive))
+    deadline = time.monotonic() + api_jobs.JOB_EVENTS_MAX_SECONDS
+    sent_status: T.Optional[str] = None
+    try:
+        while job is not None:
+            if job["status"] == sent_status:
+                event = api_jobs.JOB_EVENTS_KEEPALIVE
+            else:
+                sent_status = job["status"]
+                event = api_jobs.job_status_event(job)
+            await send({"type": "http.response.body", "body": event.encode(), "more_body": True})
+
+            if sent_status in _finished_statuses or time.monotonic() >= deadline:
+                break
+
+            changed = asyncio.ensure_future(uploader.job_store.wait_for_job_async(
+                job_uuid, sent_status,
+                min(api_jobs.JOB_EVENTS_KEEPALIVE_SECONDS, deadline - time.monotonic())))
+            await asyncio.wait({changed, disconnected}, return_when=asyncio.FIRST_COMPLETED)
+            if not changed.done():
+                changed.cancel()
+                return True
+            job = changed.result()
+
+        await send({"type": "http.response.body", "body": b""})
+    finally:
+        disconnected.cancel()
+    return True
+
+
+async def app(scope: Scope, receive: Receive, send: Send) -> None:
+    """the ASGI app"""
+    if scope["type"] == "lifespan":
+        # the job workers are started by gunicorn, there's nothing to do
+        while True:
+            message = await receive()
+            if message["type"] == "lifespan.startup":
+                await send({"type": "lifespan.startup.complete"})
+            elif message["type"] == "lifespan.shutdown":
+                await send({"type": "lifespan.shutdown.complete"})
+                return
+
+    if scope["type"] != "http":
+        return
+
+    path: str = scope["path"]
+    executor = local_executor
+    if scope["method"] in ("GET", "HEAD"):
+        job_path = JOB_PATH.match(path)
+        job_events_path = JOB_EVENTS_PATH.match(path)
+        if job_path:
+            scope = await wait_for_job(scope, job_path.group("job_uuid"))
+        elif job_events_path and scope["method"] == "GET":
+            if await job_events(receive, send, job_events_path.group("job_uuid")):
+                return
+        elif any(pattern.match(path) for pattern in GENESTACK_READ_PATHS):
+            executor = genestack_executor
+    elif scope["method"] == "POST" and any(pattern.match(path) for pattern in STUDY_CHECK_PATHS):
+        executor = genestack_executor
+
+    await call_flask(scope, receive, send, executor)
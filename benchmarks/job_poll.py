@@ -0,0 +1,88 @@
+"""
+Genestack Uploader
+A HTTP server providing an API and a frontend for easy uploading to Genestack
+
+Copyright (C) 2022 Genome Research Limited
+
+Author: Michael Grace <mg38@sanger.ac.uk>
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+Benchmark for polling a job's status as the job store grows
+
+Fills a throwaway job store with an increasing number of jobs
+and times looking up random jobs, which is what happens on each
+GET /api/jobs/<uuid>. The lookup time should stay flat.
+
+Run from the root of the project:
+    python -m benchmarks.job_poll
+"""
+
+import datetime
+import os
+import random
+import statistics
+import tempfile
+import time
+import typing as T
+import uuid
+
+_store_dir = tempfile.TemporaryDirectory()  # pylint: disable=consider-using-with
+os.environ["JOB_STORE_PATH"] = f"{_store_dir.name}/jobs.db"
+
+from uploader import job_store  # pylint: disable=wrong-import-position
+
+JOB_COUNTS: T.List[int] = [1_000, 10_000, 100_000]
+POLLS: int = 2_000
+
+
+def _add_jobs(count: int) -> T.List[str]:
+    """add count finished jobs to the store in
+    a single transaction, returning their UUIDs"""
+    now = datetime.datetime.now()
+    uuids = [str(uuid.uuid4()) for _ in range(count)]
+
+    conn = job_store.connection()
+    conn.execute("BEGIN")
+    for job_uuid in uuids:
+        job_store.save_job(
+            job_uuid, "study", None, "COMPLETED",
+            now, now, now, {"studyAccession": "GSF000001"})
+    conn.execute("COMMIT")
+
+    return uuids
+
+
+def main() -> None:
+    """fill the store up to each of JOB_COUNTS and
+    report how long polling a job takes"""
+    uuids: T.List[str] = []
+    print(f"{'jobs':>10} {'mean (us)':>12} {'p99 (us)':>12}")
+
+    for count in JOB_COUNTS:
+        uuids += _add_jobs(count - len(uuids))
+
+        timings: T.List[float] = []
+        for job_uuid in random.choices(uuids, k=POLLS):
+            start = time.perf_counter()
+            job_store.get_job(job_uuid)
+            timings.append((time.perf_counter() - start) * 1_000_000)
+
+        timings.sort()
+        print(f"{count:>10} {statistics.mean(timings):>12.1f} "
+              f"{timings[int(len(timings) * 0.99)]:>12.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -24,6 +24,7 @@ import os
 import typing as T
 
 import uploader.common
+from uploader.common import int_env
 
 # Configuration Settings
 
@@ -41,3 +42,55 @@ SERVER_ENDPOINT = f"https://genestack{'-qc' if GENESTACK_SERVER == 'qc' else ''}
 LogLevel = T.Union[str, int]
 
 LOG_LEVEL: LogLevel = uploader.common.LOG_LEVEL
+
+# template lookups are cached, as they rarely change
+TEMPLATE_CACHE_TTL_SECONDS: int = int_env("TEMPLATE_CACHE_TTL_SECONDS", 3600)
+TEMPLATE_CACHE_SIZE: int = int_env("TEMPLATE_CACHE_SIZE", 256)
+
+# how long a token Genestack has accepted is trusted
+# for before it's checked again
+TOKEN_CHECK_TTL_SECONDS: int = int_env("TOKEN_CHECK_TTL_SECONDS", 60)
+
+# the Genestack ODM endpoint that lists studies a page at a time,
+# and the most studies it'll return in one page
+STUDIES_API_PATH = "/frontend/rs/genestack/studyCurator/default-released/studies"
+
+# the Genestack application method that says whose token it is,
+# as used by the Genestack Python client's Connection.whoami
+WHOAMI_API_PATH = "/frontend/endpoint/application/invoke/genestack/signin"
+
+STUDIES_PAGE_SIZE: int = int_env("STUDIES_PAGE_SIZE", 2000)
+
+# each study's signals are indexed, so a single signal
+# can be found without listing them all again
+SIGNAL_INDEX_TTL_SECONDS: int = int_env("SIGNAL_INDEX_TTL_SECONDS", 300)
+SIGNAL_INDEX_SIZE: int = int_env("SIGNAL_INDEX_SIZE", 256)
+
+# each user's studies are indexed for searching. an index older than
+# STUDY_INDEX_REFRESH_SECONDS is still used, while it's built again
+# in the background, and one unused for STUDY_INDEX_TTL_SECONDS is dropped
+STUDY_INDEX_REFRESH_SECONDS: int = int_env("STUDY_INDEX_REFRESH_SECONDS", 300)
+STUDY_INDEX_TTL_SECONDS: int = int_env("STUDY_INDEX_TTL_SECONDS", 86400)
+STUDY_INDEX_SIZE: int = int_env("STUDY_INDEX_SIZE", 32)
+
+# how many calls to Genestack the API can make at
+# once, when it fans out, such as for signal groups
+GENESTACK_THREADS: int = int_env("GENESTACK_THREADS", 8)
+
+# Genestack clients are kept for each token, so
+# their connections can be used again
+GENESTACK_CLIENT_POOL_SIZE: int = int_env("GENESTACK_CLIENT_POOL_SIZE", 64)
+GENESTACK_CLIENT_IDLE_SECONDS: int = int_env("GENESTACK_CLIENT_IDLE_SECONDS", 300)
+
+# API responses smaller than this aren't worth compressing
+COMPRESS_MIN_BYTES: int = int_env("COMPRESS_MIN_BYTES", 1024, minimum=0)
+
+# when run with gunicorn (see gunicorn.conf.py and asgi.py), how many
+# web worker processes there are, and how many requests each runs at
+# once, both those calling Genestack and those that don't. any more
+# requests wait their turn without holding a thread. calls to Genestack
+# block, so WEB_WORKERS * GENESTACK_READ_THREADS is the most requests
+# that can be waiting on Genestack at once
+WEB_WORKERS: int = int_env("WEB_WORKERS", 4)
+WEB_THREADS: int = int_env("WEB_THREADS", 32)
+GENESTACK_READ_THREADS: int = int_env("GENESTACK_READ_THREADS", 64)
@@ -21,27 +21,41 @@ along with this program.  If not, see <https://www.gnu.org/licenses/>.
 */
 
 import Head from "next/head";
-import { useEffect, useState } from "react";
+import { useEffect, useRef, useState } from "react";
 import styles from "../styles/Home.module.css";
 import { apiRequest } from "../utils/api";
+import { AutocompleteField } from "../utils/AutocompleteField";
 
-const studyNames = async (ignore_unauth) => {
+const checkToken = async (ignore_unauth) => {
   /**
-   * We need to pull the names and accessions of the studies from the API
-   * However, we also need to use the oppurtunity to check if the authentication
-   * works. So, only once, we'll ignore it if its unauthorised (its not like the
+   * Searching the studies once gets the server to index them, so the
+   * search box is quick from the start. However, we also need to use the
+   * oppurtunity to check if the authentication works. So, only once, we'll ignore it if its unauthorised (its not like the
    * API will return anything), and then prompt the user to enter a token, instead
    * of going in alarm bells ringing like HEY LOOK - YOU'RE NOT ALLOWED TO ACCESS
    * THIS DATA WHAT ARE YOU DOING, when actually its more like "Hey, I just haven't
    * typed in the token yet"
    */
-  var studies = await apiRequest("studies", ignore_unauth);
-  return studies.data.map((e) => ({
-    title: e["Study Source"],
-    accession: e["genestack:accession"],
-  }));
+  await apiRequest("studies/search?q=&limit=1", ignore_unauth);
 };
 
+const searchStudies = async (text) => {
+  /**
+   * The server searches the studies for us, so we don't have to
+   * download every study
+   */
+  var found = await apiRequest(
+    `studies/search?q=${encodeURIComponent(text)}&limit=20`
+  );
+  if (found == null || found.status != "OK") {
+    return [];
+  }
+  return found.data.studies;
+};
+
+const studySuggestion = (study) =>
+  `${study.accession}: ${study.title || study.source}`;
+
 const saveAPIToken = (token) => {
   /**
    * When we save the API token into localStorage, we also need to
@@ -52,8 +66,10 @@ const saveAPIToken = (token) => {
 };
 
 export default function Home() {
-  const [studies, setStudies] = useState([]);
+  // "" is a new study, and null is something typed that isn't a study
   const [selectedStudy, setSelectedStudy] = useState("");
+  // the accession of each suggestion we've shown
+  const suggestedStudies = useRef({});
 
   const [softwareVersion, setSoftwareVersion] = useState("");
   const [genestackServer, setGenestackServer] = useState("");
@@ -88,14 +104,11 @@ export default function Home() {
   const authenticate = (ignore_unauth) => {
     localStorage.setItem("unauthorised", "");
     !ignore_unauth && setUnauthorisedWarning("");
-    studyNames(ignore_unauth).then((names) => {
-      setStudies(names);
-    });
+    checkToken(ignore_unauth);
   };
 
   useEffect(() => {
     setUnauthorisedWarning(localStorage.getItem("unauthorised"));
-    setStudies([]);
     authenticate(true);
 
     apiRequest("").then((d) => {
@@ -105,7 +118,21 @@ export default function Home() {
     });
   }, []);
 
+  const suggestStudies = async (text) => {
+    let studies = await searchStudies(text);
+    studies.forEach((e) => {
+      suggestedStudies.current[studySuggestion(e)] = e.accession;
+    });
+    return studies.map(studySuggestion);
+  };
+
   const goToStudy = () => {
+    if (selectedStudy == null) {
+      window.alert(
+        "Pick a study from the suggestions, or leave it blank for a new study"
+      );
+      return;
+    }
     window.location = `${process.env.NEXT_PUBLIC_HOST}/studies/${selectedStudy}`;
   };
 
@@ -147,21 +174,22 @@ export default function Home() {
         </div>
         <br />
         <div className="form-group">
-          <label>Select a Study:</label>
-          <select
-            name="study"
-            className="form-select"
-            onChange={(e) => {
-              setSelectedStudy(e.target.value);
+          <label>Select a Study (leave blank for a new study):</label>
+          <AutocompleteField
+            defaultValue=""
+            placeholder="New Study"
+            blurHandler={(value) => {
+              // only a picked suggestion selects a study, so
+              // whatever else is typed isn't taken as an accession
+              if (!value.trim()) {
+                setSelectedStudy("");
+              } else {
+                setSelectedStudy(suggestedStudies.current[value] ?? null);
+              }
             }}
-          >
-            <option value="">New Study</option>
-            {studies.map((e) => (
-              <option key={e.accession} value={e.accession}>
-                {e.title}
-              </option>
-            ))}
-          </select>
+            search={suggestStudies}
+            keyID="study"
+          />
         </div>
         <br />
         <div className="form-group">
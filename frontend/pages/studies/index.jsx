@@ -20,7 +20,12 @@ You should have received a copy of the GNU General Public License
 along with this program.  If not, see <https://www.gnu.org/licenses/>.
 */
 
-import { apiRequest, keyCheck, postApiReqiest } from "../../utils/api";
+import {
+  apiRequest,
+  keyCheck,
+  postApiReqiest,
+  putApiRequest,
+} from "../../utils/api";
 import styles from "../../styles/Home.module.css";
 import { useEffect, useState } from "react";
 import { HelpModal } from "../../utils/HelpModal";
@@ -36,6 +41,7 @@ const NewStudy = () => {
   const [selectedTemplate, setSelectedTemplate] = useState("");
   const [templateFields, setTemplateFields] = useState([]);
   const [sampleTemplateFields, setSampleTemplateFields] = useState([]);
+  const [columnPresets, setColumnPresets] = useState([]);
 
   const [newStudy, setNewStudy] = useState(Object);
 
@@ -90,6 +96,57 @@ const NewStudy = () => {
         .map((e) => e.name);
       setSampleTemplateFields(sampleFields);
     });
+    loadColumnPresets();
+  };
+
+  /**
+   * Column presets are the columns to rename, add and delete,
+   * saved by name for a template, so a sample file with the same
+   * layout as last time doesn't need them all entering again.
+   * Loading one copies its columns into the form, where they
+   * can still be changed before submitting.
+   */
+  const columnPresetsUrl = () =>
+    `templates/${encodeURIComponent(selectedTemplate)}/columnPresets`;
+
+  const loadColumnPresets = () => {
+    apiRequest(columnPresetsUrl()).then((p) => {
+      setColumnPresets(p.data);
+    });
+  };
+
+  const applyColumnPreset = (name) => {
+    let preset = columnPresets.find((e) => e.name == name);
+    if (!preset) {
+      return;
+    }
+    setNewStudy({
+      ...newStudy,
+      renamedColumns: preset.renamedColumns.map((e) => ({ ...e })),
+      addedColumns: preset.addedColumns.map((e) => ({ ...e })),
+      deletedColumns: [...preset.deletedColumns],
+    });
+  };
+
+  const saveColumnPreset = async () => {
+    let name = window.prompt("Save these columns as a preset called");
+    if (!name) {
+      return;
+    }
+    let [req_ok, req_info] = await putApiRequest(
+      `${columnPresetsUrl()}/${encodeURIComponent(name)}`,
+      {
+        renamedColumns: newStudy.renamedColumns,
+        addedColumns: newStudy.addedColumns,
+        deletedColumns: newStudy.deletedColumns,
+      }
+    );
+    if (!req_ok) {
+      let detail = JSON.parse(req_info).data?.detail || [];
+      window.alert(`The preset couldn't be saved:\n${detail.join("\n")}`);
+      return;
+    }
+    loadColumnPresets();
   };
 
   const submitStudy = async () => {
@@ -125,9 +182,16 @@ const NewStudy = () => {
     }
 
     // POST the request, get the job ID
-    // We'll then poll the job every 20 seconds
-    // and update the UI if the job status changes
+    // JobStatus then follows the job's events
+    // and updates the UI when the job status changes.
+    // The study is checked against the template and the sample file's
+    // header first, and if it won't upload we get every problem back
     let [req_ok, req_info] = await postApiReqiest("studies", newStudy);
+    if (!req_ok) {
+      let detail = JSON.parse(req_info).data?.detail || [];
+      window.alert(`The study can't be uploaded:\n${detail.join("\n")}`);
+      return;
+    }
     let jobID = JSON.parse(req_info).data.jobId;
     setJobID(jobID);
   };
@@ -235,6 +299,30 @@ const NewStudy = () => {
               }}
             />
             <br />
+            <label htmlFor="select-column-preset">Column Preset</label>
+            <select
+              className="form-select"
+              name="select-column-preset"
+              defaultValue=""
+              onChange={(e) => {
+                applyColumnPreset(e.target.value);
+              }}
+            >
+              <option value="">None</option>
+              {columnPresets.map((e) => (
+                <option key={e.name} value={e.name}>
+                  {e.name}
+                </option>
+              ))}
+            </select>
+            <button
+              type="button"
+              className="btn btn-sm btn-secondary"
+              onClick={saveColumnPreset}
+            >
+              Save Columns as Preset
+            </button>
+            <br />
             <label>Add Columns</label>
             <br />
             {newStudy.addedColumns.map((val, idx) => (
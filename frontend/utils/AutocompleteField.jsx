@@ -20,11 +20,16 @@ You should have received a copy of the GNU General Public License
 along with this program.  If not, see <https://www.gnu.org/licenses/>.
 */
 
-import { useState } from "react";
+import { useRef, useState } from "react";
 import styles from "../styles/Home.module.css";
 
+// how long to wait after the last key press
+// before asking the server for suggestions
+const SEARCH_DELAY_MS = 150;
+
 export const AutocompleteField = ({
   suggestions,
+  search,
   defaultValue,
   placeholder,
   blurHandler,
@@ -32,17 +37,36 @@ export const AutocompleteField = ({
 }) => {
   const [filteredSuggestsions, setFilteredSuggestions] = useState([]);
   const [userInput, setUserInput] = useState(defaultValue);
+  const searchTimeout = useRef(null);
+  const latestInput = useRef(defaultValue);
 
   const textChangeHandler = (e) => {
     // this is called when we type anything in the box
     // it will refilter the suggestions, and set userInput
     let newUserInput = e.currentTarget.value;
+    setUserInput(newUserInput);
+    latestInput.current = newUserInput;
+
+    if (search) {
+      // the suggestions come from the server, so we only ask
+      // once the user stops typing, and ignore any answers
+      // that come back after they've typed something else
+      clearTimeout(searchTimeout.current);
+      searchTimeout.current = setTimeout(() => {
+        search(newUserInput).then((found) => {
+          if (latestInput.current == newUserInput) {
+            setFilteredSuggestions(found);
+          }
+        });
+      }, SEARCH_DELAY_MS);
+      return;
+    }
+
     let newFilteredSuggestions = suggestions.filter(
       (s) => s.toLowerCase().indexOf(newUserInput.toLowerCase()) > -1
     );
 
     setFilteredSuggestions(newFilteredSuggestions);
-    setUserInput(newUserInput);
   };
 
   const clickHandler = (e) => {
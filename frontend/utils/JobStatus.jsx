@@ -22,7 +22,6 @@ along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
 import { useEffect, useState } from "react";
 import { QuestionCircle } from "react-bootstrap-icons";
-import { apiRequest } from "./api";
 import { HelpModal } from "./HelpModal";
 
 export const JobStatus = ({ jobID }) => {
@@ -31,27 +30,38 @@ export const JobStatus = ({ jobID }) => {
   const [studyAccession, setStudyAccession] = useState("");
   const [showModal, setShowModal] = useState(false);
 
-  const updateJobState = (jobID, refreshID) => {
-    apiRequest(`jobs/${jobID}`).then((t) => {
-      setSuccessfulRequest(t.data.status);
+  const updateJobState = (job) => {
+    setSuccessfulRequest(job.status);
 
-      if (t.data.status === "FAILED") {
-        setApiError(JSON.stringify(t.data.output));
-        clearInterval(refreshID);
-      } else if (t.data.status === "COMPLETED") {
-        setStudyAccession(t.data.output.studyAccession);
-        clearInterval(refreshID);
-      }
-    });
+    if (job.status === "FAILED") {
+      setApiError(JSON.stringify(job.output));
+    } else if (job.status === "COMPLETED") {
+      setStudyAccession(job.output.studyAccession);
+    }
   };
 
   useEffect(() => {
     setApiError("");
     setStudyAccession("");
-    updateJobState(jobID, null);
-    let refreshID = setInterval(() => {
-      updateJobState(jobID, refreshID);
-    }, 20000);
+
+    // the API pushes us the job's status each time it changes,
+    // and ends the stream once the job has finished
+    const events = new EventSource(
+      `${process.env.NEXT_PUBLIC_HOST}/api/jobs/${jobID}/events`
+    );
+    events.addEventListener("status", (e) => {
+      const job = JSON.parse(e.data).data;
+      updateJobState(job);
+
+      if (job.status === "FAILED" || job.status === "COMPLETED") {
+        // otherwise the browser will reconnect when the stream ends
+        events.close();
+      }
+    });
+
+    return () => {
+      events.close();
+    };
   }, [jobID]);
 
   return (
@@ -20,23 +20,43 @@ You should have received a copy of the GNU General Public License
 along with this program.  If not, see <https://www.gnu.org/licenses/>.
 */
 
+// responses we've had an ETag for, by token and url, so we can ask
+// the API if they've changed, and use them again on a 304
+const etagCache = new Map();
+
 export const apiRequest = async (endpoint, ignore_unauth = false) => {
-  const r = await fetch(
-    `${process.env.NEXT_PUBLIC_HOST}/api${
-      endpoint != "" ? "/" : ""
-    }${endpoint}`,
-    {
-      headers: {
-        "Genestack-API-Token": localStorage.getItem("Genestack-API-Token"),
-      },
-    }
-  );
+  const url = `${process.env.NEXT_PUBLIC_HOST}/api${
+    endpoint != "" ? "/" : ""
+  }${endpoint}`;
+  const token = localStorage.getItem("Genestack-API-Token");
+  const cacheKey = `${token} ${url}`;
+  const cached = etagCache.get(cacheKey);
+
+  const headers = { "Genestack-API-Token": token };
+  if (cached) {
+    headers["If-None-Match"] = cached.etag;
+  }
+
+  // we handle the ETags ourselves, so the browser shouldn't
+  // turn a 304 into its own cached copy
+  const r = await fetch(url, { headers, cache: "no-store" });
   if ((r.status == 403 || r.status == 401) && !ignore_unauth) {
     localStorage.setItem("unauthorised", "Unauthorised");
     window.location = process.env.NEXT_PUBLIC_HOST + "/";
     return null;
   }
-  return await r.json();
+  if (r.status == 304 && cached) {
+    return cached.body;
+  }
+
+  const body = await r.json();
+  const etag = r.headers.get("ETag");
+  if (r.ok && etag) {
+    etagCache.set(cacheKey, { etag, body });
+  } else {
+    etagCache.delete(cacheKey);
+  }
+  return body;
 };
 
 export const postApiReqiest = async (endpoint, body) => {
@@ -51,6 +71,18 @@ export const postApiReqiest = async (endpoint, body) => {
   return [r.ok, await r.text()];
 };
 
+export const putApiRequest = async (endpoint, body) => {
+  const r = await fetch(`${process.env.NEXT_PUBLIC_HOST}/api/${endpoint}`, {
+    method: "PUT",
+    headers: {
+      "Genestack-API-Token": localStorage.getItem("Genestack-API-Token"),
+      "Content-Type": "application/json",
+    },
+    body: JSON.stringify(body),
+  });
+  return [r.ok, await r.text()];
+};
+
 export const keyCheck = () => {
   if (localStorage.getItem("Genestack-API-Token") == null) {
     window.location = process.env.NEXT_PUBLIC_HOST + "/";
@@ -22,7 +22,8 @@ along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
 export const studiesIndexHelpText =
   "Using this page, you can create a new study. First, select the template you wish to use, and \
-load it. Then, fill out the boxes you want, and click submit at the bottom.";
+load it. Then, fill out the boxes you want, and click submit at the bottom. If you upload sample \
+files with the same layout often, save the columns to change as a preset, and choose it next time.";
 
 export const viewStudyHelpText =
   "Using this page, you can view the metadata for a study. You also have links \
@@ -0,0 +1,59 @@
+"""
+Genestack Uploader
+A HTTP server providing an API and a frontend for easy uploading to Genestack
+
+Copyright (C) 2022 Genome Research Limited
+
+Author: Michael Grace <mg38@sanger.ac.uk>
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+# The production server, run with `gunicorn asgi:app`, which reads
+# this file. There are WEB_WORKERS processes, each running the app
+# on an asyncio event loop with uvicorn (see asgi.py).
+#
+# The app is loaded once, in gunicorn's master process, which then
+# starts the job workers and the expiry sweeper, before setting up its
+# signal handlers and forking the web workers. That way, there's only one pool of job workers, and
+# every web worker puts jobs on the same queue. Job state is in the
+# job store, so any web worker can look up any job.
+
+import config
+
+bind = "0.0.0.0:5000"
+workers = config.WEB_WORKERS
+worker_class = "uvicorn.workers.UvicornWorker"
+preload_app = True
+
+# how long a web worker can go without checking in before it is restarted
+timeout = 120
+
+
+def on_starting(_server):
+    """start the job workers and expiry sweeper once, in the master process
+
+    this is before gunicorn sets up its signal handlers, so the job workers
+    don't inherit them: they'd stop SIGTERM from stopping a worker, and the
+    SIGCHLD one would reap processes the upload libraries start. the app
+    is already loaded, as preload_app is set"""
+    from api import start_expiry_sweeper, start_multiproc  # pylint: disable=import-outside-toplevel
+    start_multiproc()
+    start_expiry_sweeper()
+
+
+def on_exit(_server):
+    """stop the job workers, so the master can exit"""
+    from api import stop_multiproc  # pylint: disable=import-outside-toplevel
+    stop_multiproc()
@@ -0,0 +1,138 @@
+"""
+Genestack Uploader
+A HTTP server providing an API and a frontend for easy uploading to Genestack
+
+Copyright (C) 2022 Genome Research Limited
+
+Author: Michael Grace <mg38@sanger.ac.uk>
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+import bisect
+import re
+import typing as T
+
+# the fields of a study that are searched, and how much
+# more a match on each counts than a match on the last
+SEARCH_FIELDS: T.Dict[str, int] = {
+    "genestack:accession": 3,
+    "Study Title": 2,
+    "Study Source": 1,
+}
+
+# how much more a word matching a term exactly counts
+# than matching the start of it, or anywhere in it
+_EXACT_SCORE: int = 4
+_PREFIX_SCORE: int = 2
+_SUBSTRING_SCORE: int = 1
+
+_WORD = re.compile(r"[a-z0-9]+")
+
+
+def _words(text: str) -> T.List[str]:
+    """split text into lowercase words,
+    ignoring any punctuation"""
+    return _WORD.findall(text.lower())
+
+
+class StudyIndex:
+    """
+        An inverted index of studies by the words in their
+        accession, title and source, for searching as the user types
+
+        Each distinct term is kept once, sorted, so the terms starting
+        with a word are found with a binary search, and the terms
+        containing it with a scan of the terms, rather than the studies
+    """
+
+    def __init__(self, studies: T.Iterable[T.Dict[str, T.Any]]) -> None:
+        self.studies: T.List[T.Dict[str, str]] = []
+        # for each term, the studies it's in, with
+        # the weight of the best field it's in
+        postings: T.Dict[str, T.Dict[int, int]] = {}
+
+        for study in studies:
+            position = len(self.studies)
+            self.studies.append({
+                "accession": study.get("genestack:accession") or "",
+                "title": study.get("Study Title") or "",
+                "source": study.get("Study Source") or "",
+            })
+            for field, weight in SEARCH_FIELDS.items():
+                for term in _words(str(study.get(field) or "")):
+                    weights = postings.setdefault(term, {})
+                    weights[position] = max(weights.get(position, 0), weight)
+
+        self._terms: T.List[str] = sorted(postings)
+        self._postings: T.List[T.Dict[int, int]] = [postings[term] for term in self._terms]
+
+    def __len__(self) -> int:
+        return len(self.studies)
+
+    def _matches(self, word: str) -> T.Dict[int, int]:
+        """score every study with a term matching the word,
+        keeping each study's best match"""
+        scores: T.Dict[int, int] = {}
+
+        def add(term_position: int, match_score: int) -> None:
+            for study, weight in self._postings[term_position].items():
+                scores[study] = max(scores.get(study, 0), match_score * weight)
+
+        start = bisect.bisect_left(self._terms, word)
+        end = start
+        while end < len(self._terms) and self._terms[end].startswith(word):
+            add(end, _EXACT_SCORE if self._terms[end] == word else _PREFIX_SCORE)
+            end += 1
+
+        for term_position, term in enumerate(self._terms):
+            if (term_position < start or term_position >= end) and word in term:
+                add(term_position, _SUBSTRING_SCORE)
+
+        return scores
+
+    def search(self, query: str, limit: int) -> T.List[T.Dict[str, T.Any]]:
+        """find the studies matching every word in the query, at the
+        start of, or anywhere in, a word of their accession, title or source
+
+        Args:
+            query: str - what the user has typed
+            limit: int - the most studies to return
+
+        Returns:
+            List[Dict[str, Any]]: the best matches first, for example
+                [{"accession": "GSF000001", "title": "...",
+                  "source": "...", "score": 12}]
+        """
+        words = _words(query)
+        if not words:
+            return []
+
+        scores: T.Optional[T.Dict[int, int]] = None
+        for word in words:
+            matches = self._matches(word)
+            scores = matches if scores is None else {
+                study: score + matches[study]
+                for study, score in scores.items() if study in matches
+            }
+            if not scores:
+                return []
+
+        assert scores is not None
+
+        def name(study: int) -> str:
+            return (self.studies[study]["title"] or self.studies[study]["source"]).lower()
+
+        best = sorted(scores.items(), key=lambda match: (-match[1], name(match[0])))[:limit]
+        return [{**self.studies[study], "score": score} for study, score in best]
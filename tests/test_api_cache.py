@@ -0,0 +1,121 @@
+"""
+Genestack Uploader
+A HTTP server providing an API and a frontend for easy uploading to Genestack
+
+Copyright (C) 2022 Genome Research Limited
+
+Author: Michael Grace <mg38@sanger.ac.uk>
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+Tests for the API's in-memory caches
+
+Run from the root of the project:
+    python -m unittest discover tests
+"""
+
+import os
+import tempfile
+import unittest
+
+_store_dir = tempfile.TemporaryDirectory()  # pylint: disable=consider-using-with
+os.environ["JOB_STORE_PATH"] = f"{_store_dir.name}/jobs.db"
+
+import api_cache  # pylint: disable=wrong-import-position
+from uploader import job_store  # pylint: disable=wrong-import-position
+
+
+class TTLCacheTest(unittest.TestCase):
+    """expiring values, and dropping the least recently used"""
+
+    def test_hits_and_misses(self):
+        """a cached value is a hit, anything else a miss"""
+        cache = api_cache.TTLCache(60, 10)
+        cache.set("a", None)
+        self.assertIsNone(cache.get("a"))
+        self.assertIs(cache.get("b"), api_cache.MISSING)
+        self.assertEqual(
+            {key: cache.stats[key] for key in ("hits", "misses", "hitRatio", "size")},
+            {"hits": 1, "misses": 1, "hitRatio": 0.5, "size": 1})
+
+    def test_expiry(self):
+        """a value past its ttl is gone"""
+        cache = api_cache.TTLCache(-1, 10)
+        cache.set("a", 1)
+        self.assertIs(cache.get("a"), api_cache.MISSING)
+        self.assertEqual(cache.stats["size"], 0)
+
+    def test_least_recently_used_dropped(self):
+        """over max_size, the value used longest ago goes"""
+        cache = api_cache.TTLCache(60, 2)
+        cache.set("a", 1)
+        cache.set("b", 2)
+        cache.get("a")
+        cache.set("c", 3)
+        self.assertEqual(cache.get("a"), 1)
+        self.assertIs(cache.get("b"), api_cache.MISSING)
+        self.assertEqual(cache.get("c"), 3)
+
+    def test_invalidate(self):
+        """a single key, or everything, can be removed"""
+        cache = api_cache.TTLCache(60, 10)
+        cache.set("a", 1)
+        cache.set("b", 2)
+        cache.invalidate("a")
+        self.assertIs(cache.get("a"), api_cache.MISSING)
+        self.assertEqual(cache.get("b"), 2)
+        cache.invalidate()
+        self.assertIs(cache.get("b"), api_cache.MISSING)
+
+
+class SyncInvalidationsTest(unittest.TestCase):
+    """emptying a cache in every web worker"""
+
+    def setUp(self):
+        """start from empty caches, checked against the job store"""
+        for cache in api_cache.caches.values():
+            cache.invalidate()
+        api_cache._generations_checked = 0  # pylint: disable=protected-access
+        api_cache.sync_invalidations()
+
+    def test_another_worker_emptied_it(self):
+        """a cache emptied through the job store is emptied here"""
+        api_cache.templates.set("a", 1)
+        api_cache.signal_indexes.set("a", 1)
+        job_store.bump_cache_generation("templates")
+
+        api_cache._generations_checked = 0  # pylint: disable=protected-access
+        api_cache.sync_invalidations()
+        self.assertIs(api_cache.templates.get("a"), api_cache.MISSING)
+        self.assertEqual(api_cache.signal_indexes.get("a"), 1)
+
+    def test_checked_at_most_once_a_second(self):
+        """a check straight after another doesn't look at the job store"""
+        api_cache.templates.set("a", 1)
+        job_store.bump_cache_generation("templates")
+        api_cache.sync_invalidations()
+        self.assertEqual(api_cache.templates.get("a"), 1)
+
+    def test_invalidate_doesnt_empty_it_again(self):
+        """the worker that empties a cache isn't behind on it"""
+        api_cache.invalidate("templates")
+        api_cache.templates.set("a", 1)
+
+        api_cache._generations_checked = 0  # pylint: disable=protected-access
+        api_cache.sync_invalidations()
+        self.assertEqual(api_cache.templates.get("a"), 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
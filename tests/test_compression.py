@@ -0,0 +1,115 @@
+"""
+Genestack Uploader
+A HTTP server providing an API and a frontend for easy uploading to Genestack
+
+Copyright (C) 2022 Genome Research Limited
+
+Author: Michael Grace <mg38@sanger.ac.uk>
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+Tests for telling how a file is compressed, and decompressing it as it streams
+
+Run from the root of the project:
+    python -m unittest discover tests
+"""
+
+import gzip
+import typing as T
+import unittest
+
+import zstandard
+
+from uploader import compression
+
+TEXT: bytes = b"".join(f"line {i}\n".encode() for i in range(100_000))
+
+
+def _chunks(data: bytes, size: int = 1000) -> T.Iterator[bytes]:
+    """data, a chunk at a time, as it'd be streamed from S3"""
+    for start in range(0, len(data), size):
+        yield data[start:start + size]
+
+
+class DetectTest(unittest.TestCase):
+    """telling how a file is compressed"""
+
+    def test_magic_bytes(self):
+        """the first bytes are trusted over the name"""
+        self.assertEqual(
+            compression.detect(gzip.compress(b"x"), "a.zst"), compression.Compression.GZIP)
+        self.assertEqual(
+            compression.detect(zstandard.compress(b"x"), "a.gz"), compression.Compression.ZSTD)
+        self.assertEqual(compression.detect(b"#CHROM", "a.gz"), compression.Compression.NONE)
+
+    def test_short_files_go_by_name(self):
+        """a file too short to have magic bytes goes by its extension"""
+        self.assertEqual(compression.detect(b"", "a.VCF.GZ"), compression.Compression.GZIP)
+        self.assertEqual(compression.detect(b"", "a.bgz"), compression.Compression.GZIP)
+        self.assertEqual(compression.detect(b"", "a.vcf"), compression.Compression.NONE)
+
+    def test_decompressed_name(self):
+        """only a compression extension is removed"""
+        self.assertEqual(compression.decompressed_name("a.vcf.gz"), "a.vcf")
+        self.assertEqual(compression.decompressed_name("a.tsv.zst"), "a.tsv")
+        self.assertEqual(compression.decompressed_name("a.vcf"), "a.vcf")
+
+
+class DecompressTest(unittest.TestCase):
+    """decompressing a file as its chunks arrive"""
+
+    def _decompress(self, data: bytes, name: str = "") -> bytes:
+        """decompress data, streamed in small chunks"""
+        return b"".join(compression.decompress(_chunks(data), name))
+
+    def test_plain(self):
+        """an uncompressed file comes through as it is"""
+        self.assertEqual(self._decompress(TEXT), TEXT)
+
+    def test_gzip(self):
+        """a gzipped file is decompressed"""
+        self.assertEqual(self._decompress(gzip.compress(TEXT)), TEXT)
+
+    def test_bgzip(self):
+        """bgzip, many gzip members one after another, is decompressed whole"""
+        members = b"".join(gzip.compress(chunk) for chunk in _chunks(TEXT, 65280))
+        self.assertEqual(self._decompress(members), TEXT)
+
+    def test_zstd_frames(self):
+        """every zstd frame is decompressed, not just the first"""
+        frames = b"".join(zstandard.compress(chunk) for chunk in _chunks(TEXT, 100_000))
+        self.assertEqual(self._decompress(frames), TEXT)
+
+    def test_only_takes_the_chunks_it_needs(self):
+        """reading the start of a file doesn't read all of it"""
+        taken: T.List[bytes] = []
+
+        def chunks() -> T.Iterator[bytes]:
+            """the gzipped text, noting each chunk taken"""
+            for chunk in _chunks(gzip.compress(TEXT)):
+                taken.append(chunk)
+                yield chunk
+
+        first = next(compression.decompress(chunks()))
+        self.assertTrue(TEXT.startswith(first))
+        self.assertLess(sum(len(chunk) for chunk in taken), len(gzip.compress(TEXT)))
+
+    def test_corrupt(self):
+        """a file cut short raises one of the DECOMPRESSION_ERRORS"""
+        with self.assertRaises(compression.DECOMPRESSION_ERRORS):
+            self._decompress(gzip.compress(TEXT)[:-100])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,171 @@
+"""
+Genestack Uploader
+A HTTP server providing an API and a frontend for easy uploading to Genestack
+
+Copyright (C) 2022 Genome Research Limited
+
+Author: Michael Grace <mg38@sanger.ac.uk>
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+Tests for the job store's queries, and waiting on a job
+
+Run from the root of the project:
+    python -m unittest discover tests
+"""
+
+import asyncio
+import datetime
+import os
+import tempfile
+import threading
+import typing as T
+import unittest
+import uuid
+
+_store_dir = tempfile.TemporaryDirectory()  # pylint: disable=consider-using-with
+os.environ["JOB_STORE_PATH"] = f"{_store_dir.name}/jobs.db"
+
+from uploader import job_store  # pylint: disable=wrong-import-position
+
+
+def _add_job(
+    status: str = "QUEUED",
+    job_type: str = "study",
+    submitted: T.Optional[datetime.datetime] = None
+) -> str:
+    """add a job to the store, returning its UUID"""
+    job_uuid = str(uuid.uuid4())
+    job_store.save_job(
+        job_uuid, job_type, "GSF000001" if job_type == "signal" else None, status,
+        submitted or datetime.datetime.now(), None, None, None)
+    return job_uuid
+
+
+class JobStoreTest(unittest.TestCase):
+    """each test starts with an empty job store"""
+
+    def setUp(self):
+        """remove the jobs the last test added"""
+        job_store.connection().execute("DELETE FROM jobs")
+
+
+class FindJobsTest(JobStoreTest):
+    """finding jobs by their ID, status, type and submit time"""
+
+    def test_newest_first_up_to_the_limit(self):
+        """the newest jobs are returned, no more than the limit"""
+        start = datetime.datetime(2022, 1, 1)
+        uuids = [_add_job(submitted=start + datetime.timedelta(minutes=i)) for i in range(5)]
+        found = job_store.find_jobs(limit=3)
+        self.assertEqual([job["jobId"] for job in found], uuids[:1:-1])
+
+    def test_limit_must_be_positive(self):
+        """SQLite takes a negative limit as no limit, so they're refused"""
+        _add_job()
+        for limit in (0, -1):
+            with self.assertRaises(ValueError):
+                job_store.find_jobs(limit=limit)
+
+    def test_filters(self):
+        """every filter given must match"""
+        start = datetime.datetime(2022, 1, 1)
+        old = _add_job(submitted=start)
+        queued_signal = _add_job(job_type="signal", submitted=start + datetime.timedelta(hours=1))
+        running = _add_job(status="RUNNING", submitted=start + datetime.timedelta(hours=1))
+
+        def found(**filters: T.Any) -> T.Set[str]:
+            """the IDs of the jobs found"""
+            return {job["jobId"] for job in job_store.find_jobs(**filters)}
+
+        self.assertEqual(found(status="QUEUED"), {old, queued_signal})
+        self.assertEqual(found(job_type="signal"), {queued_signal})
+        self.assertEqual(
+            found(since=start + datetime.timedelta(minutes=1)), {queued_signal, running})
+        self.assertEqual(found(job_uuids=[old, running, str(uuid.uuid4())]), {old, running})
+        self.assertEqual(found(job_uuids=[old], status="RUNNING"), set())
+
+
+class WaitForJobTest(JobStoreTest):
+    """long-polling a job for a change to its status"""
+
+    def test_returns_straight_away_if_the_status_has_changed(self):
+        """a caller that's behind gets the new status without waiting"""
+        job_uuid = _add_job(status="RUNNING")
+        job = job_store.wait_for_job(job_uuid, "QUEUED", 60)
+        self.assertEqual(job["status"], "RUNNING")
+
+    def test_returns_the_new_status(self):
+        """a change made while waiting is returned"""
+        job_uuid = _add_job()
+        changer = threading.Timer(0.3, job_store.save_job, args=(
+            job_uuid, "study", None, "RUNNING", datetime.datetime.now(), None, None, None))
+        changer.start()
+        self.addCleanup(changer.cancel)
+
+        job = job_store.wait_for_job(job_uuid, "QUEUED", 60)
+        self.assertEqual(job["status"], "RUNNING")
+
+    def test_times_out(self):
+        """with no change, the same status is returned at the timeout"""
+        job_uuid = _add_job()
+        job = job_store.wait_for_job(job_uuid, "QUEUED", 0.3)
+        self.assertEqual(job["status"], "QUEUED")
+
+    def test_missing_job(self):
+        """there's nothing to wait for on a job that isn't there"""
+        self.assertIsNone(job_store.wait_for_job(str(uuid.uuid4()), "QUEUED", 60))
+
+    def test_timeout_must_be_finite_and_not_negative(self):
+        """a nan or infinite timeout would never be reached"""
+        job_uuid = _add_job()
+        for timeout in (float("nan"), float("inf"), -1):
+            with self.assertRaises(ValueError):
+                job_store.wait_for_job(job_uuid, "QUEUED", timeout)
+            with self.assertRaises(ValueError):
+                asyncio.run(job_store.wait_for_job_async(job_uuid, "QUEUED", timeout))
+
+    def test_async(self):
+        """waiting on the event loop sees the same change"""
+        job_uuid = _add_job()
+
+        async def wait() -> T.Optional[T.Dict[str, T.Any]]:
+            """fail the job in a moment, while waiting on it"""
+            asyncio.get_running_loop().call_later(
+                0.3, job_store.save_job, job_uuid, "study", None, "FAILED",
+                datetime.datetime.now(), None, None, None)
+            return await job_store.wait_for_job_async(job_uuid, "QUEUED", 60)
+
+        self.assertEqual(asyncio.run(wait())["status"], "FAILED")
+
+
+class FailUnfinishedTest(JobStoreTest):
+    """finishing the jobs left behind by a restart"""
+
+    def test_only_unfinished_jobs_are_failed(self):
+        """queued and running jobs are failed, with an end
+        time so they expire, and finished jobs are left alone"""
+        queued, running, completed = _add_job(), _add_job("RUNNING"), _add_job("COMPLETED")
+        failed = job_store.fail_unfinished(("QUEUED", "RUNNING"), "FAILED", {"error": "restart"})
+        self.assertEqual(failed, 2)
+
+        for job_uuid in (queued, running):
+            job = job_store.get_job(job_uuid)
+            self.assertEqual((job["status"], job["output"]), ("FAILED", {"error": "restart"}))
+            self.assertIsNotNone(job["endTime"])
+        self.assertEqual(job_store.get_job(completed)["status"], "COMPLETED")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,165 @@
+"""
+Genestack Uploader
+A HTTP server providing an API and a frontend for easy uploading to Genestack
+
+Copyright (C) 2022 Genome Research Limited
+
+Author: Michael Grace <mg38@sanger.ac.uk>
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+Tests for changing the columns of a sample file
+
+Run from the root of the project:
+    python -m unittest discover tests
+"""
+
+import gzip
+from pathlib import Path
+import tempfile
+import typing as T
+import unittest
+
+from uploader import sample_columns
+
+HEADERS: T.List[str] = ["Sample Source ID", "Sample Source", "Age", "Sex"]
+
+
+class ColumnPlanTest(unittest.TestCase):
+    """the header of the new sample file, and
+    where each of its columns comes from"""
+
+    def test_renamed_kept_then_added(self):
+        """renamed columns come first, then those kept, then those added"""
+        plan = sample_columns.ColumnPlan(
+            HEADERS,
+            [{"old": "Sex", "new": " Gender "}],
+            [{"title": "Tissue", "value": "Blood"}],
+            ["Age"]
+        )
+        self.assertEqual(plan.titles, ["Gender", "Sample Source ID", "Sample Source", "Tissue"])
+        self.assertEqual(
+            plan.columns, [(3, "Gender"), (0, "Sample Source ID"), (1, "Sample Source")])
+        self.assertEqual(
+            plan.transform_row(["S1", "Sanger", "42", "F"]), ["F", "S1", "Sanger", "Blood"])
+
+    def test_short_rows_are_filled_with_blanks(self):
+        """a row with fewer fields than the header gets blanks for the rest"""
+        plan = sample_columns.ColumnPlan(HEADERS, [], [], [])
+        self.assertEqual(plan.transform_row(["S1", "Sanger"]), ["S1", "Sanger", "", ""])
+
+    def test_every_problem_is_reported(self):
+        """every problem is raised at once, not just the first"""
+        with self.assertRaises(sample_columns.ColumnPlanError) as err:
+            sample_columns.ColumnPlan(
+                HEADERS,
+                [{"old": "Height", "new": "Tallness"}, {"old": "Age", "new": ""}],
+                [{"title": "Tissue", "value": ""}],
+                ["Weight"]
+            )
+        self.assertEqual(err.exception.args, (
+            "can't rename Height, it isn't in the sample file",
+            "renamed column not complete: Age -> ?",
+            "added column not complete: Tissue",
+            "can't delete Weight, it isn't in the sample file",
+        ))
+
+    def test_rename_and_delete_the_same_column(self):
+        """a column can't be both renamed and deleted"""
+        with self.assertRaises(sample_columns.ColumnPlanError) as err:
+            sample_columns.ColumnPlan(HEADERS, [{"old": "Age", "new": "Years"}], [], ["Age"])
+        self.assertEqual(err.exception.args, ("can't both rename and delete Age",))
+
+    def test_duplicate_columns(self):
+        """an added column can't have the title of one already there"""
+        with self.assertRaises(sample_columns.ColumnPlanError) as err:
+            sample_columns.ColumnPlan(HEADERS, [], [{"title": "Age", "value": "1"}], [])
+        self.assertEqual(err.exception.args, ("the sample file would have Age more than once",))
+
+    def test_required_columns(self):
+        """the columns Genestack needs can't be deleted"""
+        with self.assertRaises(sample_columns.ColumnPlanError) as err:
+            sample_columns.ColumnPlan(HEADERS, [], [], ["Sample Source"])
+        self.assertEqual(
+            err.exception.args, ("the sample file would be missing the Sample Source column",))
+
+
+class TransformTest(unittest.TestCase):
+    """writing the new sample file"""
+
+    def setUp(self):
+        """a directory for the sample files, removed after each test"""
+        self._dir = tempfile.TemporaryDirectory()  # pylint: disable=consider-using-with
+        self.addCleanup(self._dir.cleanup)
+        self.output = Path(self._dir.name, "transformed.tsv")
+
+    def _transform(self, sample_file: Path, plan: sample_columns.ColumnPlan) -> T.Tuple[int, str]:
+        """transform the sample file, returning how many rows were written, and the new file"""
+        rows = sample_columns.transform(sample_file, plan, self.output)
+        return rows, self.output.read_text(encoding="UTF-8")
+
+    def test_transform(self):
+        """line endings are normalised and blank lines are dropped"""
+        sample_file = Path(self._dir.name, "samples.tsv")
+        sample_file.write_text(
+            "Sample Source ID\tSample Source\tAge\tSex\r\n"
+            "S1\tSanger\t42\tF\r\n"
+            "\r\n"
+            "S2\tSanger\t\tM\r\n",
+            encoding="UTF-8")
+
+        plan = sample_columns.ColumnPlan(
+            sample_columns.read_headers(sample_file),
+            [{"old": "Sex", "new": "Gender"}],
+            [{"title": "Tissue", "value": "Blood"}],
+            ["Age"]
+        )
+        self.assertEqual(self._transform(sample_file, plan), (2, (
+            "Gender\tSample Source ID\tSample Source\tTissue\n"
+            "F\tS1\tSanger\tBlood\n"
+            "M\tS2\tSanger\tBlood\n"
+        )))
+
+    def test_quoted_fields(self):
+        """quoted fields, with tabs, quotes and new lines in them, are kept whole"""
+        sample_file = Path(self._dir.name, "samples.tsv")
+        sample_file.write_text(
+            'Sample Source ID\tSample Source\t"Notes"\n'
+            'S1\tSanger\t"tab\there, ""quotes"" and\na new line"\n',
+            encoding="UTF-8")
+
+        headers = sample_columns.read_headers(sample_file)
+        self.assertEqual(headers, ["Sample Source ID", "Sample Source", "Notes"])
+        plan = sample_columns.ColumnPlan(headers, [{"old": "Notes", "new": "Comment"}], [], [])
+        self.assertEqual(self._transform(sample_file, plan), (1, (
+            "Comment\tSample Source ID\tSample Source\n"
+            '"tab\there, ""quotes"" and\na new line"\tS1\tSanger\n'
+        )))
+
+    def test_compressed(self):
+        """a gzipped sample file is read decompressed"""
+        sample_file = Path(self._dir.name, "samples.tsv.gz")
+        with gzip.open(sample_file, "wt", encoding="UTF-8") as samples:
+            samples.write("Sample Source ID\tSample Source\nS1\tSanger\n")
+
+        plan = sample_columns.ColumnPlan(
+            sample_columns.read_headers(sample_file), [], [{"title": "Age", "value": "42"}], [])
+        self.assertEqual(self._transform(sample_file, plan), (1, (
+            "Sample Source ID\tSample Source\tAge\n"
+            "S1\tSanger\t42\n"
+        )))
+
+
+if __name__ == "__main__":
+    unittest.main()
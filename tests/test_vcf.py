@@ -0,0 +1,89 @@
+"""
+Genestack Uploader
+A HTTP server providing an API and a frontend for easy uploading to Genestack
+
+Copyright (C) 2022 Genome Research Limited
+
+Author: Michael Grace <mg38@sanger.ac.uk>
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+Tests for reading just the header of a VCF
+
+Run from the root of the project:
+    python -m unittest discover tests
+"""
+
+import typing as T
+import unittest
+
+from uploader import vcf
+
+HEADER: bytes = (
+    b"##fileformat=VCFv4.2\n"
+    b"##contig=<ID=1>\n"
+    b"#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\tFORMAT\tS1\tS2\n"
+)
+RECORD: bytes = b"1\t100\t.\tA\tG\t.\tPASS\t.\tGT\t0/1\t1/1\n"
+
+
+def _header_lines(chunks: T.Iterable[bytes]) -> bytes:
+    """the header read from the chunks"""
+    return b"".join(vcf._header_lines(chunks))  # pylint: disable=protected-access
+
+
+def _header(data: bytes, size: int) -> bytes:
+    """the header read from data, streamed in chunks of size bytes"""
+    return _header_lines(data[start:start + size] for start in range(0, len(data), size))
+
+
+class HeaderLinesTest(unittest.TestCase):
+    """finding the end of the header"""
+
+    def test_stops_at_the_chrom_line(self):
+        """the header is read up to the #CHROM line, however it's chunked"""
+        for size in (1, 7, 64, len(HEADER), 1024):
+            with self.subTest(size=size):
+                self.assertEqual(_header(HEADER + RECORD * 100, size), HEADER)
+
+    def test_reads_no_further(self):
+        """no chunks after the one with the #CHROM line are taken"""
+        taken: T.List[bytes] = []
+
+        def chunks() -> T.Iterator[bytes]:
+            """the VCF, noting each chunk taken"""
+            for chunk in (HEADER, RECORD, RECORD):
+                taken.append(chunk)
+                yield chunk
+
+        self.assertEqual(_header_lines(chunks()), HEADER)
+        self.assertEqual(taken, [HEADER])
+
+    def test_chrom_line_without_a_line_ending(self):
+        """a VCF that's only a header can end without a new line"""
+        self.assertEqual(_header(HEADER.rstrip(b"\n"), 10), HEADER)
+
+    def test_records_before_the_chrom_line(self):
+        """a record before the #CHROM line means there isn't one"""
+        with self.assertRaises(vcf.VCFHeaderError):
+            _header(b"##fileformat=VCFv4.2\n" + RECORD, 10)
+
+    def test_no_chrom_line(self):
+        """a VCF that ends before its #CHROM line has no header"""
+        with self.assertRaises(vcf.VCFHeaderError):
+            _header(b"##fileformat=VCFv4.2\n", 10)
+
+
+if __name__ == "__main__":
+    unittest.main()
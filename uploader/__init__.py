@@ -24,20 +24,24 @@ from __future__ import annotations
 
 import datetime
 import enum
-import json
 import logging
 import os
+import signal as os_signal
+import sqlite3
+import sys
+import time
 import typing as T
 import uuid
-from uploader.common import FINISHED_STATUSES, LOG_LEVEL, JobStatus
+from uploader import job_responses, job_store, metrics, s3
+from uploader.common import FINISHED_STATUSES, LOG_LEVEL, JobStatus, WorkerStatus, int_env
 from uploader.signal import new_signal
 
 from uploader.study import new_study
+from uploader.timings import Stage, StageTimings
 
-try:
-    JOB_EXPIRY_HOURS: int = int(os.getenv("JOB_EXPIRY_HOURS", default="168"))
-except ValueError as err:
-    raise ValueError("JOB_EXPIRY_HOURS env variable must be integer") from err
+JOB_EXPIRY_HOURS: int = int_env("JOB_EXPIRY_HOURS", 168)
+JOB_WORKERS: int = int_env("JOB_WORKERS", 1)
+JOB_SWEEP_INTERVAL_SECONDS: int = int_env("JOB_SWEEP_INTERVAL_SECONDS", 600)
 
 
 class InvalidJobStatusProgressionError(Exception):
@@ -70,13 +74,42 @@ class JobType(enum.Enum):
     Signal = new_signal  # pylint: disable=invalid-name
 
 
-_str_to_status: T.Dict[str, JobStatus] = {
-    "QUEUED": JobStatus.Queued,
-    "RUNNING": JobStatus.Running,
-    "COMPLETED": JobStatus.Completed,
-    "FAILED": JobStatus.Failed
+_job_type_names: T.Dict[T.Any, str] = {
+    JobType.Study: "study",
+    JobType.Signal: "signal"
 }
 
+job_types: T.Dict[str, T.Any] = {v: k for k, v in _job_type_names.items()}
+
+# the keys each type of job needs in its body, which
+# we can check before the job is queued
+_required_body_keys: T.Dict[T.Any, T.List[str]] = {
+    JobType.Study: [
+        "template", "Study Source", "Sample File",
+        "renamedColumns", "addedColumns", "deletedColumns"
+    ],
+    JobType.Signal: ["type", "data", "metadata", "linkingattribute"]
+}
+
+
+def validate_body(job_type: JobType, body: T.Any) -> T.List[str]:
+    """check the body of a job has everything
+    the job will need when it runs
+
+    Args:
+        job_type: JobType - the type of job the body is for
+        body: Any - the body of the job, from the API request
+
+    Returns:
+        List[str]: a description of each problem with the body,
+            which is empty if there are none
+    """
+    if not isinstance(body, dict):
+        return ["body must be a JSON object"]
+
+    return [f"missing key: {key}" for key in _required_body_keys[job_type]
+            if key not in body]
+
 
 class GenestackUploadJob:
     """a representaion of an uploading job"""
@@ -94,15 +127,26 @@ class GenestackUploadJob:
         """
         cls.env[key] = val
 
-    def __init__(
+    def __init__(  # pylint: disable=too-many-arguments
         self,
         job_type: JobType,
         token: str,
         body: T.Dict[str, T.Any],
-        study_id: T.Optional[str] = None
+        study_id: T.Optional[str] = None,
+        save: bool = True
     ) -> None:
+        """
+        Args:
+            job_type: JobType - whether the job is for a study or signal
+            token: str - the user's Genestack API token
+            body: Dict[str, Any] - the body of the API request
+            study_id: Optional[str] - the study a signal job is for
+            save: bool - whether to add the job to the job store now.
+                jobs submitted together are saved with save_batch instead
+        """
 
         self._status: JobStatus = JobStatus.Queued
+        self._submit_time: datetime.datetime = datetime.datetime.now()
         self._start_time: T.Optional[datetime.datetime] = None
         self._end_time: T.Optional[datetime.datetime] = None
         self._output: T.Any = None
@@ -116,7 +160,24 @@ class GenestackUploadJob:
 
         self.logger: logging.Logger
 
-        self._write_to_file()
+        metrics.inc("uploader_jobs_submitted_total", type=_job_type_names[job_type])
+
+        if save:
+            self._save()
+
+    @staticmethod
+    def save_batch(batch_id: uuid.UUID, jobs: T.List[GenestackUploadJob]) -> None:
+        """add jobs to the job store as a single batch,
+        in one transaction
+
+        Args:
+            batch_id: UUID - the ID to give the batch
+            jobs: List[GenestackUploadJob] - the jobs, created with save=False
+        """
+        with job_store.transaction():
+            for job in jobs:
+                job._save()  # pylint: disable=protected-access
+            job_store.save_batch(str(batch_id), [str(job.uuid) for job in jobs])
 
     def start(self) -> None:
         """start the job
@@ -134,15 +195,32 @@ class GenestackUploadJob:
 
         self.status = JobStatus.Running
         self._start_time = datetime.datetime.now()
-        self._write_to_file()
+        self._save()
+        metrics.observe(
+            "uploader_job_queue_seconds",
+            (self._start_time - self._submit_time).total_seconds(),
+            type=_job_type_names[self._job_type])
 
         finish_status: JobStatus
+        timings = StageTimings(on_finish=self._save_stage)
         finish_status, output = self._job_type(  # type: ignore
-            self._token, self._body, self.logger, self.__class__.env, self._study_id)
+            self._token, self._body, self.logger, self.__class__.env, self._study_id, timings)
 
         self.logger.info(f"job done: {finish_status.value}: {output}")
         self.finish(finish_status, output)
 
+    def _save_stage(self, position: int, stage: Stage) -> None:
+        """write how long a stage of the job took to
+        the job store, as soon as the stage finishes
+
+        Args:
+            position: int - the order the stage ran in
+            stage: Stage - the stage's name, seconds and bytes
+        """
+        self.logger.info(f"stage {stage['name']} took {stage['seconds']}s")
+        job_store.save_stage(str(self._uuid), position, stage)
+        metrics.observe("uploader_job_stage_seconds", stage["seconds"], stage=stage["name"])
+
     def finish(self, state: JobStatus, output: T.Any) -> None:
         """update the internal states of the job when it
         finishes
@@ -154,7 +232,19 @@ class GenestackUploadJob:
         self.status = state
         self._output = output
         self._end_time = datetime.datetime.now()
-        self._write_to_file()
+        self._save()
+
+        job_type = _job_type_names[self._job_type]
+        # failed jobs are counted by the category of error from job_responses
+        reason: str = output.get("error", "") \
+            if state == JobStatus.Failed and isinstance(output, dict) else ""
+        metrics.inc("uploader_jobs_finished_total",
+                    type=job_type, status=state.value, reason=reason)
+        if self._start_time:
+            metrics.observe(
+                "uploader_job_duration_seconds",
+                (self._end_time - self._start_time).total_seconds(),
+                type=job_type, status=state.value)
 
     @property
     def uuid(self) -> uuid.UUID:
@@ -232,62 +322,163 @@ class GenestackUploadJob:
 
         return data
 
-    def _write_to_file(self):
-        """write the job's information to the file
-        .jobs/{uuid} as JSON"""
-        try:
-            with open(f".jobs/{self._uuid}", "w", encoding="utf-8") as out_file:
-                out_file.write(json.dumps(self.dict))
-        except FileNotFoundError:
-            os.mkdir(".jobs")
-            self._write_to_file()
+    def _save(self):
+        """write the job's information to the job store"""
+        job_store.save_job(
+            str(self._uuid),
+            _job_type_names[self._job_type],
+            self._study_id,
+            self._status.value,
+            self._submit_time,
+            self._start_time,
+            self._end_time,
+            self._output
+        )
 
     @property
     def json(self) -> T.Dict[str, T.Any]:
         """read the job's information from the
-        file written using _write_to_file
+        job store, as written using _save
 
         Returns: Dict[str, Any]
 
+        Raises:
+            KeyError: if the job isn't in the store,
+                which happens once it has expired
+
         This method is preferred over `dict`
-        as it reads from the file, so will work
+        as it reads from the store, so will work
         across objects, so long as they have the
         same UUID"""
-        with open(f".jobs/{self._uuid}", encoding="utf-8") as in_file:
-            return json.loads(in_file.read())
+        data = job_store.get_job(str(self._uuid))
+        if data is None:
+            raise KeyError(self._uuid)
+        return data
 
-    @property
-    def expired(self) -> bool:
-        """read from the jobs JSON and see if
-        the job finished more than a week ago.
-        if so, return True and delete the job
-        file
-
-        Returns:
-            bool: did the job finish more than a week ago
-        """
-        data: T.Dict[str, T.Any] = self.json
-        self._status = _str_to_status[data["status"]]
-        if self.status in FINISHED_STATUSES:
-            self._end_time = datetime.datetime.fromisoformat(data["endTime"])
-            if datetime.datetime.now() - self.end_time > datetime.timedelta(hours=JOB_EXPIRY_HOURS):
-                os.remove(f".jobs/{self._uuid}")
-                return True
 
-        return False
+def expiry_sweeper(interval: int = JOB_SWEEP_INTERVAL_SECONDS) -> None:
+    """expiry_sweeper runs a loop, every interval
+    seconds removing all the jobs from the store that
+    finished more than JOB_EXPIRY_HOURS ago
+
+    Args:
+        interval: int - seconds to wait between sweeps
+
+    Note: this never returns, so should be run
+    in its own thread
+    """
+    logger = logging.getLogger("expiry-sweeper")
+    logger.setLevel(LOG_LEVEL)
+
+    while True:
+        cutoff = datetime.datetime.now() - datetime.timedelta(hours=JOB_EXPIRY_HOURS)
+        try:
+            removed = job_store.delete_expired(cutoff)
+            job_store.delete_orphaned_batch_jobs()
+            logger.info(f"removed {removed} expired job(s)")
+        except sqlite3.Error as sweep_err:
+            # we'll get them next time round
+            logger.exception(sweep_err)
+
+        time.sleep(interval)
+
+
+def _write_worker_state(
+    worker_id: int,
+    status: WorkerStatus,
+    jobs_done: int,
+    job_uuid: T.Optional[uuid.UUID] = None
+) -> None:
+    """write the worker's current state to the job store
+
+    Args:
+        worker_id: int - the index of the worker in the pool
+        status: WorkerStatus - whether the worker is idle or busy
+        jobs_done: int - how many jobs the worker has finished
+        job_uuid: Optional[UUID] - the job the worker is running, if any
+    """
+    job_store.save_worker(
+        worker_id, status.value, jobs_done, str(job_uuid) if job_uuid else None)
+
+
+def reset_worker_states() -> None:
+    """remove the states left over from any
+    previous pool of workers, so we only report on
+    the workers we're about to start"""
+    job_store.delete_workers()
 
 
-def job_handler(jobs_queue: multiprocessing.Queue[GenestackUploadJob]) -> None:  # pylint: disable=undefined-variable
+def fail_interrupted_jobs() -> int:
+    """fail the jobs left queued or running by a previous
+    run of the server - the queue doesn't survive a restart,
+    so nothing would ever pick them up or finish them
+
+    Returns:
+        int: how many jobs were failed
+    """
+    status, output = job_responses.INTERRUPTED
+    return job_store.fail_unfinished(
+        (JobStatus.Queued.value, JobStatus.Running.value), status.value, output)
+
+
+def worker_states() -> T.List[T.Dict[str, T.Any]]:
+    """read the state of every worker in the pool
+
+    Returns:
+        List[Dict[str, Any]]: the state recorded by each worker,
+            ordered by worker ID, for example:
+            [{"worker": 0, "pid": 12, "status": "BUSY",
+              "job": "...", "since": "...", "jobsDone": 3}]
+    """
+    return job_store.get_workers()
+
+
+def job_handler(
+    jobs_queue: multiprocessing.Queue[GenestackUploadJob],  # pylint: disable=undefined-variable
+    worker_id: int = 0
+) -> None:
     """job_handler runs a loop to block
     until it gets a job on the queue, then
     starts that job
 
     Args:
         jobs_queue: multiprocessing.Queue[GenestackUploadJob]
+        worker_id: int - the index of this worker in the pool,
+            used when reporting the worker's state
 
     Note: this waits for the current job to finish
-    before starting the next
+    before starting the next, so run several of these
+    (see JOB_WORKERS) to run jobs concurrently
     """
-    while True:
-        job = jobs_queue.get(block=True)
-        job.start()
+    logger = logging.getLogger(f"worker-{worker_id}")
+    logger.setLevel(LOG_LEVEL)
+    logger.info(f"worker started in process {os.getpid()}")
+
+    # being stopped unwinds the worker, so the S3
+    # public policy can be closed on the way out
+    os_signal.signal(os_signal.SIGTERM, lambda *_: sys.exit(0))
+
+    jobs_done: int = 0
+    try:
+        while True:
+            _write_worker_state(worker_id, WorkerStatus.Idle, jobs_done)
+            job = jobs_queue.get(block=True)
+            _write_worker_state(worker_id, WorkerStatus.Busy, jobs_done, job.uuid)
+
+            try:
+                job.start()
+            except Exception as job_err:  # pylint: disable=broad-except
+                # one bad job shouldn't take the worker down with it
+                logger.error(f"job {job.uuid} raised an error")
+                logger.exception(job_err)
+                if job.status == JobStatus.Running:
+                    job.finish(*job_responses.other_error(job_err))
+
+            jobs_done += 1
+    finally:
+        # any linger timer this worker started dies with it
+        logger.info("worker stopping")
+        if "s3_bucket" in GenestackUploadJob.env:
+            s3.close_public_policy(GenestackUploadJob.env["s3_bucket"])
+        # multiprocessing doesn't run atexit in the workers
+        metrics.flush()
@@ -0,0 +1,183 @@
+"""
+Genestack Uploader
+A HTTP server providing an API and a frontend for easy uploading to Genestack
+
+Copyright (C) 2022 Genome Research Limited
+
+Author: Michael Grace <mg38@sanger.ac.uk>
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+import contextlib
+import datetime
+import json
+import os
+import sqlite3
+import threading
+import typing as T
+
+# Column presets never expire, unlike jobs, so they're kept in their own
+# SQLite database rather than the job store, which can be thrown away
+# (and isn't on a volume by default). COLUMN_PRESETS_PATH needs to be
+# somewhere that lasts, such as the configs volume in Docker.
+# Each preset belongs to the Genestack user who saved it (as from
+# upstream.current_user), and only they can change or delete it.
+COLUMN_PRESETS_PATH: str = os.getenv("COLUMN_PRESETS_PATH", default=".column_presets.db")
+
+_SCHEMA: str = """
+CREATE TABLE IF NOT EXISTS column_presets (
+    template TEXT NOT NULL,
+    name TEXT NOT NULL,
+    owner TEXT NOT NULL,
+    columns TEXT NOT NULL,
+    updated REAL NOT NULL,
+    PRIMARY KEY (template, name)
+);
+"""
+
+_BUSY_TIMEOUT_SECONDS: int = 30
+
+_local = threading.local()
+
+
+class NotPresetOwnerError(PermissionError):
+    """when a column preset is changed by
+    anyone but whoever saved it"""
+
+
+def _connection() -> sqlite3.Connection:
+    """get this thread's connection to the presets
+    database, opening it (and creating the table) if needed,
+    as with job_store.connection"""
+    conn: T.Optional[sqlite3.Connection] = getattr(_local, "conn", None)
+    if conn is not None and getattr(_local, "pid", None) == os.getpid():
+        return conn
+
+    conn = sqlite3.connect(
+        COLUMN_PRESETS_PATH,
+        timeout=_BUSY_TIMEOUT_SECONDS,
+        isolation_level=None
+    )
+    conn.row_factory = sqlite3.Row
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.executescript(_SCHEMA)
+
+    _local.conn = conn
+    _local.pid = os.getpid()
+    return conn
+
+
+@contextlib.contextmanager
+def _transaction() -> T.Iterator[sqlite3.Connection]:
+    conn = _connection()
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        yield conn
+    except BaseException:
+        conn.execute("ROLLBACK")
+        raise
+    conn.execute("COMMIT")
+
+
+def _check_owner(conn: sqlite3.Connection, template: str, name: str, owner: str) -> bool:
+    """whether there's a preset of this name
+
+    Raises:
+        NotPresetOwnerError: if there is, but someone else saved it
+    """
+    row = conn.execute(
+        "SELECT owner FROM column_presets WHERE template = ? AND name = ?",
+        (template, name)
+    ).fetchone()
+    if row is not None and row["owner"] != owner:
+        raise NotPresetOwnerError(f"column preset {name} of template {template} isn't yours")
+    return row is not None
+
+
+def save_preset(template: str, name: str, owner: str, columns: T.Dict[str, T.Any]) -> None:
+    """save the columns to rename, add and delete as a named
+    preset for a template, replacing any preset of that name
+
+    Args:
+        template: str - the template's accession
+        name: str - the preset's name
+        owner: str - the Genestack user saving it
+        columns: Dict[str, Any] - the renamedColumns,
+            addedColumns and deletedColumns
+
+    Raises:
+        NotPresetOwnerError: if someone else saved the preset being replaced
+    """
+    with _transaction() as conn:
+        _check_owner(conn, template, name, owner)
+        conn.execute(
+            """INSERT OR REPLACE INTO column_presets (
+                template, name, owner, columns, updated
+            ) VALUES (?, ?, ?, ?, ?)""",
+            (template, name, owner, json.dumps(columns), datetime.datetime.now().timestamp())
+        )
+
+
+def _preset_dict(row: sqlite3.Row) -> T.Dict[str, T.Any]:
+        return {
+        "name": row["name"],
+        "updated": datetime.datetime.fromtimestamp(row["updated"]).isoformat(),
+        **json.loads(row["columns"])
+    }
+
+
+def get_preset(template: str, name: str) -> T.Optional[T.Dict[str, T.Any]]:
+    """get a template's column preset by its name
+
+    Returns:
+        Optional[Dict[str, Any]]: for example
+            {"name": "...", "updated": "...", "renamedColumns": [...],
+             "addedColumns": [...], "deletedColumns": [...]}
+            or None if there's no such preset
+    """
+    row = _connection().execute(
+        "SELECT * FROM column_presets WHERE template = ? AND name = ?",
+        (template, name)
+    ).fetchone()
+    return _preset_dict(row) if row is not None else None
+
+
+def get_presets(template: str) -> T.List[T.Dict[str, T.Any]]:
+    """get every column preset for a template, by name,
+    each as from get_preset"""
+    return [_preset_dict(row) for row in _connection().execute(
+        "SELECT * FROM column_presets WHERE template = ? ORDER BY name", (template,))]
+
+
+def delete_preset(template: str, name: str, owner: str) -> bool:
+    """remove a template's column preset
+
+    Args:
+        template: str - the template's accession
+        name: str - the preset's name
+        owner: str - the Genestack user deleting it
+
+    Returns:
+        bool: whether there was a preset to remove
+
+    Raises:
+        NotPresetOwnerError: if someone else saved the preset
+    """
+    with _transaction() as conn:
+        if not _check_owner(conn, template, name, owner):
+            return False
+        conn.execute(
+            "DELETE FROM column_presets WHERE template = ? AND name = ?", (template, name))
+        return True
@@ -22,6 +22,7 @@ along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
 import enum
 import logging
+import math
 import os
 import typing as T
 
@@ -38,6 +39,41 @@ _str_to_log: T.Dict[str, LogLevel] = {
 LOG_LEVEL: LogLevel = _str_to_log[os.getenv("LOG_LEVEL", default="INFO")]
 
 
+def int_env(name: str, default: int, minimum: int = 1) -> int:
+    """read an integer setting from the env variable name,
+    or use default if it isn't set
+
+    Raises:
+        ValueError: if it's set, but not to an integer
+            of at least minimum
+    """
+    try:
+        value = int(os.getenv(name, default=str(default)))
+    except ValueError as err:
+        raise ValueError(f"{name} env variable must be integer") from err
+    if value < minimum:
+        raise ValueError(f"{name} env variable must be at least {minimum}")
+    return value
+
+
+def float_env(name: str, default: float, minimum: float = 0, allow_minimum: bool = False) -> float:
+    """read a number setting from the env variable name,
+    or use default if it isn't set
+
+    Raises:
+        ValueError: if it's set, but not to a finite number more
+            than minimum (or equal to it, if allow_minimum)
+    """
+    try:
+        value = float(os.getenv(name, default=str(default)))
+    except ValueError as err:
+        raise ValueError(f"{name} env variable must be a number") from err
+    if not math.isfinite(value) or value < minimum or (value == minimum and not allow_minimum):
+        raise ValueError(
+            f"{name} env variable must be {'at least' if allow_minimum else 'more than'} {minimum}")
+    return value
+
+
 class JobStatus(enum.Enum):
     """JobStatus is an enum of the
     various states a job can be in,
@@ -50,3 +86,12 @@ class JobStatus(enum.Enum):
 
 
 FINISHED_STATUSES: T.Set[JobStatus] = {JobStatus.Failed, JobStatus.Completed}
+
+
+class WorkerStatus(enum.Enum):
+    """WorkerStatus is an enum of the
+    states a job worker can be in, either
+    waiting for a job or running one"""
+
+    Idle = "IDLE"  # pylint: disable=invalid-name
+    Busy = "BUSY"  # pylint: disable=invalid-name
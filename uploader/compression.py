@@ -0,0 +1,176 @@
+"""
+Genestack Uploader
+A HTTP server providing an API and a frontend for easy uploading to Genestack
+
+Copyright (C) 2022 Genome Research Limited
+
+Author: Michael Grace <mg38@sanger.ac.uk>
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+import contextlib
+import enum
+import gzip
+import io
+import os
+import shutil
+import typing as T
+import zlib
+
+import zstandard
+
+# how much is decompressed at a time when streaming
+_BLOCK_BYTES: int = 64 * 1024
+
+
+class Compression(enum.Enum):
+    """how a file in the bucket is compressed. bgzip
+    is gzip, in many members one after another"""
+    NONE = "none"
+    GZIP = "gzip"
+    ZSTD = "zstd"
+
+
+_MAGIC_BYTES: T.Dict[Compression, bytes] = {
+    Compression.GZIP: b"\x1f\x8b",
+    Compression.ZSTD: b"\x28\xb5\x2f\xfd",
+}
+MAGIC_LENGTH: int = max(len(magic) for magic in _MAGIC_BYTES.values())
+
+# what's raised reading a compressed file that's corrupt, or cut short
+DECOMPRESSION_ERRORS: T.Tuple[T.Type[Exception], ...] = (
+    EOFError, gzip.BadGzipFile, zlib.error, zstandard.ZstdError)
+
+_EXTENSIONS: T.Dict[str, Compression] = {
+    ".gz": Compression.GZIP,
+    ".bgz": Compression.GZIP,
+    ".zst": Compression.ZSTD,
+}
+
+
+def detect(start: bytes, name: str = "") -> Compression:
+    """tell how a file is compressed from its first bytes, or, if
+    there aren't enough of them to tell, the extension of its name
+
+    Args:
+        start: bytes - the start of the file, at least MAGIC_LENGTH
+            bytes of it, unless the file's shorter
+        name: str - the file's name, or key in the bucket
+    """
+    for compression, magic in _MAGIC_BYTES.items():
+        if start.startswith(magic):
+            return compression
+    if len(start) >= MAGIC_LENGTH:
+        return Compression.NONE
+    return _EXTENSIONS.get(os.path.splitext(name)[1].lower(), Compression.NONE)
+
+
+def detect_file(path: T.Union[str, os.PathLike]) -> Compression:
+    """tell how a local file is compressed"""
+    with open(path, "rb") as file:
+        return detect(file.read(MAGIC_LENGTH), str(path))
+
+
+def decompressed_name(name: str) -> str:
+    """the name of a file once it's decompressed,
+    without any compression extension"""
+    root, extension = os.path.splitext(name)
+    return root if extension.lower() in _EXTENSIONS else name
+
+
+def _reader(raw: T.BinaryIO, compression: Compression) -> T.BinaryIO:
+    """a file object reading raw decompressed, a block at a time"""
+    if compression == Compression.GZIP:
+        return T.cast(T.BinaryIO, gzip.GzipFile(fileobj=raw, mode="rb"))
+    if compression == Compression.ZSTD:
+        return T.cast(T.BinaryIO, zstandard.ZstdDecompressor().stream_reader(
+            raw, read_size=_BLOCK_BYTES, read_across_frames=True))
+    return raw
+
+
+class _ChunkReader(io.RawIOBase):
+    """a file object reading from an iterator of chunks, such as the
+    chunks of an object streamed from S3, so the decompressors can
+    read from it, and only take the chunks they need"""
+
+    def __init__(self, chunks: T.Iterable[bytes]) -> None:
+        super().__init__()
+        self._chunks = iter(chunks)
+        self._pending = b""
+
+    def readable(self) -> bool:
+        return True
+
+    def readinto(self, buffer: T.Any) -> int:
+        while not self._pending:
+            chunk = next(self._chunks, None)
+            if chunk is None:
+                return 0
+            self._pending = chunk
+
+        size = min(len(buffer), len(self._pending))
+        buffer[:size] = self._pending[:size]
+        self._pending = self._pending[size:]
+        return size
+
+
+def decompress(chunks: T.Iterable[bytes], name: str = "") -> T.Iterator[bytes]:
+    """decompress a file as its chunks arrive, however it's compressed,
+    taking no more chunks than are needed for what's been read
+
+    Args:
+        chunks: Iterable[bytes] - the file, a chunk at a time
+        name: str - the file's name, or key in the bucket,
+            for telling how it's compressed if it's very short
+
+    Yields:
+        bytes: the file decompressed, a block at a time
+    """
+    raw = io.BufferedReader(_ChunkReader(chunks), _BLOCK_BYTES)
+    compression = detect(raw.peek(MAGIC_LENGTH)[:MAGIC_LENGTH], name)
+    with _reader(raw, compression) as reader:
+        while True:
+            block = reader.read(_BLOCK_BYTES)
+            if not block:
+                return
+            yield block
+
+
+@contextlib.contextmanager
+def open_text(path: T.Union[str, os.PathLike]) -> T.Iterator[T.TextIO]:
+    """open a local file as UTF-8 text, decompressing
+    it as it's read, however it's compressed
+
+    Yields:
+        TextIO: with line endings passed through as they are
+    """
+    with open(path, "rb") as raw:
+        compression = detect(raw.read(MAGIC_LENGTH), str(path))
+        raw.seek(0)
+        with _reader(raw, compression) as reader, \
+                io.TextIOWrapper(reader, encoding="UTF-8", newline="") as text:
+            yield text
+
+
+def decompress_file(
+    source: T.Union[str, os.PathLike],
+    destination: T.Union[str, os.PathLike]
+) -> None:
+    """write a local file decompressed to destination, a block at a time"""
+    with open(source, "rb") as raw:
+        compression = detect(raw.read(MAGIC_LENGTH), str(source))
+        raw.seek(0)
+        with _reader(raw, compression) as reader, open(destination, "wb") as output:
+            shutil.copyfileobj(reader, output, _BLOCK_BYTES)
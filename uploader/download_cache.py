@@ -0,0 +1,190 @@
+"""
+Genestack Uploader
+A HTTP server providing an API and a frontend for easy uploading to Genestack
+
+Copyright (C) 2022 Genome Research Limited
+
+Author: Michael Grace <mg38@sanger.ac.uk>
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+import hashlib
+import logging
+import os
+import shutil
+import typing as T
+
+import botocore
+from uploadtogenestack import S3BucketUtils
+
+from uploader import metrics, s3
+from uploader.common import LOG_LEVEL, float_env
+
+DOWNLOAD_CACHE_DIR: str = os.getenv(
+    "DOWNLOAD_CACHE_DIR", default="/tmp/genestack-uploader-cache")
+
+DOWNLOAD_CACHE_MAX_GB: float = float_env("DOWNLOAD_CACHE_MAX_GB", 50)
+
+_PARTIAL_SUFFIX: str = ".part"
+
+
+class DownloadCache:  # pylint: disable=too-few-public-methods
+    """
+        A bounded, on-disk cache of files downloaded
+        from the S3 bucket
+
+        Files are stored by a hash of their bucket, key and ETag,
+        so a file that's changed in the bucket is downloaded again,
+        but one that hasn't only costs a HEAD request. When the cache
+        is bigger than max_bytes, the least recently used files are
+        removed. The cache directory is shared by all the job workers.
+
+        Files are given to the caller as hard links (or copies, if
+        the destination is on another filesystem), so the caller can
+        delete its file without affecting the cache, but mustn't
+        change it in place
+    """
+
+    def __init__(self, directory: str, max_bytes: int) -> None:
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.logger = logging.getLogger(self.__class__.__name__)
+        self.logger.setLevel(LOG_LEVEL)
+
+    def download_file(
+        self,
+        s3_bucket: S3BucketUtils,
+        bucket_name: str,
+        key: str,
+        destination: T.Union[str, os.PathLike]
+    ) -> None:
+        """put the file at key in the bucket at destination,
+        from the cache if we have it
+
+        Args:
+            s3_bucket: S3BucketUtils - used to download files
+                that aren't in the cache
+            bucket_name: str - the name of the bucket
+            key: str - the key of the file in the bucket
+            destination: str | PathLike - where to put the file
+
+        Raises:
+            anything s3_bucket.download_file raises, such
+            as botocore.exceptions.ClientError
+        """
+        try:
+            head = s3.s3_client().head_object(Bucket=bucket_name, Key=key)
+        except (
+            botocore.exceptions.BotoCoreError,
+            botocore.exceptions.ClientError,
+            KeyError
+        ) as head_err:
+            # without an ETag, we can't know if a cached copy is still
+            # right, so skip the cache, and let the download report errors
+            self.logger.warning(
+                f"can't check {key} for the cache, downloading it: {head_err!r}")
+            s3_bucket.download_file(key, destination)
+            return
+
+        if head["ContentLength"] > self.max_bytes:
+            self.logger.info(f"{key} is too big for the cache, downloading it")
+            s3_bucket.download_file(key, destination)
+            return
+
+        cached = os.path.join(
+            self.directory,
+            hashlib.sha256(f"{bucket_name}/{key}\0{head['ETag']}".encode()).hexdigest()
+        )
+
+        try:
+            # the modified time is used as the last used time
+            os.utime(cached)
+            self._link(cached, destination)
+            self.logger.info(f"{key} found in the cache")
+            metrics.inc("uploader_download_cache_requests_total", result="hit")
+            metrics.inc("uploader_download_cache_hit_bytes_total", head["ContentLength"])
+            return
+        except FileNotFoundError:
+            pass
+
+        self.logger.info(f"{key} not in the cache, downloading it")
+        metrics.inc("uploader_download_cache_requests_total", result="miss")
+
+        os.makedirs(self.directory, exist_ok=True)
+        # each process downloads to its own partial file, then moves it into
+        # place in one go, so no one ever sees a half downloaded file
+        partial = f"{cached}.{os.getpid()}{_PARTIAL_SUFFIX}"
+        try:
+            s3_bucket.download_file(key, partial)
+            os.replace(partial, cached)
+        finally:
+            if os.path.exists(partial):
+                os.remove(partial)
+
+        self._evict()
+        try:
+            self._link(cached, destination)
+        except FileNotFoundError:
+            # another worker's eviction got there first
+            s3_bucket.download_file(key, destination)
+
+    @staticmethod
+    def _link(cached: str, destination: T.Union[str, os.PathLike]) -> None:
+        """hard link the cached file to destination,
+        copying it if they're on different filesystems
+
+        Raises:
+            FileNotFoundError: if the file isn't cached
+        """
+        if os.path.exists(destination):
+            os.remove(destination)
+
+        try:
+            os.link(cached, destination)
+        except FileNotFoundError:
+            raise
+        except OSError:
+            shutil.copyfile(cached, destination)
+
+    def _evict(self) -> None:
+        """remove the least recently used files until
+        the cache is within max_bytes"""
+        entries: T.List[T.Tuple[float, int, str]] = []
+        with os.scandir(self.directory) as scan:
+            for entry in scan:
+                if entry.name.endswith(_PARTIAL_SUFFIX):
+                    continue
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    # another worker evicted it
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+
+            self.logger.info(f"evicting {path} from the cache")
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+            metrics.inc("uploader_download_cache_evictions_total")
+
+
+cache = DownloadCache(DOWNLOAD_CACHE_DIR, int(DOWNLOAD_CACHE_MAX_GB * 1024 ** 3))
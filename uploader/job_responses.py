@@ -30,6 +30,9 @@ INVALID_BODY: JobResponse = JobStatus.Failed, {"error": "no valid json body"}
 FORBIDDEN: JobResponse = JobStatus.Failed, {"error": "forbidden"}
 S3_PERMISSION_DENIED: JobResponse = JobStatus.Failed, {
     "error": "S3 bucket permission denied"}
+INTERRUPTED: JobResponse = JobStatus.Failed, {
+    "error": "interrupted",
+    "detail": ["the server restarted before the job finished"]}
 
 
 def bad_request_error(err: Exception) -> JobResponse:
@@ -0,0 +1,635 @@
+"""
+Genestack Uploader
+A HTTP server providing an API and a frontend for easy uploading to Genestack
+
+Copyright (C) 2022 Genome Research Limited
+
+Author: Michael Grace <mg38@sanger.ac.uk>
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+import asyncio
+import contextlib
+import datetime
+import json
+import math
+import os
+import sqlite3
+import threading
+import time
+import typing as T
+
+JOB_STORE_PATH: str = os.getenv("JOB_STORE_PATH", default=".jobs.db")
+
+# The job store is a single SQLite database shared by the API process
+# and all the job workers. In WAL mode, readers don't block the writer
+# (and vice versa), and SQLite itself serialises the writers across
+# processes, waiting up to the busy timeout for the lock.
+_SCHEMA: str = """
+CREATE TABLE IF NOT EXISTS jobs (
+    uuid TEXT PRIMARY KEY,
+    job_type TEXT NOT NULL,
+    study_id TEXT,
+    status TEXT NOT NULL,
+    submit_time REAL NOT NULL,
+    start_time REAL,
+    end_time REAL,
+    output TEXT
+);
+CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status);
+CREATE INDEX IF NOT EXISTS jobs_end_time ON jobs (end_time);
+CREATE INDEX IF NOT EXISTS jobs_submit_time ON jobs (submit_time);
+CREATE INDEX IF NOT EXISTS jobs_study_id ON jobs (study_id);
+
+CREATE TABLE IF NOT EXISTS workers (
+    worker_id INTEGER PRIMARY KEY,
+    pid INTEGER NOT NULL,
+    status TEXT NOT NULL,
+    job TEXT,
+    since REAL NOT NULL,
+    jobs_done INTEGER NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS job_stages (
+    job_uuid TEXT NOT NULL,
+    position INTEGER NOT NULL,
+    name TEXT NOT NULL,
+    seconds REAL NOT NULL,
+    bytes INTEGER,
+    PRIMARY KEY (job_uuid, position)
+);
+
+CREATE TABLE IF NOT EXISTS metrics (
+    name TEXT NOT NULL,
+    labels TEXT NOT NULL,
+    value REAL NOT NULL,
+    PRIMARY KEY (name, labels)
+);
+
+CREATE TABLE IF NOT EXISTS batch_jobs (
+    batch_id TEXT NOT NULL,
+    job_uuid TEXT NOT NULL,
+    PRIMARY KEY (batch_id, job_uuid)
+);
+
+CREATE TABLE IF NOT EXISTS cache_generations (
+    name TEXT PRIMARY KEY,
+    generation INTEGER NOT NULL
+);
+
+"""
+
+_BUSY_TIMEOUT_SECONDS: int = 30
+
+# how often to check the store for a status change when waiting on a job.
+# each check is a single primary key lookup, so this can be kept short
+_WAIT_POLL_SECONDS: float = 0.25
+
+_local = threading.local()
+
+
+def connection() -> sqlite3.Connection:
+    """get this thread's connection to the job store,
+    opening it (and creating the tables) if needed
+
+    SQLite connections can't be shared between threads,
+    or survive being forked into another process, so
+    each thread in each process gets its own
+
+    Returns:
+        sqlite3.Connection: in autocommit mode, with rows
+            returned as sqlite3.Row
+    """
+    conn: T.Optional[sqlite3.Connection] = getattr(_local, "conn", None)
+    if conn is not None and getattr(_local, "pid", None) == os.getpid():
+        return conn
+
+    conn = sqlite3.connect(
+        JOB_STORE_PATH,
+        timeout=_BUSY_TIMEOUT_SECONDS,
+        isolation_level=None
+    )
+    conn.row_factory = sqlite3.Row
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.executescript(_SCHEMA)
+
+    _local.conn = conn
+    _local.pid = os.getpid()
+    return conn
+
+
+@contextlib.contextmanager
+def transaction() -> T.Iterator[sqlite3.Connection]:
+    """context manager to make all the writes to the
+    store within it in a single transaction, which is
+    rolled back if an exception is raised
+
+    Yields:
+        sqlite3.Connection: this thread's connection
+    """
+    conn = connection()
+    # IMMEDIATE takes the write lock now, rather than on the first
+    # write, so we can't fail part way through on a busy database
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        yield conn
+    except BaseException:
+        conn.execute("ROLLBACK")
+        raise
+    conn.execute("COMMIT")
+
+
+def _timestamp(when: T.Optional[datetime.datetime]) -> T.Optional[float]:
+    return when.timestamp() if when else None
+
+
+def _isoformat(timestamp: T.Optional[float]) -> T.Optional[str]:
+    if timestamp is None:
+        return None
+    return datetime.datetime.fromtimestamp(timestamp).isoformat()
+
+
+def save_job(  # pylint: disable=too-many-arguments
+    job_uuid: str,
+    job_type: str,
+    study_id: T.Optional[str],
+    status: str,
+    submit_time: datetime.datetime,
+    start_time: T.Optional[datetime.datetime],
+    end_time: T.Optional[datetime.datetime],
+    output: T.Any
+) -> None:
+    """insert the job into the store, or update
+    it if it's already there
+
+    Args:
+        job_uuid: str - the job's UUID
+        job_type: str - "study" or "signal"
+        study_id: Optional[str] - the study a signal job is for
+        status: str - the JobStatus value
+        submit_time: datetime - when the job was queued
+        start_time: Optional[datetime] - when the job started running
+        end_time: Optional[datetime] - when the job finished
+        output: Any - the job's output for the user, must be JSON serialisable
+    """
+    connection().execute(
+        """INSERT INTO jobs (
+            uuid, job_type, study_id, status,
+            submit_time, start_time, end_time, output
+        ) VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+        ON CONFLICT (uuid) DO UPDATE SET
+            status = excluded.status,
+            start_time = excluded.start_time,
+            end_time = excluded.end_time,
+            output = excluded.output""",
+        (
+            job_uuid, job_type, study_id, status,
+            submit_time.timestamp(), _timestamp(start_time), _timestamp(end_time),
+            json.dumps(output)
+        )
+    )
+
+
+def _job_dict(row: sqlite3.Row) -> T.Dict[str, T.Any]:
+    """convert a row from the jobs table to the
+    JSON we return to the user about the job"""
+    data: T.Dict[str, T.Any] = {
+        "status": row["status"]
+    }
+
+    if row["start_time"] is not None:
+        data["startTime"] = _isoformat(row["start_time"])
+
+    if row["end_time"] is not None:
+        data["endTime"] = _isoformat(row["end_time"])
+        data["output"] = json.loads(row["output"])
+
+    return data
+
+
+def get_job(job_uuid: str) -> T.Optional[T.Dict[str, T.Any]]:
+    """look up a single job by its UUID
+
+    Args:
+        job_uuid: str - the job's UUID
+
+    Returns:
+        Optional[Dict[str, Any]]: the job's information, for example
+            {"status": "COMPLETED", "startTime": "...", "endTime": "...",
+             "output": {"studyAccession": "GSF000001"}}
+            or None if there's no such job
+    """
+    row = connection().execute(
+        "SELECT * FROM jobs WHERE uuid = ?", (job_uuid,)).fetchone()
+    if row is None:
+        return None
+
+    data = _job_dict(row)
+    data["stages"] = get_stages(job_uuid)
+    return data
+
+
+def save_stage(job_uuid: str, position: int, stage: T.Dict[str, T.Any]) -> None:
+    """record how long one stage of a job took
+
+    Args:
+        job_uuid: str - the job's UUID
+        position: int - the order the stage ran in
+        stage: Dict[str, Any] - the stage's name, seconds and bytes,
+            for example {"name": "download", "seconds": 1.5, "bytes": 1024}
+    """
+    connection().execute(
+        """INSERT OR REPLACE INTO job_stages (
+            job_uuid, position, name, seconds, bytes
+        ) VALUES (?, ?, ?, ?, ?)""",
+        (job_uuid, position, stage["name"], stage["seconds"], stage["bytes"])
+    )
+
+
+def get_stages(job_uuid: str) -> T.List[T.Dict[str, T.Any]]:
+    """get how long each stage of a job took, in the
+    order they ran
+
+    Args:
+        job_uuid: str - the job's UUID
+
+    Returns:
+        List[Dict[str, Any]]: for example
+            [{"name": "download", "seconds": 1.5, "bytes": 1024}]
+    """
+    return [{
+        "name": row["name"],
+        "seconds": row["seconds"],
+        "bytes": row["bytes"]
+    } for row in connection().execute(
+        "SELECT * FROM job_stages WHERE job_uuid = ? ORDER BY position", (job_uuid,))]
+
+
+def find_jobs(  # pylint: disable=too-many-arguments
+    job_uuids: T.Optional[T.List[str]] = None,
+    status: T.Optional[str] = None,
+    job_type: T.Optional[str] = None,
+    since: T.Optional[datetime.datetime] = None,
+    limit: int = 1000
+) -> T.List[T.Dict[str, T.Any]]:
+    """find all the jobs matching every filter given,
+    in a single query
+
+    Args:
+        job_uuids: Optional[List[str]] - only these jobs
+        status: Optional[str] - only jobs with this JobStatus value
+        job_type: Optional[str] - only "study" or "signal" jobs
+        since: Optional[datetime] - only jobs submitted at or after this
+        limit: int - the most jobs to return, newest first
+
+    Returns:
+        List[Dict[str, Any]]: the information for each job, as from
+            get_job, with its ID, type and submit time added, for example
+            [{"jobId": "...", "type": "signal", "studyAccession": "GSF000001",
+              "submitTime": "...", "status": "QUEUED"}]
+
+    Raises:
+        ValueError: if limit isn't positive, as SQLite
+            takes a negative limit as no limit at all
+    """
+    if limit <= 0:
+        raise ValueError(f"limit must be positive, not {limit}")
+
+    clauses: T.List[str] = []
+    params: T.List[T.Any] = []
+
+    if job_uuids is not None:
+        # passing the IDs as one JSON array saves us hitting
+        # SQLite's limit on the number of parameters
+        clauses.append("uuid IN (SELECT value FROM json_each(?))")
+        params.append(json.dumps(job_uuids))
+    if status is not None:
+        clauses.append("status = ?")
+        params.append(status)
+    if job_type is not None:
+        clauses.append("job_type = ?")
+        params.append(job_type)
+    if since is not None:
+        clauses.append("submit_time >= ?")
+        params.append(since.timestamp())
+
+    where = f"WHERE {' AND '.join(clauses)}" if clauses else ""
+    rows = connection().execute(
+        f"SELECT * FROM jobs {where} ORDER BY submit_time DESC LIMIT ?",
+        (*params, limit)
+    )
+
+    return [{
+        "jobId": row["uuid"],
+        "type": row["job_type"],
+        "studyAccession": row["study_id"],
+        "submitTime": _isoformat(row["submit_time"]),
+        **_job_dict(row)
+    } for row in rows]
+
+
+def _check_timeout(timeout: float) -> None:
+    """a wait that can't reach its deadline would never return"""
+    if not math.isfinite(timeout) or timeout < 0:
+        raise ValueError(f"timeout must be finite and not negative, not {timeout}")
+
+
+def wait_for_job(
+    job_uuid: str,
+    known_status: T.Optional[str],
+    timeout: float
+) -> T.Optional[T.Dict[str, T.Any]]:
+    """block until the job's status is no longer known_status,
+    or until timeout seconds have passed
+
+    as the job's status is written by the job workers, which
+    are other processes, we watch the store for the change
+
+    Args:
+        job_uuid: str - the job's UUID
+        known_status: Optional[str] - the status the caller already
+            knows about. if None, return the job straight away
+        timeout: float - the most seconds to wait for
+
+    Returns:
+        Optional[Dict[str, Any]]: the job's latest information, as from
+            get_job, or None if there's no such job
+
+    Raises:
+        ValueError: if timeout is negative, infinite or nan
+    """
+    _check_timeout(timeout)
+    deadline = time.monotonic() + timeout
+    while True:
+        data = get_job(job_uuid)
+        if data is None or data["status"] != known_status \
+                or time.monotonic() >= deadline:
+            return data
+
+        time.sleep(min(_WAIT_POLL_SECONDS, max(deadline - time.monotonic(), 0)))
+
+
+async def wait_for_job_async(
+    job_uuid: str,
+    known_status: T.Optional[str],
+    timeout: float
+) -> T.Optional[T.Dict[str, T.Any]]:
+    """as wait_for_job, but sleeping without blocking the event loop,
+    so any number of clients can wait on jobs at once
+
+    each check is a single primary key lookup, so is made
+    on the event loop's thread
+
+    Args:
+        job_uuid: str - the job's UUID
+        known_status: Optional[str] - the status the caller already
+            knows about. if None, return the job straight away
+        timeout: float - the most seconds to wait for
+
+    Returns:
+        Optional[Dict[str, Any]]: the job's latest information, as from
+            get_job, or None if there's no such job
+
+    Raises:
+        ValueError: if timeout is negative, infinite or nan
+    """
+    _check_timeout(timeout)
+    deadline = time.monotonic() + timeout
+    while True:
+        data = get_job(job_uuid)
+        if data is None or data["status"] != known_status \
+                or time.monotonic() >= deadline:
+            return data
+
+        await asyncio.sleep(min(_WAIT_POLL_SECONDS, max(deadline - time.monotonic(), 0)))
+
+
+def delete_job(job_uuid: str) -> None:
+    """remove a job from the store
+
+    Args:
+        job_uuid: str - the job's UUID
+    """
+    with transaction() as conn:
+        conn.execute("DELETE FROM job_stages WHERE job_uuid = ?", (job_uuid,))
+        conn.execute("DELETE FROM jobs WHERE uuid = ?", (job_uuid,))
+
+
+def delete_expired(finished_before: datetime.datetime) -> int:
+    """remove every job that finished before the given time,
+    in a single statement using the end time index
+
+    Args:
+        finished_before: datetime - jobs that ended before this are removed
+
+    Returns:
+        int: how many jobs were removed
+    """
+    with transaction() as conn:
+        conn.execute(
+            """DELETE FROM job_stages WHERE job_uuid IN (
+                SELECT uuid FROM jobs WHERE end_time < ?
+            )""",
+            (finished_before.timestamp(),)
+        )
+        return conn.execute(
+            "DELETE FROM jobs WHERE end_time < ?", (finished_before.timestamp(),)).rowcount
+
+
+def fail_unfinished(
+    unfinished: T.Iterable[str],
+    status: str,
+    output: T.Any
+) -> int:
+    """finish every job still in one of the unfinished statuses,
+    such as the jobs left queued or running when the server stopped,
+    so they get an end time and can expire
+
+    Args:
+        unfinished: Iterable[str] - the JobStatus values to finish
+        status: str - the JobStatus value to finish them with
+        output: Any - the output for the user, must be JSON serialisable
+
+    Returns:
+        int: how many jobs were finished
+    """
+    unfinished = list(unfinished)
+    with transaction() as conn:
+        return conn.execute(
+            f"""UPDATE jobs SET status = ?, end_time = ?, output = ?
+            WHERE status IN ({", ".join("?" * len(unfinished))})""",
+            (status, datetime.datetime.now().timestamp(), json.dumps(output), *unfinished)
+        ).rowcount
+
+
+def save_batch(batch_id: str, job_uuids: T.List[str]) -> None:
+    """record which jobs were submitted together as a batch
+
+    Args:
+        batch_id: str - the batch's ID
+        job_uuids: List[str] - the UUIDs of the jobs in the batch
+    """
+    connection().executemany(
+        "INSERT INTO batch_jobs (batch_id, job_uuid) VALUES (?, ?)",
+        [(batch_id, job_uuid) for job_uuid in job_uuids]
+    )
+
+
+def get_batch(batch_id: str) -> T.List[T.Dict[str, T.Any]]:
+    """get the status of every job in a batch, that
+    hasn't yet expired
+
+    Args:
+        batch_id: str - the batch's ID
+
+    Returns:
+        List[Dict[str, Any]]: for example
+            [{"jobId": "...", "status": "RUNNING"}]
+            which is empty if there's no such batch
+    """
+    return [{
+        "jobId": row["uuid"],
+        "status": row["status"]
+    } for row in connection().execute(
+        """SELECT jobs.uuid, jobs.status FROM batch_jobs
+        JOIN jobs ON jobs.uuid = batch_jobs.job_uuid
+        WHERE batch_jobs.batch_id = ?
+        ORDER BY jobs.submit_time""",
+        (batch_id,)
+    )]
+
+
+def delete_orphaned_batch_jobs() -> int:
+    """remove the batch records of jobs that are no
+    longer in the store, such as once they've expired
+
+    Returns:
+        int: how many records were removed
+    """
+    return connection().execute(
+        """DELETE FROM batch_jobs WHERE NOT EXISTS (
+            SELECT 1 FROM jobs WHERE jobs.uuid = batch_jobs.job_uuid
+        )"""
+    ).rowcount
+
+
+def bump_cache_generation(name: str) -> int:
+    """mark one of the API's in-memory caches as emptied, so each web
+    worker knows to empty its own copy (see api_cache.sync_invalidations)
+
+    Args:
+        name: str - the cache's name, as in api_cache.caches
+
+    Returns:
+        int: the cache's new generation
+    """
+    with transaction() as conn:
+        conn.execute(
+            """INSERT INTO cache_generations (name, generation) VALUES (?, 1)
+            ON CONFLICT (name) DO UPDATE SET generation = generation + 1""",
+            (name,)
+        )
+        return conn.execute(
+            "SELECT generation FROM cache_generations WHERE name = ?", (name,)
+        ).fetchone()["generation"]
+
+
+def get_cache_generations() -> T.Dict[str, int]:
+    """get the generation of each of the API's in-memory caches
+    that's been emptied, as from bump_cache_generation
+
+    Returns:
+        Dict[str, int]: for example {"templates": 2}
+    """
+    return dict(connection().execute(
+        "SELECT name, generation FROM cache_generations").fetchall())
+
+
+def count_jobs() -> T.Dict[str, int]:
+    """count how many jobs there are in each status
+
+    Returns:
+        Dict[str, int]: for example {"QUEUED": 3, "RUNNING": 1}
+    """
+    return dict(connection().execute(
+        "SELECT status, COUNT(*) FROM jobs GROUP BY status").fetchall())
+
+
+def last_completed(job_type: str, study_id: str) -> T.Optional[float]:
+    """when the last job of a type for a study completed
+
+    Args:
+        job_type: str - such as "signal"
+        study_id: str - the study accession
+
+    Returns:
+        Optional[float]: the end time as a POSIX timestamp,
+            or None if there isn't a completed job
+    """
+    return connection().execute(
+        """SELECT MAX(end_time) FROM jobs
+        WHERE study_id = ? AND job_type = ? AND status = 'COMPLETED'""",
+        (study_id, job_type)
+    ).fetchone()[0]
+
+
+def save_worker(
+    worker_id: int,
+    status: str,
+    jobs_done: int,
+    job_uuid: T.Optional[str] = None
+) -> None:
+    """record the current state of a job worker
+
+    Args:
+        worker_id: int - the index of the worker in the pool
+        status: str - the WorkerStatus value
+        jobs_done: int - how many jobs the worker has finished
+        job_uuid: Optional[str] - the job the worker is running, if any
+    """
+    connection().execute(
+        """INSERT OR REPLACE INTO workers (
+            worker_id, pid, status, job, since, jobs_done
+        ) VALUES (?, ?, ?, ?, ?, ?)""",
+        (
+            worker_id, os.getpid(), status, job_uuid,
+            datetime.datetime.now().timestamp(), jobs_done
+        )
+    )
+
+
+def get_workers() -> T.List[T.Dict[str, T.Any]]:
+    """get the state of every job worker
+
+    Returns:
+        List[Dict[str, Any]]: ordered by worker ID, for example
+            [{"worker": 0, "pid": 12, "status": "BUSY",
+              "job": "...", "since": "...", "jobsDone": 3}]
+    """
+    return [{
+        "worker": row["worker_id"],
+        "pid": row["pid"],
+        "status": row["status"],
+        "job": row["job"],
+        "since": _isoformat(row["since"]),
+        "jobsDone": row["jobs_done"]
+    } for row in connection().execute("SELECT * FROM workers ORDER BY worker_id")]
+
+
+def delete_workers() -> None:
+    """forget every job worker, such as when a new
+    pool is about to be started"""
+    connection().execute("DELETE FROM workers")
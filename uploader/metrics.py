@@ -0,0 +1,285 @@
+"""
+Genestack Uploader
+A HTTP server providing an API and a frontend for easy uploading to Genestack
+
+Copyright (C) 2022 Genome Research Limited
+
+Author: Michael Grace <mg38@sanger.ac.uk>
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+import atexit
+import contextlib
+import logging
+import os
+import sqlite3
+import threading
+import time
+import typing as T
+
+from uploader import job_store
+from uploader.common import LOG_LEVEL, JobStatus, WorkerStatus, float_env
+
+# Metrics are recorded from the API process and from every job worker.
+# Each process adds them up in memory, and every METRICS_FLUSH_SECONDS
+# adds what it's got to the job store in one transaction, where the API
+# can read them all. So recording a metric never waits on SQLite.
+
+METRICS_FLUSH_SECONDS: float = float_env("METRICS_FLUSH_SECONDS", 5)
+
+logger = logging.getLogger("metrics")
+logger.setLevel(LOG_LEVEL)
+
+# name: (type, help)
+_metrics: T.Dict[str, T.Tuple[str, str]] = {
+    "uploader_jobs_submitted_total": (
+        "counter", "Upload jobs submitted, by type"),
+    "uploader_jobs_finished_total": (
+        "counter", "Upload jobs finished, by type, status and error category"),
+    "uploader_job_queue_seconds": (
+        "histogram", "Time upload jobs spent queued before starting, by type"),
+    "uploader_job_duration_seconds": (
+        "histogram", "Time upload jobs spent running, by type and status"),
+    "uploader_job_stage_seconds": (
+        "histogram", "Time spent in each stage of an upload job"),
+    "uploader_genestack_request_seconds": (
+        "histogram", "Latency of Genestack calls made by the API, by call"),
+    "uploader_s3_policy_changes_total": (
+        "counter", "Times the S3 bucket policy was changed, by the policy set"),
+    "uploader_download_cache_requests_total": (
+        "counter", "S3 downloads through the download cache, by hit or miss"),
+    "uploader_download_cache_hit_bytes_total": (
+        "counter", "Bytes not downloaded from S3 as they were in the download cache"),
+    "uploader_download_cache_evictions_total": (
+        "counter", "Files removed from the download cache to keep it under its size cap"),
+    "uploader_http_requests_total": (
+        "counter", "API requests handled, by endpoint and status code"),
+}
+
+_BUCKETS: T.List[float] = [
+    0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300, 900, 1800, 3600, 7200
+]
+
+
+def _labels(labels: T.Dict[str, T.Any]) -> str:
+    """render labels as they appear in the Prometheus
+    text format, sorted so the same labels always give
+    the same string, for example: status="FAILED",type="study"
+    """
+    def escape(val: T.Any) -> str:
+        return str(val).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+    return ",".join(f'{k}="{escape(v)}"' for k, v in sorted(labels.items()))
+
+
+class _Pending:  # pylint: disable=too-few-public-methods
+    """
+        What this process has recorded since it last flushed,
+        as (name, labels): amount to add in the job store
+    """
+
+    def __init__(self) -> None:
+        self.lock = threading.Lock()
+        self.values: T.Dict[T.Tuple[str, str], float] = {}
+        # the flush thread, started by the first metric recorded
+        self.flusher: T.Optional[threading.Thread] = None
+
+
+_pending = _Pending()
+
+
+def _forget_pending() -> None:
+    """a forked process starts with nothing pending, otherwise what
+    the parent had pending would be flushed by both of them, and
+    without the parent's flush thread, which doesn't survive the fork"""
+    global _pending  # pylint: disable=global-statement
+    _pending = _Pending()
+
+
+os.register_at_fork(after_in_child=_forget_pending)
+
+
+def _flush_periodically() -> None:
+    while True:
+        time.sleep(METRICS_FLUSH_SECONDS)
+        flush()
+
+
+def _add(name: str, labels: str, amount: float) -> None:
+    """add amount to what's pending, must be
+    called holding the pending lock"""
+    _pending.values[(name, labels)] = _pending.values.get((name, labels), 0) + amount
+
+
+def _start_flusher() -> None:
+    """start this process's flush thread, if it hasn't been,
+    must be called holding the pending lock"""
+    if _pending.flusher is None:
+        _pending.flusher = threading.Thread(
+            target=_flush_periodically, name="metrics-flush", daemon=True)
+        _pending.flusher.start()
+
+
+def flush() -> None:
+    """add everything this process has recorded since it last
+    flushed to the job store, so the API can render it. this
+    runs every METRICS_FLUSH_SECONDS, and should also be run
+    before a process exits, so nothing recorded is lost
+
+    Note: metrics shouldn't get in the way of what's being
+    measured, so a failure to flush is only logged, and what
+    was pending is kept for the next flush
+    """
+    pending = _pending
+    with pending.lock:
+        values, pending.values = pending.values, {}
+    if not values:
+        return
+
+    try:
+        with job_store.transaction() as conn:
+            conn.executemany(
+                """INSERT INTO metrics (name, labels, value) VALUES (?, ?, ?)
+                ON CONFLICT (name, labels) DO UPDATE SET value = value + excluded.value""",
+                [(name, labels, amount) for (name, labels), amount in values.items()]
+            )
+    except sqlite3.Error as err:
+        logger.exception(err)
+        with pending.lock:
+            for (name, labels), amount in values.items():
+                pending.values[(name, labels)] = pending.values.get((name, labels), 0) + amount
+
+
+atexit.register(flush)
+
+
+def inc(name: str, amount: float = 1, **labels: T.Any) -> None:
+    """increase a counter
+
+    Args:
+        name: str - the counter, one of those in _metrics
+        amount: float - how much to increase it by
+        labels: the labels for this count, such as type="study"
+    """
+    rendered = _labels(labels)
+    with _pending.lock:
+        _add(name, rendered, amount)
+        _start_flusher()
+
+
+def observe(name: str, value: float, **labels: T.Any) -> None:
+    """record a value, such as a duration, in a histogram
+
+    Args:
+        name: str - the histogram, one of those in _metrics
+        value: float - the value to record
+        labels: the labels for this value, such as type="study"
+    """
+    rendered = _labels(labels)
+    with _pending.lock:
+        for bucket in [*_BUCKETS, float("inf")]:
+            # every bucket is written, even when it isn't added to, so
+            # the histogram is complete. le always goes last, so
+            # _bucket_order can find it
+            bound = "+Inf" if bucket == float("inf") else str(bucket)
+            _add(f"{name}_bucket",
+                 f'{rendered},le="{bound}"' if rendered else f'le="{bound}"',
+                 1 if value <= bucket else 0)
+        _add(f"{name}_sum", rendered, value)
+        _add(f"{name}_count", rendered, 1)
+        _start_flusher()
+
+
+@contextlib.contextmanager
+def timed(name: str, **labels: T.Any) -> T.Iterator[None]:
+    """context manager to record how long the code
+    within it takes in a histogram, even if it raises
+
+    Args:
+        name: str - the histogram, one of those in _metrics
+        labels: the labels for this value, such as call="get_study"
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe(name, time.perf_counter() - start, **labels)
+
+
+def _sample(name: str, labels: str, value: float) -> str:
+    return f"{name}{{{labels}}} {float(value)!r}" if labels else f"{name} {float(value)!r}"
+
+
+def _bucket_order(row: sqlite3.Row) -> T.Tuple[str, float]:
+    """sort histogram buckets by their other labels,
+    then numerically by le, as Prometheus expects"""
+    labels, _, bound = row["labels"].rpartition("le=")
+    return labels, float(bound.strip('"'))
+
+
+def render() -> str:
+    """render every metric in the Prometheus text format,
+    along with the current number of jobs in each status
+    and workers in each state
+
+    Returns:
+        str: the text exposition, for example
+            # HELP uploader_jobs Upload jobs in the job store, by status
+            # TYPE uploader_jobs gauge
+            uploader_jobs{status="QUEUED"} 3
+    """
+    # so the API's own metrics are up to date,
+    # the job workers' are up to METRICS_FLUSH_SECONDS old
+    flush()
+
+    lines: T.List[str] = []
+    conn = job_store.connection()
+
+    job_counts = job_store.count_jobs()
+    lines += [
+        "# HELP uploader_jobs Upload jobs in the job store, by status",
+        "# TYPE uploader_jobs gauge",
+        *[_sample("uploader_jobs", _labels({"status": x.value}), job_counts.get(x.value, 0))
+          for x in JobStatus]
+    ]
+
+    workers = job_store.get_workers()
+    lines += [
+        "# HELP uploader_workers Job workers, by state",
+        "# TYPE uploader_workers gauge",
+        *[_sample("uploader_workers", _labels({"status": x.value}),
+                  len([w for w in workers if w["status"] == x.value]))
+          for x in WorkerStatus]
+    ]
+
+    for name, (metric_type, metric_help) in _metrics.items():
+        lines += [f"# HELP {name} {metric_help}", f"# TYPE {name} {metric_type}"]
+
+        if metric_type == "counter":
+            rows = conn.execute(
+                "SELECT * FROM metrics WHERE name = ? ORDER BY labels", (name,))
+            lines += [_sample(name, row["labels"], row["value"]) for row in rows]
+            continue
+
+        buckets = sorted(conn.execute(
+            "SELECT * FROM metrics WHERE name = ?", (f"{name}_bucket",)).fetchall(),
+            key=_bucket_order)
+        lines += [_sample(f"{name}_bucket", row["labels"], row["value"]) for row in buckets]
+        for suffix in ["_sum", "_count"]:
+            rows = conn.execute(
+                "SELECT * FROM metrics WHERE name = ? ORDER BY labels", (f"{name}{suffix}",))
+            lines += [_sample(f"{name}{suffix}", row["labels"], row["value"]) for row in rows]
+
+    return "\n".join(lines) + "\n"
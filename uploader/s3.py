@@ -20,14 +20,257 @@ You should have received a copy of the GNU General Public License
 along with this program.  If not, see <https://www.gnu.org/licenses/>.
 """
 
+import configparser
 import logging
+import multiprocessing
 import os
+import threading
+import time
+import typing as T
 
+import boto3
 import botocore
 import paramiko
 from uploadtogenestack import S3BucketUtils, genestackassist
 
 import config
+from uploader import compression, metrics
+from uploader.common import float_env
+
+# 0 sets the VM only policy as soon as the last job leaves
+S3_POLICY_LINGER_SECONDS: float = float_env("S3_POLICY_LINGER_SECONDS", 60, allow_minimum=True)
+
+# how much of an object is asked for at a time when reading its first line,
+# and the most that's read before giving up on finding the end of it
+FIRST_LINE_READ_BYTES: int = 64 * 1024
+FIRST_LINE_MAX_BYTES: int = 4 * 1024 * 1024
+
+
+_clients: T.Dict[int, T.Any] = {}
+
+
+def s3_client() -> T.Any:
+    """get a boto3 S3 client for this process, using the
+    same s3cmd config (~/.s3cfg) as the uploadtogenestack package
+
+    this uses our own credentials, but the bucket's VM only
+    policy refuses those too, so use it within S3PublicPolicy.
+    boto3 clients can't be shared across processes, so each
+    process makes its own
+
+    Returns:
+        botocore.client.S3
+
+    Raises:
+        KeyError: if the s3cmd config is missing or incomplete
+    """
+    if os.getpid() not in _clients:
+        s3cfg = configparser.ConfigParser()
+        s3cfg.read(f"{os.environ['HOME']}/.s3cfg")
+        default = s3cfg["default"]
+        scheme = "https" if default.getboolean("use_https", fallback=True) else "http"
+
+        _clients[os.getpid()] = boto3.client(
+            "s3",
+            aws_access_key_id=default["access_key"],
+            aws_secret_access_key=default["secret_key"],
+            endpoint_url=f"{scheme}://{default['host_base']}"
+        )
+
+    return _clients[os.getpid()]
+
+
+def _ranged_chunks(bucket_name: str, key: str) -> T.Iterator[bytes]:
+    """read an object with ranged GETs, each bigger than the last, up to
+    FIRST_LINE_MAX_BYTES, so if we stop early, little more is transferred
+    than we've used
+
+    Raises:
+        botocore.exceptions.ClientError: if the object can't be read,
+            such as if it doesn't exist, or is empty
+    """
+    start, size = 0, FIRST_LINE_READ_BYTES
+    while True:
+        response = s3_client().get_object(
+            Bucket=bucket_name, Key=key, Range=f"bytes={start}-{start + size - 1}")
+        chunk = response["Body"].read()
+        yield chunk
+        start += len(chunk)
+
+        # Content-Range is "bytes start-end/size"
+        total = int(response.get("ContentRange", "").rpartition("/")[2] or start)
+        if not chunk or start >= total:
+            return
+        size = min(size * 4, FIRST_LINE_MAX_BYTES)
+
+
+def read_first_line(bucket_name: str, key: str) -> str:
+    """read the first line of an object, such as the header of a sample
+    file, decompressing it if it's compressed, with ranged GETs, so not
+    much more than the line is transferred
+
+    Args:
+        bucket_name: str - the bucket the object is in
+        key: str - the object's key in the bucket
+
+    Returns:
+        str: the first line, without its line ending
+
+    Raises:
+        botocore.exceptions.ClientError: if the object can't be read,
+            such as if it doesn't exist
+        ValueError: if the line doesn't end within FIRST_LINE_MAX_BYTES,
+            or isn't UTF-8, or the object can't be decompressed
+    """
+    line = b""
+    try:
+        for block in compression.decompress(_ranged_chunks(bucket_name, key), key):
+            newline = block.find(b"\n")
+            if newline >= 0:
+                line += block[:newline]
+                break
+            line += block
+            if len(line) > FIRST_LINE_MAX_BYTES:
+                raise ValueError(f"the first line is longer than {FIRST_LINE_MAX_BYTES} bytes")
+    except compression.DECOMPRESSION_ERRORS as err:
+        raise ValueError(f"can't decompress it: {err}") from err
+
+    return line.decode("UTF-8").rstrip("\r")
+
+
+# the most processes that can be in the public policy window at once:
+# every job worker, and every web worker checking new studies
+_MAX_WINDOW_PROCESSES: int = 256
+
+# how often the watchdog looks for a window left open
+# by a job worker that has died, or whose linger timer has
+_WATCHDOG_INTERVAL_SECONDS: float = 10
+
+# the window's states. it's _UNKNOWN when whoever was setting the
+# policy failed or died part way through, so it's set again either way
+_CLOSED, _OPENING, _OPEN, _CLOSING, _UNKNOWN = range(5)
+
+
+def _is_alive(pid: int) -> bool:
+    """whether a process is still running. one that's exited,
+    but not yet been waited for by its parent, is a zombie"""
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    try:
+        with open(f"/proc/{pid}/stat", encoding="utf8") as stat:
+            return stat.read().rpartition(")")[2].split()[0] != "Z"
+    except OSError:
+        return True
+
+
+class _PolicyWindow:
+    """
+        The state of the public policy window, shared by
+        every job worker and web worker
+
+        This is made when the module is imported by the API
+        process, before the workers are forked from it, so
+        they all share the same lock and values
+
+        The lock is only held to change the state, never while
+        setting a policy, which calls the bucket's VM over SSH.
+        Whoever is setting one marks the window _OPENING or
+        _CLOSING, and anyone else entering waits for them to
+        finish. Who is in the window is kept by pid, so a
+        process that dies inside it can be let go of
+    """
+
+    def __init__(self) -> None:
+        self.lock = multiprocessing.Lock()
+        # notified when a policy has been set
+        self.changed = multiprocessing.Condition(self.lock)
+        # each process in the window, and how many of its jobs are in it
+        self.pids = multiprocessing.Array("i", _MAX_WINDOW_PROCESSES, lock=False)
+        self.counts = multiprocessing.Array("i", _MAX_WINDOW_PROCESSES, lock=False)
+        self.state = multiprocessing.Value("b", _CLOSED, lock=False)
+        # the process setting a policy, when _OPENING or _CLOSING
+        self.changer = multiprocessing.Value("i", 0, lock=False)
+        # bumped every time a job enters, so a pending close
+        # knows if the window has been reused since it was scheduled
+        self.generation = multiprocessing.Value("i", 0, lock=False)
+        # when the last job left the window, on the monotonic clock
+        self.emptied = multiprocessing.Value("d", 0.0, lock=False)
+
+    # all of the below must be called holding the lock
+
+    def users(self) -> int:
+        """how many jobs are in the window"""
+        return sum(self.counts)
+
+    def enter(self, pid: int) -> None:
+        """count a job of the process into the window"""
+        free: T.Optional[int] = None
+        for slot in range(_MAX_WINDOW_PROCESSES):
+            if self.counts[slot] and self.pids[slot] == pid:
+                self.counts[slot] += 1
+                return
+            if free is None and not self.counts[slot]:
+                free = slot
+        if free is None:
+            raise RuntimeError(
+                f"more than {_MAX_WINDOW_PROCESSES} processes in the S3 public policy window")
+        self.pids[free], self.counts[free] = pid, 1
+
+    def leave(self, pid: int) -> None:
+        """count a job of the process out of the window"""
+        for slot in range(_MAX_WINDOW_PROCESSES):
+            if self.counts[slot] and self.pids[slot] == pid:
+                self.counts[slot] -= 1
+                break
+        if not self.users():
+            self.emptied.value = time.monotonic()
+
+    def clear(self) -> None:
+        """count every job out of the window"""
+        for slot in range(_MAX_WINDOW_PROCESSES):
+            self.counts[slot] = 0
+        self.emptied.value = time.monotonic()
+
+    def reclaim_dead(self) -> int:
+        """count out the jobs of processes that died in the window,
+        and stop waiting on one that died setting a policy
+
+        Returns:
+            int: how many jobs were counted out
+        """
+        reclaimed = 0
+        for slot in range(_MAX_WINDOW_PROCESSES):
+            if self.counts[slot] and not _is_alive(self.pids[slot]):
+                reclaimed += self.counts[slot]
+                self.counts[slot] = 0
+        if reclaimed and not self.users():
+            self.emptied.value = time.monotonic()
+
+        if self.state.value in (_OPENING, _CLOSING) and not _is_alive(self.changer.value):
+            self.state.value = _UNKNOWN
+            self.changed.notify_all()
+        return reclaimed
+
+    def start_closing(self, pid: int, generation: T.Optional[int] = None) -> bool:
+        """mark the window _CLOSING, if no job is in it, it might be
+        open, and (if given) no job has entered since generation
+
+        Returns:
+            bool: whether the caller should now set the VM only policy
+        """
+        if self.users() or self.state.value not in (_OPEN, _UNKNOWN) or \
+                (generation is not None and self.generation.value != generation):
+            return False
+        self.state.value = _CLOSING
+        self.changer.value = pid
+        return True
+
+
+_window = _PolicyWindow()
 
 
 class S3PublicPolicy:
@@ -37,6 +280,17 @@ class S3PublicPolicy:
 
         When opened, sets a public policy
         When closed, sets a GS VM only policy
+
+        The policy is shared by every job across all the
+        job workers. The public policy is only set by the
+        first job to enter, and the VM only policy is only
+        set once the last job has left and no other job has
+        entered for S3_POLICY_LINGER_SECONDS, so jobs running
+        together or back-to-back don't keep flipping it. A job
+        worker that exits sets it straight away (close_public_policy),
+        and so does stopping the job workers. If a worker dies
+        inside the window, or before its linger timer fires, the
+        watchdog (policy_watchdog) lets go of it and sets it
     """
 
     def __init__(self, s3_bucket: S3BucketUtils):
@@ -45,19 +299,153 @@ class S3PublicPolicy:
         self.logger.setLevel(config.LOG_LEVEL)
 
     def __enter__(self):
+        pid = os.getpid()
+        with _window.changed:
+            _window.enter(pid)
+            _window.generation.value += 1
+            while _window.state.value in (_OPENING, _CLOSING):
+                _window.changed.wait(1)
+                _window.reclaim_dead()
+
+            if _window.state.value == _OPEN:
+                self.logger.info(
+                    f"S3 public policy already set, shared by {_window.users()} job(s)")
+                return
+            _window.state.value = _OPENING
+            _window.changer.value = pid
+
+        state = _UNKNOWN
+        try:
+            state = _OPEN if self._set_public_policy() else _CLOSED
+        except BaseException:
+            # __exit__ won't be called, so we need to let go here
+            with _window.lock:
+                _window.leave(pid)
+            raise
+        finally:
+            with _window.changed:
+                _window.state.value = state
+                _window.changer.value = 0
+                _window.changed.notify_all()
+
+    def __exit__(self, *_):
+        with _window.lock:
+            _window.leave(os.getpid())
+            if _window.users() > 0:
+                self.logger.info(
+                    f"S3 public policy still needed by {_window.users()} job(s)")
+                return
+
+            generation: int = _window.generation.value
+
+        if S3_POLICY_LINGER_SECONDS <= 0:
+            self._close_if_unused(generation)
+            return
+
+        self.logger.info(
+            f"setting S3 private policy in {S3_POLICY_LINGER_SECONDS}s if no other job needs it")
+        timer = threading.Timer(
+            S3_POLICY_LINGER_SECONDS, self._close_if_unused, args=(generation,))
+        timer.daemon = True
+        timer.start()
+
+    def _set_public_policy(self) -> bool:
+        """set the public policy on the bucket. must be called
+        outside the window's lock, with the window _OPENING
+
+        Returns:
+            bool: whether the policy was set
+        """
         self.logger.info("setting S3 public policy")
         try:
             self.s3_bucket.delete_bucket_policy(
                 key_filename=f"{os.environ['HOME']}/.ssh/id_rsa_genestack")
             self.s3_bucket.set_public_policy()
+            metrics.inc("uploader_s3_policy_changes_total", policy="public")
+            return True
         except paramiko.PasswordRequiredException:
             self.logger.warning(
                 "can't change the bucket policy. the upload might work. but probably not.")
+            return False
 
-    def __exit__(self, *_):
+    def _close_if_unused(self, generation: int) -> None:
+        """set the VM only policy on the bucket, so long as
+        no job has entered the window since generation
+
+        Args:
+            generation: int - the window's generation when the
+                last job left
+        """
+        with _window.lock:
+            if not _window.start_closing(os.getpid(), generation):
+                return
+        self._set_vm_only_policy()
+
+    def _set_vm_only_policy(self) -> None:
+        """set the VM only policy on the bucket. must be called
+        outside the window's lock, with the window _CLOSING"""
         self.logger.info("setting S3 private policy")
+        state = _UNKNOWN
         try:
             self.s3_bucket.set_vm_only_policy()
+            metrics.inc("uploader_s3_policy_changes_total", policy="vm_only")
+            state = _CLOSED
         except (botocore.exceptions.ClientError, genestackassist.BucketPermissionDenied):
             # VM Only Policy is Already Set
             self.logger.info("VM Only policy already set")
+            state = _CLOSED
+        finally:
+            with _window.changed:
+                _window.state.value = state
+                _window.changer.value = 0
+                _window.changed.notify_all()
+
+
+def close_public_policy(s3_bucket: S3BucketUtils, force: bool = False) -> None:
+    """set the VM only policy now, rather than waiting for the linger
+    timer, which is a thread in whichever job worker last left the window,
+    so won't fire if that worker exits first
+
+    Args:
+        s3_bucket: S3BucketUtils - the bucket
+        force: bool - set it even if the window looks to be in use, or
+            not open, such as once every job worker has been stopped, when
+            a worker killed part way through a job can't have left it
+    """
+    with _window.lock:
+        if force:
+            _window.clear()
+            _window.state.value = _UNKNOWN
+        if not _window.start_closing(os.getpid()):
+            return
+    S3PublicPolicy(s3_bucket)._set_vm_only_policy()  # pylint: disable=protected-access
+
+
+def policy_watchdog(s3_bucket: S3BucketUtils, interval: float = _WATCHDOG_INTERVAL_SECONDS) -> None:
+    """policy_watchdog runs a loop, every interval seconds letting go
+    of the jobs of any process that died in the public policy window,
+    and setting the VM only policy if the window has been empty for
+    S3_POLICY_LINGER_SECONDS, as the linger timer dies with its process
+
+    Args:
+        s3_bucket: S3BucketUtils - the bucket
+        interval: float - seconds to wait between checks
+
+    Note: this never returns, so should be run
+    in its own thread, in a process that outlives
+    the job workers
+    """
+    logger = logging.getLogger("policy-watchdog")
+    logger.setLevel(config.LOG_LEVEL)
+
+    while True:
+        time.sleep(interval)
+        with _window.lock:
+            reclaimed = _window.reclaim_dead()
+            close = time.monotonic() - _window.emptied.value >= S3_POLICY_LINGER_SECONDS \
+                and _window.start_closing(os.getpid())
+        if reclaimed:
+            logger.warning(f"let go of {reclaimed} job(s) that died with the S3 public policy set")
+        if close:
+            logger.info("S3 public policy left open by a stopped job worker")
+            S3PublicPolicy(s3_bucket)._set_vm_only_policy()  # pylint: disable=protected-access
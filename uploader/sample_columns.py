@@ -0,0 +1,257 @@
+"""
+Genestack Uploader
+A HTTP server providing an API and a frontend for easy uploading to Genestack
+
+Copyright (C) 2022 Genome Research Limited
+
+Author: Michael Grace <mg38@sanger.ac.uk>
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+import csv
+from pathlib import Path
+import typing as T
+
+from uploader import compression
+
+# a column kept from the uploaded sample file: its
+# position there, and its title in the new file
+Column = T.Tuple[int, str]
+
+# the columns Genestack needs every sample file to have, as the
+# new study form tells the user (see docs/spec/main-spec-updates/2.md)
+REQUIRED_COLUMNS: T.List[str] = ["Sample Source ID", "Sample Source"]
+
+# the keys of a study's body, or a column preset, with the columns
+# to change, and the fields of each of their entries
+COLUMN_KEYS: T.Dict[str, T.Tuple[str, ...]] = {
+    "renamedColumns": ("old", "new"),
+    "addedColumns": ("title", "value"),
+    "deletedColumns": (),
+}
+
+
+class ColumnPlanError(ValueError):
+    """when the columns to rename, add or delete don't fit
+    the sample file. The args are every problem found"""
+
+
+class ColumnPlan:
+    """
+        How to make the sample file the user wants from the one
+        they uploaded: the header of the new file, and where each of
+        its columns comes from
+
+        The renamed columns come first, in the order given, then the
+        columns kept as they are, then the columns added
+    """
+
+    def __init__(
+        self,
+        headers: T.List[str],
+        renamed: T.List[T.Dict[str, str]],
+        added: T.List[T.Dict[str, str]],
+        deleted: T.List[str]
+    ) -> None:
+        """
+        Args:
+            headers: List[str] - the columns of the uploaded sample file
+            renamed: List[Dict[str, str]] - as in renamedColumns,
+                [{"old": "...", "new": "..."}]
+            added: List[Dict[str, str]] - as in addedColumns,
+                [{"title": "...", "value": "..."}]
+            deleted: List[str] - as in deletedColumns
+
+        Raises:
+            ColumnPlanError: with every problem found
+        """
+        problems = problems_with(headers, renamed, added, deleted)
+        if problems:
+            raise ColumnPlanError(*problems)
+
+        positions = {header: position for position, header in enumerate(headers)}
+        renamed_from = {col["old"].strip() for col in renamed}
+        deleted_columns = {col.strip() for col in deleted}
+
+        self.columns: T.List[Column] = [
+            (positions[col["old"].strip()], col["new"].strip()) for col in renamed
+        ] + [
+            (position, header) for position, header in enumerate(headers)
+            if header not in renamed_from and header not in deleted_columns
+        ]
+        self.titles: T.List[str] = [title for _, title in self.columns] + \
+            [col["title"].strip() for col in added]
+        self.fill_values: T.List[str] = [col["value"].strip() for col in added]
+
+    def transform_row(self, row: T.List[str]) -> T.List[str]:
+        """make a row of the new sample file from a row of the
+        uploaded one. any missing fields at the end are blank"""
+        return [
+            row[position] if position < len(row) else ""
+            for position, _ in self.columns
+        ] + self.fill_values
+
+
+def complete_columns(
+    renamed: T.List[T.Dict[str, str]],
+    added: T.List[T.Dict[str, str]],
+    deleted: T.List[str]
+) -> T.Tuple[T.List[T.Dict[str, str]], T.List[T.Dict[str, str]], T.List[str]]:
+    """drop the rows the user left completely blank in the form"""
+    return (
+        [col for col in renamed if col.get("old", "").strip() or col.get("new", "").strip()],
+        [col for col in added if col.get("title", "").strip() or col.get("value", "").strip()],
+        [col for col in deleted if col.strip()]
+    )
+
+
+def shape_problems(columns: T.Dict[str, T.Any]) -> T.List[str]:
+    """check the columns to rename, add and delete are the
+    shape the rest of this module expects. any missing are
+    taken as empty
+
+    Args:
+        columns: Dict[str, Any] - with any of renamedColumns,
+            addedColumns and deletedColumns
+
+    Returns:
+        List[str]: a description of each problem,
+            which is empty if there are none
+    """
+    problems: T.List[str] = []
+    for key, fields in COLUMN_KEYS.items():
+        entries = columns.get(key, [])
+        if not isinstance(entries, list):
+            problems.append(f"{key} must be a list")
+            continue
+
+        for idx, entry in enumerate(entries):
+            if not fields:
+                if not isinstance(entry, str):
+                    problems.append(f"{key}[{idx}] must be a string")
+            elif not isinstance(entry, dict) or \
+                    not all(isinstance(entry.get(field, ""), str) for field in fields):
+                problems.append(
+                    f"{key}[{idx}] must be an object with the strings {' and '.join(fields)}")
+
+    return problems
+
+
+def problems_with(
+    headers: T.List[str],
+    renamed: T.List[T.Dict[str, str]],
+    added: T.List[T.Dict[str, str]],
+    deleted: T.List[str]
+) -> T.List[str]:
+    """check the columns to rename, add or delete
+    against the columns of the sample file
+
+    Args:
+        headers: List[str] - the columns of the uploaded sample file
+        renamed: List[Dict[str, str]] - as in renamedColumns
+        added: List[Dict[str, str]] - as in addedColumns
+        deleted: List[str] - as in deletedColumns
+
+    Returns:
+        List[str]: a description of each problem,
+            which is empty if there are none
+    """
+    problems: T.List[str] = []
+    columns = set(headers)
+
+    for col in renamed:
+        old, new = col.get("old", "").strip(), col.get("new", "").strip()
+        if not old or not new:
+            problems.append(f"renamed column not complete: {old or '?'} -> {new or '?'}")
+        elif old not in columns:
+            problems.append(f"can't rename {old}, it isn't in the sample file")
+
+    for col in added:
+        if not col.get("title", "").strip() or not col.get("value", "").strip():
+            problems.append(f"added column not complete: {col.get('title', '') or '?'}")
+
+    renamed_from = {col.get("old", "").strip() for col in renamed}
+    for col in deleted:
+        if col.strip() not in columns:
+            problems.append(f"can't delete {col.strip()}, it isn't in the sample file")
+        elif col.strip() in renamed_from:
+            problems.append(f"can't both rename and delete {col.strip()}")
+
+    if problems:
+        return problems
+
+    # the new file can't have the same column twice, and must have those Genestack needs
+    deleted_columns = {col.strip() for col in deleted}
+    titles = [col["new"].strip() for col in renamed] + \
+        [header for header in headers
+         if header not in renamed_from and header not in deleted_columns] + \
+        [col["title"].strip() for col in added]
+    seen: T.Set[str] = set()
+    for title in titles:
+        if title in seen:
+            problems.append(f"the sample file would have {title} more than once")
+        seen.add(title)
+
+    problems += [f"the sample file would be missing the {col} column"
+                 for col in REQUIRED_COLUMNS if col not in seen]
+
+    return problems
+
+
+def split_fields(line: str) -> T.List[str]:
+    """split a line of a sample file into its fields, tab separated,
+    with the same quoting as the rest of the file is read with"""
+    return next(csv.reader([line.rstrip("\r\n")], delimiter="\t"), [])
+
+
+def read_headers(sample_file: Path) -> T.List[str]:
+    """read just the header row of a sample file,
+    which can be compressed"""
+    with compression.open_text(sample_file) as samples:
+        return next(csv.reader(samples, delimiter="\t"), [])
+
+
+def transform(sample_file: Path, plan: ColumnPlan, output: Path) -> int:
+    """write the sample file the plan describes to output, a row
+    at a time, so the memory used doesn't grow with the file
+
+    Args:
+        sample_file: Path - the uploaded sample file, which can be
+            compressed. it's decompressed as it's read
+        plan: ColumnPlan - which columns to rename, add and delete
+        output: Path - where to write the new sample file
+
+    Returns:
+        int: how many rows of samples there were, not counting the header
+
+    Note: the file is read and written as tab separated values with
+    csv's default quoting, as uploadtogenestack did, so quoted fields,
+    even with tabs or new lines in them, are kept as they are
+    """
+    rows = 0
+    with compression.open_text(sample_file) as samples, \
+            open(output, "w", encoding="UTF-8", newline="") as transformed:
+        reader = csv.reader(samples, delimiter="\t")
+        writer = csv.writer(transformed, delimiter="\t", lineterminator="\n")
+        next(reader, None)
+        writer.writerow(plan.titles)
+        for row in reader:
+            # blank lines come through as empty rows
+            if not row:
+                continue
+            writer.writerow(plan.transform_row(row))
+            rows += 1
+
+    return rows
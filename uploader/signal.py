@@ -31,16 +31,18 @@ import botocore
 
 import uploadtogenestack
 
-from uploader import job_responses, s3
+from uploader import compression, download_cache, job_responses, s3, vcf
 from uploader.job_responses import JobResponse
+from uploader.timings import StageTimings
 
 
-def new_signal(
+def new_signal(  # pylint: disable=too-many-arguments
     token: str,
     body: T.Dict[str, T.Any],
     logger: logging.Logger,
     env: T.Dict[str, T.Any],
-    study_id: str
+    study_id: str,
+    timings: StageTimings
 ) -> JobResponse:
     """
         Creating a New Signal
@@ -53,6 +55,7 @@ def new_signal(
             env: Dict[str, Any]: the environment the jobs are run in
             study_id: str: the study id of the study the signal is
                 linked to
+            timings: StageTimings: records how long each stage of the upload takes
 
         Returns:
             JobResponse: the response containing both a JobStatus
@@ -80,15 +83,17 @@ def new_signal(
 
         # As with creating the study, genestack needs the metadata to be in a TSV file
         # with the first line being the keys, and the second line being the values
-        tmp_fp: str = f"/tmp/genestack-{int(time.time()*1000)}.tsv"
+        tmp_fp: str = f"/tmp/genestack-{os.getpid()}-{int(time.time()*1000)}.tsv"
         logger.info(f"using {tmp_fp} as the metadata file")
 
-        with open(tmp_fp, "w", encoding="UTF-8") as tmp_tsv:
-            body["metadata"] = OrderedDict(body["metadata"])
-            tmp_tsv.write("\t".join(x.strip()
-                                    for x in body["metadata"].keys()) + "\n")
-            tmp_tsv.write("\t".join(x.strip()
-                                    for x in body["metadata"].values()) + "\n")
+        with timings.stage("metadata") as stage:
+            with open(tmp_fp, "w", encoding="UTF-8") as tmp_tsv:
+                body["metadata"] = OrderedDict(body["metadata"])
+                tmp_tsv.write("\t".join(x.strip()
+                                        for x in body["metadata"].keys()) + "\n")
+                tmp_tsv.write("\t".join(x.strip()
+                                        for x in body["metadata"].values()) + "\n")
+            stage["bytes"] = os.path.getsize(tmp_fp)
 
         body["metadata"] = tmp_fp
 
@@ -96,45 +101,85 @@ def new_signal(
 
         with s3.S3PublicPolicy(s3_bucket):
             # Downloading S3 File
-            logger.info(
-                f"downloading {body['data']} from S3 to /tmp/{body['data'].strip().replace('/', '_')}")  # pylint: disable=line-too-long
-
+            # Each worker process gets its own directory, so jobs running
+            # at the same time on the same data file don't tread on each other
+            data_dir = f"/tmp/worker-{os.getpid()}"
+            os.makedirs(data_dir, exist_ok=True)
             gs_config = env["gs_config"]
-            s3_bucket.download_file(
-                body["data"].strip().replace(
-                    f"s3://{gs_config['genestackbucket']}/", ""),
-                f"/tmp/{body['data'].strip().replace('/', '_')}"
-            )
-
-            body["data"] = f"/tmp/{body['data'].strip().replace('/', '_')}"
+            key = body["data"].strip().replace(f"s3://{gs_config['genestackbucket']}/", "")
 
             # Generating a Minimal VCF File if we need it
-            # This generates the tmp file, and replaces our data file
-            # with it
+            # The minimal VCF only needs the sample names from the header, so
+            # rather than downloading the whole VCF, which can be hundreds of GB,
+            # we stream it and stop at the #CHROM line. This generates the tmp
+            # file, and replaces our data file with it
             if body["type"].strip().lower() == "variant" and body.get("generateMinimalVCF"):
-                new_body = f"/tmp/minimalvcf-{int(time.time()*1000)}.tsv"
+                header_fp = f"{data_dir}/header-{int(time.time()*1000)}.vcf"
+                logger.info(f"reading the header of {body['data']} from S3 to {header_fp}")
+
+                with timings.stage("download") as stage:
+                    stage["bytes"] = vcf.download_header(
+                        gs_config["genestackbucket"], key, header_fp)
+
+                new_body = f"/tmp/minimalvcf-{os.getpid()}-{int(time.time()*1000)}.tsv"
                 logger.info(f"generating minimal VCF {new_body}")
 
-                uploadtogenestack.GenestackUploadUtils.writeonelinevcf(
-                    uploadtogenestack.GenestackUploadUtils.get_vcf_samples(
-                        body["data"]),
-                    new_body
-                )
+                try:
+                    with timings.stage("minimal_vcf") as stage:
+                        uploadtogenestack.GenestackUploadUtils.writeonelinevcf(
+                            uploadtogenestack.GenestackUploadUtils.get_vcf_samples(header_fp),
+                            new_body
+                        )
+                        stage["bytes"] = os.path.getsize(new_body)
+                finally:
+                    os.remove(header_fp)
 
                 body["data"] = new_body
                 logger.info("successfully made new minimal VCF")
 
+            else:
+                # the file keeps its original name
+                data_fp = f"{data_dir}/{body['data'].strip().replace('/', '_')}"
+                logger.info(f"downloading {body['data']} from S3 to {data_fp}")
+
+                with timings.stage("download") as stage:
+                    download_cache.cache.download_file(
+                        s3_bucket, gs_config["genestackbucket"], key, data_fp)
+                    stage["bytes"] = os.path.getsize(data_fp)
+
+                # gzip and bgzip files are given to Genestack as they are, as it
+                # reads them itself, but it can't read zstd, so those are decompressed
+                if compression.detect_file(data_fp) == compression.Compression.ZSTD:
+                    decompressed_fp = compression.decompressed_name(data_fp)
+                    logger.info(f"decompressing {data_fp} to {decompressed_fp}")
+
+                    with timings.stage("decompress") as stage:
+                        partial_fp = f"{decompressed_fp}.part"
+                        try:
+                            compression.decompress_file(data_fp, partial_fp)
+                            os.replace(partial_fp, decompressed_fp)
+                        finally:
+                            if os.path.exists(partial_fp):
+                                os.remove(partial_fp)
+                        if decompressed_fp != data_fp:
+                            os.remove(data_fp)
+                        data_fp = decompressed_fp
+                        stage["bytes"] = os.path.getsize(data_fp)
+
+                body["data"] = data_fp
+
             # By "creating" a GenestackStudy with a study accession, we'll actually
             # be able to modify the study - in our case we want to add a signal_dict
             logger.info(f"adding signal for study {study_id.strip()}")
 
-            study = uploadtogenestack.GenestackStudy(
-                study_genestackaccession=study_id.strip(),
-                genestackserver=env["gs_server"],
-                genestacktoken=token,
-                signal_dict=body,
-                ssh_key_filepath=env["ssh_key_path"]
-            )
+            with timings.stage("genestack_upload"):
+                study = uploadtogenestack.GenestackStudy(
+                    study_genestackaccession=study_id.strip(),
+                    genestackserver=env["gs_server"],
+                    genestacktoken=token,
+                    signal_dict=body,
+                    ssh_key_filepath=env["ssh_key_path"]
+                )
 
         logger.info(f"successfully made signal dataset for {study_id}")
         return job_responses.signal_created(study_id)
@@ -146,6 +191,8 @@ def new_signal(
 
     except (
         FileNotFoundError,
+        vcf.VCFHeaderError,
+        *compression.DECOMPRESSION_ERRORS,
         uploadtogenestack.genestackassist.LinkingNotPossibleError
     ) as err:
         logger.error("Bad Request")
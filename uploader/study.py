@@ -21,7 +21,6 @@ along with this program.  If not, see <https://www.gnu.org/licenses/>.
 """
 
 from collections import OrderedDict
-import csv
 import logging
 import os
 from pathlib import Path
@@ -32,8 +31,52 @@ import typing as T
 import botocore
 import uploadtogenestack
 
-from uploader import job_responses, s3
+from uploader import compression, download_cache, job_responses, s3, sample_columns
 from uploader.job_responses import JobResponse
+from uploader.timings import StageTimings
+
+# the keys of a study's body that tell us how to upload
+# it, rather than being metadata of the study
+UPLOAD_KEYS: T.Set[str] = {
+    "template", "Sample File", "renamedColumns", "addedColumns", "deletedColumns"}
+
+
+def metadata_problems(
+        body: T.Dict[str, T.Any],
+        template: T.List[T.Dict[str, T.Any]]) -> T.List[str]:
+    """check a study's metadata against the study fields of its template,
+    the same ones the frontend shows: those that aren't read only
+
+    Args:
+        body: Dict[str, Any]: the body of the API call
+        template: List[Dict[str, Any]]: the template's fields, from Genestack
+
+    Returns:
+        List[str]: a description of each problem,
+            which is empty if there are none
+    """
+    fields = {
+        field["name"]: field for field in template
+        if field.get("dataType") == "study" and not field.get("isReadOnly")
+    }
+    problems: T.List[str] = []
+
+    for key, value in body.items():
+        if key in UPLOAD_KEYS:
+            continue
+        if key not in fields:
+            problems.append(f"{key} isn't a study field of the template")
+        elif not isinstance(value, str):
+            problems.append(f"{key} must be a string")
+
+    for name, field in fields.items():
+        # the Study Title defaults to the Study Source
+        if name == "Study Title" and body.get("Study Source"):
+            continue
+        if field.get("isRequired") and not str(body.get(name) or "").strip():
+            problems.append(f"missing required field: {name}")
+
+    return problems
 
 
 def new_study(
@@ -41,7 +84,8 @@ def new_study(
         body: T.Dict[str, T.Any],
         logger: logging.Logger,
         env: T.Dict[str, T.Any],
-        _) -> JobResponse:
+        _,
+        timings: StageTimings) -> JobResponse:
     """
         Create a new study
 
@@ -51,6 +95,7 @@ def new_study(
                 this comes from the body of the API call
             logger: logging.Logger: the job's logger object
             env: Dict[str, Any]: the environment the jobs are run in
+            timings: StageTimings: records how long each stage of the upload takes
 
         Returns:
             JobResponse: containing both a JobStatus and Dict[str, Any],
@@ -83,122 +128,89 @@ def new_study(
                 # store it locally so it can get uploaded.
                 # Once it has been uploaded, we don't care about it anymore,
                 # so we'll just store it in /tmp
-                sample_file = Path(f"/tmp/samples_{int(time.time()*1000)}.tsv")
+                sample_file = Path(f"/tmp/samples_{os.getpid()}-{int(time.time()*1000)}.tsv")
 
                 # Getting Data from S3
                 logger.info(
                     f"downloading sample file from S3 ({body['Sample File']}) to {sample_file}")
 
                 gs_config = env["gs_config"]
-                s3_bucket.download_file(body["Sample File"].strip().replace(
-                    f"s3://{gs_config['genestackbucket']}/", ""), sample_file)
+                with timings.stage("download") as stage:
+                    download_cache.cache.download_file(
+                        s3_bucket,
+                        gs_config["genestackbucket"],
+                        body["Sample File"].strip().replace(
+                            f"s3://{gs_config['genestackbucket']}/", ""),
+                        sample_file
+                    )
+                    stage["bytes"] = os.path.getsize(sample_file)
 
                 # Changing Sample File Columns
 
                 # The user has the oppurtunity to rename columns in the sample file,
                 # create new columns in the sample file or delete them before it gets uploaded.
 
-                # We open a file to write this all to, how the uploadtogenestack package
-                # expects it to be. This is a `|` separated file, with a header row:
-                # old|new|fillvalue
-                # where fillvalue is what we've called colValue up to now
-                # Then we can pass the samples file, this new temp file to the package, and
-                # get back the path of a new samples file, which we'll use later on.
+                # We check what they want against the columns in the file, then write
+                # the new sample file a row at a time, so however big the file is, we
+                # only ever hold one row of it in memory
 
                 # all this is under the assumption that we're going to change anything,
-                # hence `if len(body["renamedColumns"]) + ... != 0:`
+                # hence `if renamed or added or deleted:`
+
+                renamed, added, deleted = sample_columns.complete_columns(
+                    body["renamedColumns"], body["addedColumns"], body["deletedColumns"])
 
-                if len(body["renamedColumns"]) + \
-                    len(body["addedColumns"]) + \
-                        len(body["deletedColumns"]) != 0:
+                if renamed or added or deleted:
                     logger.info("we have some columns to change")
-                    logger.info(f"Change: {body['renamedColumns']}")
-                    logger.info(f"Insert: {body['addedColumns']}")
-                    logger.info(f"Delete: {body['deletedColumns']}")
-
-                    with open(sample_file, encoding="UTF-8") as samples:
-                        reader = csv.reader(samples, delimiter="\t")
-                        headers = next(reader)
-
-                    # Let's remove any records that are fully blank""
-                    body["renamedColumns"] = [
-                        x for x in body["renamedColumns"] if x["old"] != "" and x["new"] != ""]
-                    body["addedColumns"] = [x for x in body["addedColumns"]
-                                            if x["title"] != "" and x["value"] != ""]
-
-                    # Let's check there's no entries not fully filled in
-                    if [x for x in body["renamedColumns"] if x["old"] == "" or x["new"] == ""] or \
-                            [x for x in body["addedColumns"]
-                             if x["title"] == "" or x["value"] == ""]:
-                        logger.error(
-                            "records not complete in added/renamed columns")
-                        return job_responses.bad_request_error(
-                            ValueError(
-                                "records not complete in added/renamed columns")
-                        )
-
-                    # Everything's going to go into the renamedColumns dict
-                    # First, we need to add [fillvalue] to the values as the file requires
-                    for col in body["renamedColumns"]:
-                        col["colValue"] = "[fillvalue]"
-
-                    # We'll now go through the columns left in the samples file, and add
-                    # them if they're not to be deleted
-                    for header in headers:
-                        if header not in [x["old"].strip() for x in body["renamedColumns"]] \
-                                and header not in [x.strip() for x in body["deletedColumns"]]:
-                            body["renamedColumns"].append({
-                                "old": header,
-                                "new": header,
-                                "colValue": "[fillvalue]"
-                            })
-
-                    # We'll now add the columns that are getting added
-                    for col in body["addedColumns"]:
-                        body["renamedColumns"].append({
-                            "old": "",
-                            "new": col["title"],
-                            "colValue": col["value"]
-                        })
-
-                    tmp_rename_fp: Path = Path(
-                        f"/tmp/gs-rename-{int(time.time()*1000)}.tsv")
-                    logger.info(
-                        f"we're going to write the rename information to {tmp_rename_fp}")
-
-                    # We can now open the file, and write all that information to it
-                    with open(tmp_rename_fp, "w", encoding="UTF-8") as tmp_rename:
-                        tmp_rename.write("old|new|fillvalue\n")
-                        for col_rename in body["renamedColumns"]:
-                            tmp_rename.write(
-                                "|".join([
-                                    col_rename["old"].strip(),
-                                    col_rename["new"].strip(),
-                                    col_rename["colValue"].strip()
-                                ]) + "\n")
+                    logger.info(f"Change: {renamed}")
+                    logger.info(f"Insert: {added}")
+                    logger.info(f"Delete: {deleted}")
 
                     try:
-                        uploadtogenestack.GenestackUploadUtils.check_suggested_columns(
-                            tmp_rename_fp,
-                            sample_file
-                        )
-                        logger.info(
-                            "the rename file was fine, now we'll modify the sample file")
-                        sample_file = Path(
-                            uploadtogenestack.GenestackUploadUtils.renamesamplefilecolumns(
-                                sample_file,
-                                tmp_rename_fp
-                            )
-                        )
-
-                    except uploadtogenestack.genestackassist.ColumnRenamingError as err:
-                        logger.error("failed to validate the sample file")
+                        plan = sample_columns.ColumnPlan(
+                            sample_columns.read_headers(sample_file), renamed, added, deleted)
+                    except sample_columns.ColumnPlanError as err:
+                        logger.error("the columns to change don't fit the sample file")
                         logger.exception(err)
                         return job_responses.bad_request_error(err)
 
+                    transformed_file: Path = Path(f"{sample_file}.transformed.tsv")
+                    logger.info(
+                        f"the columns are fine, writing the new sample file to {transformed_file}")
+
+                    with timings.stage("rename_columns") as stage:
+                        try:
+                            rows = sample_columns.transform(sample_file, plan, transformed_file)
+                        except BaseException:
+                            transformed_file.unlink(missing_ok=True)
+                            raise
+                        # we don't need the original any more
+                        os.remove(sample_file)
+                        sample_file = transformed_file
+                        stage["bytes"] = os.path.getsize(sample_file)
+                    logger.info(f"changed the columns of {rows} samples")
+
                 else:
                     logger.info("no columns to rename")
 
+                    # the sample file can be compressed in the bucket, and is
+                    # downloaded as it is. changing the columns decompresses
+                    # it as it goes, but otherwise we need to here, as
+                    # Genestack needs the sample file as plain text
+                    if compression.detect_file(sample_file) != compression.Compression.NONE:
+                        decompressed_file: Path = Path(f"{sample_file}.decompressed.tsv")
+                        logger.info(f"decompressing the sample file to {decompressed_file}")
+
+                        with timings.stage("decompress") as stage:
+                            try:
+                                compression.decompress_file(sample_file, decompressed_file)
+                            except BaseException:
+                                decompressed_file.unlink(missing_ok=True)
+                                raise
+                            os.remove(sample_file)
+                            sample_file = decompressed_file
+                            stage["bytes"] = os.path.getsize(sample_file)
+
             # Although these are passed to us in our API,
             # it would be invalid in what we pass to genestack, so we
             # need rid of it now we've downloaded the file from S3
@@ -215,26 +227,29 @@ def new_study(
             # the metadata values.
 
             # We can then create a new `GenestackStudy` to upload everything to Genestack
-            tmp_fp: str = f"/tmp/genestack-{int(time.time()*1000)}.tsv"
+            tmp_fp: str = f"/tmp/genestack-{os.getpid()}-{int(time.time()*1000)}.tsv"
             logging.info(f"using {tmp_fp} as the metadata file")
 
-            with open(tmp_fp, "w", encoding="UTF-8") as tmp_tsv:
-                logger.info("writing to metadata file")
-                body = OrderedDict(body)
-                tmp_tsv.write("\t".join(x.strip()
-                                        for x in body.keys()) + "\n")
-                tmp_tsv.write("\t".join(x.strip()
-                                        for x in body.values()) + "\n")
+            with timings.stage("metadata") as stage:
+                with open(tmp_fp, "w", encoding="UTF-8") as tmp_tsv:
+                    logger.info("writing to metadata file")
+                    body = OrderedDict(body)
+                    tmp_tsv.write("\t".join(x.strip()
+                                            for x in body.keys()) + "\n")
+                    tmp_tsv.write("\t".join(x.strip()
+                                            for x in body.values()) + "\n")
+                stage["bytes"] = os.path.getsize(tmp_fp)
 
             logger.info("creating study")
-            study = uploadtogenestack.GenestackStudy(
-                samplefile=sample_file,
-                genestackserver=env["gs_server"],
-                genestacktoken=token,
-                studymetadata=tmp_fp,
-                ssh_key_filepath=env["ssh_key_path"],
-                genestack_template=template
-            )
+            with timings.stage("genestack_upload"):
+                study = uploadtogenestack.GenestackStudy(
+                    samplefile=sample_file,
+                    genestackserver=env["gs_server"],
+                    genestacktoken=token,
+                    studymetadata=tmp_fp,
+                    ssh_key_filepath=env["ssh_key_path"],
+                    genestack_template=template
+                )
 
         logger.info(f"study created all good: {study.study_accession}")
         return job_responses.study_created(study.study_accession)
@@ -254,6 +269,11 @@ def new_study(
         logger.exception(err)
         return job_responses.bad_request_error(err)
 
+    except compression.DECOMPRESSION_ERRORS as err:
+        logger.error("can't decompress the sample file")
+        logger.exception(err)
+        return job_responses.bad_request_error(err)
+
     except (
         botocore.exceptions.ClientError,
         uploadtogenestack.genestackassist.BucketPermissionDenied
@@ -270,7 +290,6 @@ def new_study(
     finally:
         try:
             os.remove(sample_file)  # type: ignore
-            os.remove(tmp_rename_fp)  # type: ignore
             os.remove(tmp_fp)  # type: ignore
             shutil.rmtree(study.local_dir)  # type: ignore
         except (FileNotFoundError, UnboundLocalError, TypeError):
@@ -0,0 +1,70 @@
+"""
+Genestack Uploader
+A HTTP server providing an API and a frontend for easy uploading to Genestack
+
+Copyright (C) 2022 Genome Research Limited
+
+Author: Michael Grace <mg38@sanger.ac.uk>
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+import contextlib
+import time
+import typing as T
+
+Stage = T.Dict[str, T.Any]
+
+
+class StageTimings:  # pylint: disable=too-few-public-methods
+    """
+        Records how long each stage of a job takes,
+        and how many bytes it dealt with
+
+        Each stage is recorded as it finishes, and passed
+        to on_finish, so the timings of a running job can
+        be seen as it goes
+
+        Example:
+            with timings.stage("download") as stage:
+                download(fp)
+                stage["bytes"] = os.path.getsize(fp)
+    """
+
+    def __init__(self, on_finish: T.Optional[T.Callable[[int, Stage], None]] = None) -> None:
+        self.stages: T.List[Stage] = []
+        self._on_finish = on_finish
+
+    @contextlib.contextmanager
+    def stage(self, name: str) -> T.Iterator[Stage]:
+        """time the stage run within the context, even
+        if it raises an exception
+
+        Args:
+            name: str - what to call the stage
+
+        Yields:
+            Stage: the record of the stage, which the caller
+                can set "bytes" on, for example
+                {"name": "download", "seconds": 1.5, "bytes": 1024}
+        """
+        record: Stage = {"name": name, "seconds": None, "bytes": None}
+        start = time.perf_counter()
+        try:
+            yield record
+        finally:
+            record["seconds"] = round(time.perf_counter() - start, 3)
+            self.stages.append(record)
+            if self._on_finish:
+                self._on_finish(len(self.stages) - 1, record)
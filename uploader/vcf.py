@@ -0,0 +1,113 @@
+"""
+Genestack Uploader
+A HTTP server providing an API and a frontend for easy uploading to Genestack
+
+Copyright (C) 2022 Genome Research Limited
+
+Author: Michael Grace <mg38@sanger.ac.uk>
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+import os
+import typing as T
+
+from uploader import compression, s3
+
+# how much of the VCF is asked for at a time
+_CHUNK_BYTES: int = 64 * 1024
+
+
+class VCFHeaderError(ValueError):
+    """when a VCF's header doesn't end with a #CHROM line"""
+
+
+def _header_lines(chunks: T.Iterable[bytes]) -> T.Iterator[bytes]:
+    """the lines of a VCF's header, from the VCF decompressed, up to and
+    including the #CHROM line, reading no more of it than it takes to find it
+
+    Raises:
+        VCFHeaderError: if a line that isn't part of the
+            header, or the end of the file, comes first
+    """
+    # the start of a line that hasn't ended yet. #CHROM lines with
+    # many samples are long, so this is joined once the line ends
+    pending: T.List[bytes] = []
+    for chunk in chunks:
+        *lines, rest = chunk.split(b"\n")
+        if lines:
+            lines[0] = b"".join(pending) + lines[0]
+            pending = []
+        pending.append(rest)
+        for line in lines:
+            if not line.startswith(b"#"):
+                raise VCFHeaderError("the VCF has no #CHROM line before its records")
+            yield line + b"\n"
+            if line.startswith(b"#CHROM"):
+                return
+
+    last = b"".join(pending)
+    if last.startswith(b"#CHROM"):
+        yield last + b"\n"
+        return
+    raise VCFHeaderError("the VCF ends before its #CHROM line")
+
+
+def download_header(
+    bucket_name: str,
+    key: str,
+    destination: T.Union[str, os.PathLike]
+) -> int:
+    """put just the header of the VCF at key in the bucket, decompressed,
+    at destination. the VCF is streamed, and we stop reading it at the
+    #CHROM line, so however big the VCF is, only about as much as its
+    header is transferred
+
+    Args:
+        bucket_name: str - the name of the bucket
+        key: str - the key of the VCF in the bucket, which can
+            be plain text, or compressed with gzip, bgzip or zstd
+        destination: str | PathLike - where to put the header
+
+    Returns:
+        int: how many bytes of the VCF were read from S3
+
+    Raises:
+        botocore.exceptions.ClientError: if the VCF can't be read
+        VCFHeaderError: if the VCF has no #CHROM line
+    """
+    body = s3.s3_client().get_object(Bucket=bucket_name, Key=key)["Body"]
+    read = 0
+
+    def chunks() -> T.Iterator[bytes]:
+        nonlocal read
+        for chunk in body.iter_chunks(_CHUNK_BYTES):
+            read += len(chunk)
+            yield chunk
+
+    try:
+        with open(destination, "wb") as header:
+            for line in _header_lines(compression.decompress(chunks(), key)):
+                header.write(line)
+    except BaseException:
+        try:
+            os.remove(destination)
+        except FileNotFoundError:
+            pass
+        raise
+    finally:
+        # drops the connection, rather than reading the rest of the VCF
+        body.close()
+
+    return read
@@ -0,0 +1,561 @@
+"""
+Genestack Uploader
+A HTTP server providing an API and a frontend for easy uploading to Genestack
+
+Copyright (C) 2022 Genome Research Limited
+
+Author: Michael Grace <mg38@sanger.ac.uk>
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+from collections import OrderedDict
+import concurrent.futures
+import logging
+import threading
+import time
+import typing as T
+from urllib.parse import urlsplit
+
+import requests
+import requests.adapters
+import uploadtogenestack
+import urllib3.connection
+
+import api_cache
+import config
+from study_search import StudyIndex
+import uploader
+
+# Calls the API makes to Genestack, rather than the job workers
+
+logger: logging.Logger = logging.getLogger("upstream")
+logger.setLevel(config.LOG_LEVEL)
+
+GENESTACK_TIMEOUT_SECONDS: float = 120
+
+# the groups of signals a study can have
+SIGNAL_GROUPS: T.List[str] = ["variant", "expression"]
+
+# shared by all requests, so fanning out can't
+# overwhelm Genestack however many requests there are
+_pool = concurrent.futures.ThreadPoolExecutor(
+    max_workers=config.GENESTACK_THREADS, thread_name_prefix="genestack")
+
+
+class SignalGroupsError(Exception):
+    """
+    When getting any of a study's signal groups
+    fails. The args are the error for each group
+    """
+
+    def __init__(self, errors: T.Dict[str, Exception]) -> None:
+        super().__init__(
+            "couldn't get signal groups: " +
+            ", ".join(f"{group}: {err!r}" for group, err in errors.items()))
+        self.errors = errors
+
+
+class _ConnectionCounter:  # pylint: disable=too-few-public-methods
+    """
+        Counts the connections, so TLS handshakes, this process makes
+        to Genestack. The GenestackUtils makes its own connections,
+        which we can't get at, so this counts them as urllib3 makes
+        them, along with those of the clients' sessions
+    """
+
+    def __init__(self, host: T.Optional[str]) -> None:
+        self.host = host
+        self.count: int = 0
+        self._lock = threading.Lock()
+
+        connect = urllib3.connection.HTTPSConnection.connect
+
+        def counted_connect(conn: urllib3.connection.HTTPSConnection) -> None:
+            connect(conn)
+            self.connected(conn.host)
+
+        urllib3.connection.HTTPSConnection.connect = counted_connect
+
+    def connected(self, host: str) -> None:
+        """count a new connection, if it's to Genestack"""
+        if host == self.host:
+            with self._lock:
+                self.count += 1
+
+
+genestack_connections = _ConnectionCounter(urlsplit(config.SERVER_ENDPOINT).hostname)
+
+
+class GenestackClient:
+    """
+        A GenestackUtils, and a session for the calls we make
+        to Genestack ourselves, for a single token
+    """
+
+    def __init__(self, token: str) -> None:
+        self.gsu = uploadtogenestack.GenestackUtils(
+            token=token, server=config.SERVER_ENDPOINT)
+        self.session = requests.Session()
+        self.session.headers.update({
+            "Genestack-API-Token": token,
+            "Accept": "application/json"
+        })
+        self.session.mount("https://", requests.adapters.HTTPAdapter(
+            pool_maxsize=config.GENESTACK_THREADS))
+        self.last_used: float = time.monotonic()
+
+    def close(self) -> None:
+        """close our session, and any the GenestackUtils keeps. a
+        request still using one of their connections can finish, the
+        connection is closed when it's given back, rather than kept"""
+        self.session.close()
+        for value in vars(self.gsu).values():
+            if isinstance(value, requests.Session):
+                value.close()
+
+
+class ClientPool:
+    """
+        The Genestack clients for each token, kept so the
+        same keep-alive connections are used by every request
+        with that token, rather than each request making its own
+
+        Clients are keyed by the hashed token, and dropped when
+        they haven't been used for idle_seconds, or when there's
+        more than max_size of them, least recently used first
+    """
+
+    def __init__(self, max_size: int, idle_seconds: float) -> None:
+        self.max_size = max_size
+        self.idle_seconds = idle_seconds
+        self.created: int = 0
+        self.reused: int = 0
+        self._clients: "OrderedDict[str, GenestackClient]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, token: str) -> GenestackClient:
+        """get the client for a token, making it if there isn't one
+
+        Args:
+            token: str - the user's Genestack token
+
+        Returns:
+            GenestackClient
+
+        Raises:
+            uploadtogenestack.genestackETL.AuthenticationFailed
+        """
+        hashed_token = api_cache.hash_token(token)
+        with self._lock:
+            self._evict_idle()
+            client = self._clients.get(hashed_token)
+            if client is not None:
+                self._clients.move_to_end(hashed_token)
+                client.last_used = time.monotonic()
+                self.reused += 1
+                logger.debug(
+                    f"reusing Genestack client {hashed_token[:8]} "
+                    f"({len(self._clients)}/{self.max_size} in pool, {self.reused} reused)")
+                return client
+
+        # made outside the lock, as it can call Genestack
+        client = GenestackClient(token)
+        with self._lock:
+            existing = self._clients.get(hashed_token)
+            if existing is not None:
+                # another request for the token made one first
+                client.close()
+                self._clients.move_to_end(hashed_token)
+                existing.last_used = time.monotonic()
+                self.reused += 1
+                return existing
+            self._clients[hashed_token] = client
+            self.created += 1
+            while len(self._clients) > self.max_size:
+                self._drop(*self._clients.popitem(last=False), "pool full")
+            logger.info(
+                f"new Genestack client {hashed_token[:8]} "
+                f"({len(self._clients)}/{self.max_size} in pool, {self.created} made)")
+        return client
+
+    def _evict_idle(self) -> None:
+        """drop the clients that haven't been used for idle_seconds,
+        which are at the start, as they're kept in order of use"""
+        idle_since = time.monotonic() - self.idle_seconds
+        while self._clients:
+            hashed_token, client = next(iter(self._clients.items()))
+            if client.last_used > idle_since:
+                break
+            del self._clients[hashed_token]
+            self._drop(hashed_token, client, "idle")
+
+    @staticmethod
+    def _drop(hashed_token: str, client: GenestackClient, reason: str) -> None:
+        """close a client once it's out of the pool"""
+        client.close()
+        logger.info(f"dropping Genestack client {hashed_token[:8]} ({reason})")
+
+    def render_metrics(self) -> str:
+        """render how well the pool is doing in the Prometheus text
+        format, to go with uploader.metrics. these are for this
+        process only, as each web server process has its own pool
+
+        Returns:
+            str: the text exposition, for example
+                uploader_genestack_clients_reused_total 41
+        """
+        with self._lock:
+            in_pool = len(self._clients)
+
+        lines: T.List[str] = []
+        for name, metric_type, metric_help, value in [
+            ("uploader_genestack_clients_created_total", "counter",
+             "Genestack clients made, one for each token not in the pool", self.created),
+            ("uploader_genestack_clients_reused_total", "counter",
+             "Requests that used a Genestack client already in the pool", self.reused),
+            ("uploader_genestack_connections_total", "counter",
+             "Connections, so TLS handshakes, made to Genestack", genestack_connections.count),
+            ("uploader_genestack_clients", "gauge",
+             "Genestack clients in the pool", in_pool),
+        ]:
+            lines += [f"# HELP {name} {metric_help}", f"# TYPE {name} {metric_type}",
+                      f"{name} {float(value)!r}"]
+
+        return "\n".join(lines) + "\n"
+
+
+clients = ClientPool(config.GENESTACK_CLIENT_POOL_SIZE, config.GENESTACK_CLIENT_IDLE_SECONDS)
+
+
+def timed_call(call: str) -> T.ContextManager[None]:
+    """context manager to time a call to Genestack
+    for the metrics, labelled with the call's name"""
+    return uploader.metrics.timed("uploader_genestack_request_seconds", call=call)
+
+
+def get_signal_groups(
+    gsu: uploadtogenestack.GenestackUtils,
+    study_id: str
+) -> T.List[T.Dict[str, T.Any]]:
+    """get all a study's signals, getting each of SIGNAL_GROUPS
+    at the same time, waiting at most GENESTACK_TIMEOUT_SECONDS
+
+    Args:
+        gsu: GenestackUtils
+        study_id: str - the study accession
+
+    Returns:
+        List[Dict]: the signals, in the order of SIGNAL_GROUPS
+
+    Raises:
+        PermissionError, AuthenticationFailed, StudyAccessionError:
+            if any group raises one, as they'd apply to every group
+        SignalGroupsError: with every group's error otherwise
+    """
+    def get_group(group: str) -> T.List[T.Dict[str, T.Any]]:
+        with timed_call("get_signals_by_group"):
+            return gsu.get_signals_by_group(study_id, group)
+
+    futures = {group: _pool.submit(get_group, group) for group in SIGNAL_GROUPS}
+    deadline = time.monotonic() + GENESTACK_TIMEOUT_SECONDS
+
+    signals: T.List[T.Dict[str, T.Any]] = []
+    errors: T.Dict[str, Exception] = {}
+    for group, future in futures.items():
+        try:
+            signals += future.result(timeout=max(0, deadline - time.monotonic()))
+        except concurrent.futures.TimeoutError:
+            future.cancel()
+            errors[group] = TimeoutError(
+                f"no response in {GENESTACK_TIMEOUT_SECONDS} seconds")
+        except Exception as err:  # pylint: disable=broad-except
+            errors[group] = err
+
+    for err in errors.values():
+        if isinstance(err, (
+            PermissionError,
+            uploadtogenestack.genestackETL.AuthenticationFailed,
+            uploadtogenestack.genestackETL.StudyAccessionError
+        )):
+            raise err
+    if errors:
+        raise SignalGroupsError(errors)
+
+    return signals
+
+
+def signal_index(
+    token: str,
+    study_id: str,
+    refresh: bool = False
+) -> T.Dict[str, T.List[T.Dict[str, T.Any]]]:
+    """get the index of a study's signals by itemId
+
+    The index is cached for SIGNAL_INDEX_TTL_SECONDS, but is built
+    again if a signal job for the study has completed since it was
+    built, or if refresh is set. It's always built again in full,
+    listing every one of SIGNAL_GROUPS: the job store doesn't know
+    which group a signal went to, and the groups are listed at the
+    same time, so one group would take about as long as all of them
+
+    Args:
+        token: str - the user's Genestack token
+        study_id: str - the study accession
+        refresh: bool - build the index again, even if it's cached
+
+    Returns:
+        Dict[str, List[Dict]]: the signals for each itemId, in the
+            order Genestack listed them. There should only be one each
+
+    Raises:
+        uploadtogenestack.genestackETL.StudyAccessionError: if the
+            study can't be found
+    """
+    key = (config.SERVER_ENDPOINT, api_cache.hash_token(token), study_id)
+    index = api_cache.signal_indexes.get(key)
+    if index is not api_cache.MISSING and not refresh:
+        last_upload = uploader.job_store.last_completed("signal", study_id)
+        if last_upload is None or last_upload < index["built"]:
+            return index["signals"]
+        logger.info(f"a signal has been uploaded to {study_id}, indexing its signals again")
+
+    # taken before listing, so a signal job that completes
+    # while we're listing makes the index stale
+    built = time.time()
+    gsu = clients.get(token).gsu
+    listing = get_signal_groups(gsu, study_id)
+
+    signals: T.Dict[str, T.List[T.Dict[str, T.Any]]] = {}
+    for signal in listing:
+        signals.setdefault(signal["itemId"], []).append(signal)
+
+    api_cache.signal_indexes.set(key, {"built": built, "signals": signals})
+    return signals
+
+
+def get_studies_page(
+    token: str,
+    offset: int,
+    limit: int
+) -> T.Tuple[T.List[T.Dict[str, T.Any]], T.Optional[int]]:
+    """get a page of studies from Genestack
+
+    get_all_studies doesn't page, so stops at 2000 studies,
+    so this calls the studies endpoint it uses directly
+
+    Args:
+        token: str - the user's Genestack token
+        offset: int - how many studies to skip
+        limit: int - the most studies to get
+
+    Returns:
+        Tuple[List[Dict], Optional[int]]: the studies, and the offset
+            of the next page, or None if this is the last page
+
+    Raises:
+        PermissionError: if Genestack rejects the token
+        requests.HTTPError: for any other error from Genestack
+    """
+    with timed_call("get_studies_page"):
+        response = clients.get(token).session.get(
+            f"{config.SERVER_ENDPOINT}{config.STUDIES_API_PATH}",
+            params={"pageOffset": offset, "pageLimit": limit},
+            timeout=GENESTACK_TIMEOUT_SECONDS
+        )
+    if response.status_code in (401, 403):
+        raise PermissionError("Genestack rejected the token")
+    response.raise_for_status()
+
+    body = response.json()
+    studies: T.List[T.Dict[str, T.Any]] = body["data"]
+    total: T.Optional[int] = body.get("meta", {}).get("pagination", {}).get("total")
+
+    next_offset = offset + len(studies)
+    if not studies or (next_offset >= total if total is not None else len(studies) < limit):
+        return studies, None
+    return studies, next_offset
+
+
+def stream_studies(
+    token: str,
+    studies: T.List[T.Dict[str, T.Any]],
+    next_offset: T.Optional[int]
+) -> T.Iterator[T.Dict[str, T.Any]]:
+    """yield each study from the page already fetched,
+    then from each following page as it arrives"""
+    while True:
+        yield from studies
+        if next_offset is None:
+            return
+        studies, next_offset = get_studies_page(token, next_offset, config.STUDIES_PAGE_SIZE)
+
+
+# the hashed tokens whose study index is being built in the background
+_study_index_builds: T.Set[str] = set()
+_study_index_builds_lock = threading.Lock()
+
+
+def _build_study_index(token: str) -> StudyIndex:
+    """list every study the token can see, index them,
+    and cache the index for the token"""
+    built = time.monotonic()
+    studies, next_offset = get_studies_page(token, 0, config.STUDIES_PAGE_SIZE)
+    index = StudyIndex(stream_studies(token, studies, next_offset))
+
+    hashed_token = api_cache.hash_token(token)
+    api_cache.study_indexes.set(
+        (config.SERVER_ENDPOINT, hashed_token), {"built": built, "index": index})
+    # Genestack has just answered us, so the token's good
+    api_cache.valid_tokens.set(hashed_token, True)
+    logger.info(f"indexed {len(index)} studies for {hashed_token[:8]}")
+    return index
+
+
+def _refresh_study_index(token: str) -> None:
+    """build the token's study index again, in the background"""
+    hashed_token = api_cache.hash_token(token)
+    with _study_index_builds_lock:
+        if hashed_token in _study_index_builds:
+            return
+        _study_index_builds.add(hashed_token)
+
+    def refresh() -> None:
+        try:
+            _build_study_index(token)
+        except Exception as err:  # pylint: disable=broad-except
+            # the old index is used until the next try
+            logger.error(f"couldn't index studies for {hashed_token[:8]}")
+            logger.exception(err)
+        finally:
+            with _study_index_builds_lock:
+                _study_index_builds.discard(hashed_token)
+
+    threading.Thread(target=refresh, name="study-index", daemon=True).start()
+
+
+def study_index(token: str) -> StudyIndex:
+    """get the index of the studies the token can see
+
+    The first time, the studies are listed and indexed before
+    returning. After that, the cached index is returned, and if it
+    was built more than STUDY_INDEX_REFRESH_SECONDS ago, it's built
+    again in the background, for the following searches
+
+    Args:
+        token: str - the user's Genestack token
+
+    Returns:
+        StudyIndex
+
+    Raises:
+        PermissionError: if Genestack rejects the token
+        requests.HTTPError: for any other error from Genestack
+    """
+    cached = api_cache.study_indexes.get((config.SERVER_ENDPOINT, api_cache.hash_token(token)))
+    if cached is api_cache.MISSING:
+        return _build_study_index(token)
+
+    # the index is shared by the token's requests, so the token's still checked
+    check_token(token)
+    if time.monotonic() - cached["built"] > config.STUDY_INDEX_REFRESH_SECONDS:
+        _refresh_study_index(token)
+    return cached["index"]
+
+
+def check_token(token: str) -> None:
+    """make sure Genestack accepts the token, with a single
+    cheap call, unless it's done so recently
+
+    Raises:
+        PermissionError: if Genestack rejects the token
+        uploadtogenestack.genestackETL.AuthenticationFailed
+    """
+    hashed_token = api_cache.hash_token(token)
+    if api_cache.valid_tokens.get(hashed_token) is not api_cache.MISSING:
+        return
+
+    gsu = clients.get(token).gsu
+    with timed_call("check_token"):
+        response = gsu.ApplicationsODM(gsu, None).get_template_types()
+    if response.status_code in (401, 403):
+        raise PermissionError("Genestack rejected the token")
+
+    api_cache.valid_tokens.set(hashed_token, True)
+
+
+def current_user(token: str) -> str:
+    """get the Genestack user a token belongs to, unless it's been
+    looked up recently. this stays the same when the user makes a
+    new token, unlike the token itself
+
+    Returns:
+        str: the user's login, such as someone@sanger.ac.uk
+
+    Raises:
+        PermissionError: if Genestack rejects the token
+        requests.HTTPError: for any other error from Genestack
+    """
+    hashed_token = api_cache.hash_token(token)
+    user = api_cache.token_users.get(hashed_token)
+    if user is not api_cache.MISSING:
+        return user
+
+    with timed_call("current_user"):
+        response = clients.get(token).session.post(
+            f"{config.SERVER_ENDPOINT}{config.WHOAMI_API_PATH}",
+            data={"method": "whoami", "parameters": "[]"},
+            timeout=GENESTACK_TIMEOUT_SECONDS
+        )
+    if response.status_code in (401, 403):
+        raise PermissionError("Genestack rejected the token")
+    response.raise_for_status()
+
+    user = response.json()["result"]
+    api_cache.token_users.set(hashed_token, user)
+    return user
+
+
+def cached_template_lookup(
+    token: str,
+    key: T.Tuple[str, ...],
+    lookup: T.Callable[[uploadtogenestack.GenestackUtils], T.Any]
+) -> T.Any:
+    """get a template lookup from the template cache, or call lookup
+    to get it from Genestack and cache it. the cache is shared by
+    every user, so the token is still checked on a hit
+
+    Args:
+        token: str - the user's Genestack token
+        key: Tuple[str, ...] - what's being looked up, which
+            is cached for this Genestack server
+        lookup: Callable[[GenestackUtils], Any] - gets the
+            value from Genestack, raising if it can't
+
+    Returns:
+        Any: the cached, or looked up, value
+    """
+    key = (config.SERVER_ENDPOINT, *key)
+    value = api_cache.templates.get(key)
+    if value is not api_cache.MISSING:
+        logger.info(f"{key} found in the template cache")
+        check_token(token)
+        return value
+
+    gsu = clients.get(token).gsu
+    value = lookup(gsu)
+    api_cache.templates.set(key, value)
+    # Genestack has just answered us, so the token's good
+    api_cache.valid_tokens.set(api_cache.hash_token(token), True)
+    return value